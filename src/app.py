@@ -1,10 +1,15 @@
+import time
+_RUN_START = time.perf_counter()
+
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageOps
 from core.Model import Model
+import hashlib
+import io
 import os
 import shutil
+import uuid
 from dotenv import load_dotenv
-from core.rag import pipeline_model, pipeline_clip
 from pathlib import Path
 load_dotenv()
 
@@ -22,20 +27,105 @@ available_models = [m.strip() for m in env_models.split(",")]
 default_model_env = os.getenv("DEFAULT_MODEL", "llava")
 
 TEMP_DIR = "temp_rag_images"
+# les dossiers de session sans activité depuis RAG_TEMP_TTL_HOURS sont supprimés (la fin d'une session streamlit
+# n'est pas notifiée)
+TEMP_TTL_HOURS = float(os.getenv("RAG_TEMP_TTL_HOURS", "24"))
+
+
+@st.cache_resource(show_spinner="Loading CLIP...")
+def load_rag():
+    """
+    Le module RAG et CLIP ne sont chargés que si on passe en mode RAG, une fois pour tout le process streamlit.
+    Si INFERENCE_SERVICE_URL est dans le .env, on passe par le service partagé (service/server.py) : CLIP n'est
+    pas chargé dans ce process et les requêtes identiques des différentes sessions sont calculées une seule fois.
+    """
+    service_url = os.getenv("INFERENCE_SERVICE_URL")
+    if service_url:
+        from service.client import ServiceClient
+        return ServiceClient(service_url)
+    from core import rag
+    rag.get_clip()
+    return rag
+
+
+def sweep_album_dirs(ttl_hours=TEMP_TTL_HOURS):
+    """Supprime les dossiers de session de TEMP_DIR qui n'ont pas été touchés depuis ttl_hours."""
+    if not os.path.isdir(TEMP_DIR):
+        return
+    limit = time.time() - ttl_hours * 3600
+    for entry in os.scandir(TEMP_DIR):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < limit:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            # supprimé en même temps par une autre session
+            pass
+
+
+def _album():
+    """
+    Album de la session : file_id de l'upload streamlit -> {hash, path, name}.
+    Les fichiers sont enregistrés sous le hash de leur contenu dans un dossier propre à la session
+    (temp_rag_images/<session>/<sha1>.<ext>) : une session qui retire une image ne supprime pas le fichier d'une
+    autre. Une image déjà reçue n'est ni réécrite ni ré-encodée par CLIP (l'index retrouve son embedding par le
+    hash du contenu, même venant d'une autre session).
+    """
+    if "album" not in st.session_state:
+        # nouvelle session : on en profite pour faire le ménage des sessions abandonnées
+        sweep_album_dirs()
+        st.session_state.album = {}
+        st.session_state.album_dir = os.path.join(TEMP_DIR, uuid.uuid4().hex)
+    return st.session_state.album
 
 
 def save_uploaded_files(uploaded_files):
-    if os.path.exists(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR)
-    os.makedirs(TEMP_DIR)
-
-    saved_paths = []
-    for uploaded_file in uploaded_files:
-        file_path = os.path.join(TEMP_DIR, uploaded_file.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        saved_paths.append(os.path.abspath(file_path))
-    return saved_paths
+    """
+    Synchronise le dossier de l'album avec les fichiers uploadés, de façon incrémentale.
+    :return: chemins des images (dans l'ordre des uploads, sans doublons de contenu)
+    """
+    album = _album()
+    album_dir = st.session_state.album_dir
+    os.makedirs(album_dir, exist_ok=True)
+    # le dossier d'une session active n'est pas supprimé par sweep_album_dirs
+    os.utime(album_dir)
+    current = {f.file_id: f for f in uploaded_files}
+
+    for file_id, uploaded_file in current.items():
+        # déjà reçue pendant cette session
+        if file_id in album and os.path.exists(album[file_id]["path"]):
+            continue
+        data = uploaded_file.getvalue()
+        file_hash = hashlib.sha1(data).hexdigest()
+        ext = os.path.splitext(uploaded_file.name)[1].lower() or ".jpg"
+        file_path = os.path.abspath(os.path.join(album_dir, file_hash + ext))
+        if not os.path.exists(file_path):
+            tmp_path = file_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        album[file_id] = {"hash": file_hash, "path": file_path, "name": uploaded_file.name}
+
+    # images retirées de l'uploader : on supprime les fichiers que l'album de la session n'utilise plus
+    removed = [file_id for file_id in album if file_id not in current]
+    for file_id in removed:
+        entry = album.pop(file_id)
+        if all(e["path"] != entry["path"] for e in album.values()) and os.path.exists(entry["path"]):
+            os.remove(entry["path"])
+    if not album:
+        shutil.rmtree(album_dir, ignore_errors=True)
+
+    return list(dict.fromkeys(album[f]["path"] for f in current))
+
+
+@st.cache_data(show_spinner=False, max_entries=2000)
+def thumbnail(path, size=256):
+    """Miniature JPEG d'une image de l'album, générée une seule fois (le chemin contient le hash du contenu)."""
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((size, size))
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=85)
+    return out.getvalue()
 
 
 #SIDEBAR
@@ -106,24 +196,19 @@ if mode == "Single Image Analysis":
                     st.markdown(user_query)
 
                 with st.chat_message("assistant"):
-                    with st.spinner(f"Analyzing with {selected_model}..."):
-                        try:
-                            chat_model = Model(
-                                model_name=selected_model,
-                                prompts=[user_query],
-                                imgs_path=[temp_path],
-                                coco_captions={}
-                            )
-                            responses, _ = chat_model.execute(prompt_id=0, freq_print=0)
-
-                            img_key = list(responses.keys())[0]
-                            bot_response = responses[img_key][0]
-
-                            st.markdown(bot_response)
-                            st.session_state.messages.append({"role": "assistant", "content": bot_response})
+                    try:
+                        chat_model = Model(
+                            model_name=selected_model,
+                            prompts=[user_query],
+                            imgs_path=[temp_path],
+                            coco_captions={}
+                        )
+                        # les tokens sont affichés au fur et à mesure qu'Ollama les génère
+                        bot_response = st.write_stream(chat_model.stream(prompt_id=0))
+                        st.session_state.messages.append({"role": "assistant", "content": bot_response})
 
-                        except Exception as e:
-                            st.error(f"Error: {e}")
+                    except Exception as e:
+                        st.error(f"Error: {e}")
 
 #MODE 2: MULTIMODAL RAG
 else:
@@ -134,32 +219,39 @@ else:
 
     if len(uploaded_files) > 1:
         image_paths = save_uploaded_files(uploaded_files)
+        names = {e["path"]: e["name"] for e in _album().values()}
         st.success(f"{len(image_paths)} images loaded.")
 
         with st.expander("View Gallery"):
             cols = st.columns(5)
-            for idx, img_file in enumerate(uploaded_files):
-                cols[idx % 5].image(img_file, caption=img_file.name, use_container_width=True)
+            for idx, path in enumerate(image_paths):
+                cols[idx % 5].image(thumbnail(path), caption=names[path], use_container_width=True)
 
         if user_query := st.chat_input("Search for something"):
             with st.chat_message("user"):
                 st.markdown(user_query)
 
             with st.chat_message("assistant"):
-                with st.spinner("Processing RAG pipeline..."):
-                    try:
-                        best_img_path = pipeline_clip(user_query, image_paths)
-
-                        if best_img_path is None:
-                            st.error("Clip did not find a good match, please retry with another prompt")
-                        else:
-                            st.markdown(f"**Best match:** {os.path.basename(best_img_path)}")
-                            st.image(best_img_path, width=300)
-                            bot_response = pipeline_model(user_query, best_img_path, model=selected_model)
-                            st.markdown("### Answer")
-                            st.markdown(bot_response)
-
-                    except Exception as e:
-                        st.error(f"RAG Pipeline Error: {e}")
+                try:
+                    with st.spinner("Processing RAG pipeline..."):
+                        rag = load_rag()
+                        best_img_path = rag.pipeline_clip(user_query, image_paths)
+
+                    if best_img_path is None:
+                        st.error("Clip did not find a good match, please retry with another prompt")
+                    else:
+                        st.markdown(f"**Best match:** {names.get(best_img_path, os.path.basename(best_img_path))}")
+                        st.image(best_img_path, width=300)
+                        st.markdown("### Answer")
+                        st.write_stream(rag.pipeline_model(user_query, best_img_path, model=selected_model, stream=True))
+
+                except Exception as e:
+                    st.error(f"RAG Pipeline Error: {e}")
     else:
+        if st.session_state.get("album"):
+            # uploader vidé : l'album de la session et son dossier sont supprimés
+            save_uploaded_files([])
         st.info("Please upload at least 2 images to enable RAG mode.")
+
+# temps d'exécution du script (chaque rerun streamlit) pour repérer les régressions au démarrage
+st.sidebar.caption(f"Run time: {time.perf_counter() - _RUN_START:.2f}s")
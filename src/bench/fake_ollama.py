@@ -0,0 +1,241 @@
+"""
+    Faux serveur Ollama (HTTP, même API que le vrai pour /api/chat, /api/tags et /api/version) pour les benchmarks :
+    pas de GPU ni de réseau, latence et taux d'erreur réglables.
+    Seul : python -m bench.fake_ollama --port 11435 --latency-ms 200 --fail-rate 0.05 (depuis src/)
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CAPTIONS = [
+    "A dog lying on a couch in a living room.",
+    "A plate of food with vegetables and meat on a table.",
+    "A man riding a bicycle down a city street.",
+    "Two cats sleeping next to each other on a bed.",
+    "A bathroom with a white sink and a mirror.",
+    "A red car parked in front of a garage.",
+]
+
+
+class FakeOllamaServer:
+    """
+    Serveur lancé dans un thread. Chaque requête /api/chat attend latency_ms (+/- jitter_ms), puis renvoie une
+    légende choisie d'après le hash de l'image ; en streaming chaque token attend en plus token_ms.
+    Une requête sur fail_rate (en moyenne) renvoie une erreur 500.
+    Un seul modèle reste chargé à la fois : passer à un autre modèle coûte load_ms (compté dans stats()["loads"]),
+    une requête sans message le charge seulement, ou le décharge avec keep_alive=0 (comme Ollama).
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=100.0, jitter_ms=0.0, token_ms=0.0, fail_rate=0.0,
+                 seed=0, models=("llava", "moondream", "qwen2.5vl:3b"), load_ms=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.token_ms = token_ms
+        self.fail_rate = fail_rate
+        self.models = list(models)
+        self.load_ms = load_ms
+        self.loaded = None
+        self.loads = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._json(200, server.tags())
+                elif self.path == "/api/ps":
+                    self._json(200, server.ps())
+                elif self.path == "/api/version":
+                    self._json(200, {"version": "0.0.0-fake"})
+                else:
+                    self._json(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/api/chat":
+                    self._json(404, {"error": "not found"})
+                    return
+                server.chat(self, body)
+
+            def _json(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.handler = Handler
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.handle_error = self._handle_error
+        self.thread = None
+
+    def _handle_error(self, request, address):
+        # client parti avant la réponse (timeout du health check, requête abandonnée) : normal ici
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self.httpd, request, address)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def tags(self):
+        now = datetime.now(timezone.utc).isoformat()
+        return {"models": [{
+            "name": m, "model": m, "modified_at": now, "size": 1,
+            "digest": hashlib.sha256(m.encode()).hexdigest(),
+            "details": {"format": "gguf", "family": "fake", "parameter_size": "0B", "quantization_level": "Q0"},
+        } for m in self.models]}
+
+    def ps(self):
+        with self.lock:
+            loaded = [self.loaded] if self.loaded else []
+        return {"models": [{"name": m, "model": m, "size": 1, "size_vram": 1,
+                            "digest": hashlib.sha256(m.encode()).hexdigest()} for m in loaded]}
+
+    def _load(self, model):
+        """Charge le modèle s'il ne l'est pas déjà, renvoie le temps de chargement (s)."""
+        with self.lock:
+            if self.loaded == model:
+                return 0.0
+            self.loaded = model
+            self.loads += 1
+        time.sleep(self.load_ms / 1000)
+        return self.load_ms / 1000
+
+    def _delay(self):
+        with self.lock:
+            jitter = self.rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+            fail = self.rng.random() < self.fail_rate
+        return max(0.0, self.latency_ms + jitter) / 1000, fail
+
+    def chat(self, handler, body):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            start = time.perf_counter()
+            model = body.get("model", "")
+            unload = body.get("keep_alive") in (0, "0", "0s")
+            load = 0.0
+            if not (unload and not body.get("messages")):
+                load = self._load(model)
+            if not body.get("messages"):
+                # requête de chargement (warm-up) ou de déchargement
+                if unload:
+                    with self.lock:
+                        self.loaded = None if self.loaded == model else self.loaded
+                handler._json(200, {"model": model, "created_at": datetime.now(timezone.utc).isoformat(),
+                                    "message": {"role": "assistant", "content": ""}, "done": True,
+                                    "done_reason": "unload" if unload else "load", "load_duration": int(load * 1e9)})
+                return
+            delay, fail = self._delay()
+            time.sleep(delay)
+            if fail:
+                with self.lock:
+                    self.failures += 1
+                handler._json(500, {"error": "fake ollama: injected failure"})
+                return
+
+            message = (body.get("messages") or [{}])[-1]
+            images = message.get("images") or [""]
+            digest = hashlib.sha256(str(images[0]).encode()).digest()
+            caption = CAPTIONS[digest[0] % len(CAPTIONS)]
+            base = {"model": model, "created_at": datetime.now(timezone.utc).isoformat()}
+            prompt_tokens = len(str(message.get("content", "")).split()) + 576 * len(message.get("images") or [])
+            tokens = [w + " " for w in caption.split()]
+
+            def final(content):
+                total = int((time.perf_counter() - start) * 1e9)
+                return {**base, "message": {"role": "assistant", "content": content}, "done": True,
+                        "done_reason": "stop", "total_duration": total, "load_duration": int(load * 1e9),
+                        "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(delay * 1e9),
+                        "eval_count": len(tokens), "eval_duration": max(0, total - int(delay * 1e9))}
+
+            if body.get("stream", True) is False:
+                time.sleep(self.token_ms * len(tokens) / 1000)
+                handler._json(200, final(caption))
+                return
+
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/x-ndjson")
+            handler.send_header("Transfer-Encoding", "chunked")
+            handler.end_headers()
+
+            def send(payload):
+                line = (json.dumps(payload) + "\n").encode("utf-8")
+                handler.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                handler.wfile.flush()
+
+            for token in tokens:
+                time.sleep(self.token_ms / 1000)
+                send({**base, "message": {"role": "assistant", "content": token}, "done": False})
+            send(final(""))
+            handler.wfile.write(b"0\r\n\r\n")
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "failures": self.failures, "max_in_flight": self.max_in_flight,
+                    "loads": self.loads}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Faux serveur Ollama pour les benchmarks")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency-ms", type=float, default=100.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--token-ms", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--load-ms", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeOllamaServer(port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                              token_ms=args.token_ms, fail_rate=args.fail_rate, load_ms=args.load_ms)
+    print(f"Faux Ollama sur {server.url} (OLLAMA_HOST={server.url})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+    Benchmarks de bout en bout : Model.execute, pipeline_model (complet et en streaming) et pipeline_clip,
+    avec latences p50/p95/p99, débit et pic de mémoire (RSS).
+    Par défaut Ollama est remplacé par un faux serveur local (bench/fake_ollama.py) : pas de GPU ni de réseau.
+
+    Les modules du projet (donc ollama) ne sont importés qu'une fois OLLAMA_HOST positionné, cf main().
+"""
+
+import contextlib
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+TEST_IMAGES_DIR = SRC_DIR / "data" / "test"
+
+PROMPT = "Provide a very short, concise, and factual caption for this image. Maximum 10 words."
+CLIP_QUESTIONS = ["a dog on a couch", "a plate of food", "a bathroom sink", "two dogs playing", "a garage door"]
+
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du process depuis son lancement (Mo), NaN si on ne sait pas le mesurer."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ko sous linux, octets sous macOS
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        try:
+            import psutil
+            info = psutil.Process().memory_info()
+            return getattr(info, "peak_wset", info.rss) / (1 << 20)
+        except ImportError:
+            return float("nan")
+
+
+def summarize(scenario, latencies, wall, errors=0, **extra):
+    """
+    :param latencies: latences (s) de chaque élément traité
+    :param wall: durée totale (s) du scénario
+    """
+    lat = np.asarray(latencies, dtype=np.float64) * 1000
+    row = {
+        "scenario": scenario,
+        "n": int(len(lat)),
+        "errors": int(errors),
+        "p50_ms": float(np.percentile(lat, 50)) if len(lat) else float("nan"),
+        "p95_ms": float(np.percentile(lat, 95)) if len(lat) else float("nan"),
+        "p99_ms": float(np.percentile(lat, 99)) if len(lat) else float("nan"),
+        "throughput": len(lat) / wall if wall > 0 else float("nan"),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    row.update(extra)
+    return row
+
+
+def make_images(n, out_dir, size=(640, 480), seed=0):
+    """
+    n images jpeg synthétiques (toutes différentes) nommées comme COCO (000000000001.jpg), pour que
+    Model les convertisse en ids entiers.
+    """
+    rng = np.random.default_rng(seed)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n):
+        path = out_dir / f"{i + 1:012d}.jpg"
+        if not path.exists():
+            base = rng.integers(0, 255, size=(size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+            Image.fromarray(base).resize(size, Image.BILINEAR).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def bench_execute(images, model_name, workers, repeat=1, cache=False, verbose=False, label="execute"):
+    """
+    Model.execute sur toutes les images ; la latence de chaque image est relevée par _run_one.
+    """
+    from core.Model import Model
+
+    class RecordingModel(Model):
+        def _run_one(self, *args, **kwargs):
+            result = super()._run_one(*args, **kwargs)
+            self.records.append(result)
+            return result
+
+    model = RecordingModel(model_name=model_name, prompts=[PROMPT], imgs_path=images, coco_captions={},
+                           max_workers=workers, cache=cache)
+    rows = []
+    for r in range(repeat):
+        model.records = []
+        start = time.perf_counter()
+        with _quiet(verbose):
+            model.execute(prompt_id=0, freq_print=0)
+        wall = time.perf_counter() - start
+        rows.append(summarize(
+            f"{label}[w={workers}]" + (f" #{r + 1}" if repeat > 1 else ""),
+            [rec["duration"] for rec in model.records], wall,
+            errors=sum(rec["error"] is not None for rec in model.records),
+            cached=sum(rec["cached"] for rec in model.records),
+        ))
+    return rows
+
+
+def bench_pipeline_model(images, model_name, verbose=False):
+    """pipeline_model (réponse complète), une image après l'autre comme dans l'app."""
+    from core import rag
+
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for path in images:
+        t = time.perf_counter()
+        with _quiet(verbose):
+            response = rag.pipeline_model(PROMPT, str(path), model_name, cache=False)
+        latencies.append(time.perf_counter() - t)
+        errors += response == "Ann error occured on the image size or type"
+    return summarize("pipeline_model", latencies, time.perf_counter() - start, errors=errors)
+
+
+def bench_pipeline_stream(images, model_name, verbose=False):
+    """pipeline_model(stream=True) : latence totale et temps jusqu'au premier token."""
+    from core import rag
+
+    latencies, first_tokens, errors = [], [], 0
+    start = time.perf_counter()
+    for path in images:
+        t = time.perf_counter()
+        first = None
+        text = ""
+        with _quiet(verbose):
+            for token in rag.pipeline_model(PROMPT, str(path), model_name, cache=False, stream=True):
+                if first is None:
+                    first = time.perf_counter() - t
+                text += token
+        latencies.append(time.perf_counter() - t)
+        first_tokens.append(first if first is not None else latencies[-1])
+        errors += text == "Ann error occured on the image size or type"
+    return summarize("pipeline_model[stream]", latencies, time.perf_counter() - start, errors=errors,
+                     ttft_p50_ms=float(np.percentile(first_tokens, 50) * 1000) if first_tokens else float("nan"))
+
+
+def bench_pipeline_clip(images, repeat=3, verbose=False):
+    """
+    pipeline_clip sur les images de test : la 1re requête (chargement de CLIP + index) est mesurée à part.
+    Nécessite torch et transformers (le modèle CLIP doit déjà être téléchargé pour rester hors réseau).
+    """
+    try:
+        import torch  # noqa: F401
+        import transformers  # noqa: F401
+    except ImportError:
+        print("pipeline_clip ignoré : torch / transformers ne sont pas installés")
+        return []
+    from core import rag
+
+    paths = [str(p) for p in images]
+    t = time.perf_counter()
+    with _quiet(verbose):
+        rag.pipeline_clip(CLIP_QUESTIONS[0], paths)
+    cold = time.perf_counter() - t
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for question in CLIP_QUESTIONS:
+            t = time.perf_counter()
+            with _quiet(verbose):
+                rag.pipeline_clip(question, paths)
+            latencies.append(time.perf_counter() - t)
+    return [summarize(f"pipeline_clip[{rag.CLIP_BACKEND}]", latencies, time.perf_counter() - start,
+                      cold_ms=cold * 1000)]
+
+
+def bench_service(images, model_name, clients, verbose=False):
+    """
+    Service d'inférence (service/server.py) lancé dans ce process : clients threads envoient chacun une requête
+    pipeline_model par image, tous sur les mêmes images en même temps. Les requêtes identiques en cours sont
+    regroupées (coalescing), la colonne coalesced donne le nombre de requêtes qui n'ont pas appelé Ollama.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from core.Instrumentation import get_recorder
+    from service.client import ServiceClient
+    from service.server import InferenceService
+
+    def coalesced():
+        return sum(v for (name, _), v in get_recorder().counters.items() if name == "service_coalesced_total")
+
+    before = coalesced()
+    with InferenceService(port=0, cache=False) as service:
+        def one_client(_):
+            client = ServiceClient(service.url)
+            latencies = []
+            for path in images:
+                t = time.perf_counter()
+                client.pipeline_model(PROMPT, str(path), model_name)
+                latencies.append(time.perf_counter() - t)
+            client.close()
+            return latencies
+
+        start = time.perf_counter()
+        with _quiet(verbose), ThreadPoolExecutor(max_workers=clients) as pool:
+            latencies = [lat for lats in pool.map(one_client, range(clients)) for lat in lats]
+        wall = time.perf_counter() - start
+    return [summarize(f"service[clients={clients}]", latencies, wall, coalesced=coalesced() - before)]
+
+
+def format_table(rows):
+    cols = [("scenario", "{:<26}"), ("n", "{:>5}"), ("errors", "{:>6}"), ("p50_ms", "{:>9.1f}"),
+            ("p95_ms", "{:>9.1f}"), ("p99_ms", "{:>9.1f}"), ("throughput", "{:>9.2f}"), ("peak_rss_mb", "{:>9.1f}")]
+    header = f"{'scenario':<26}{'n':>5}{'err':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'img/s':>9}{'RSS Mo':>9}"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        line = "".join(fmt.format(row[key]) for key, fmt in cols)
+        extra = {k: v for k, v in row.items() if k not in dict(cols)}
+        if extra:
+            line += "  " + " ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in extra.items())
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def format_stages():
+    """Où part le temps : durée de chaque étape relevée par core/Instrumentation.py, et tokens/s par modèle."""
+    from core.Instrumentation import get_recorder
+    recorder = get_recorder()
+    lines = [f"{'étape':<34}{'n':>7}{'moy ms':>9}{'p50 ms':>9}{'p95 ms':>9}", "-" * 68]
+    for (stage, labels), stat in sorted(recorder.summary().items()):
+        name = stage + (f"[{','.join(v for _, v in labels)}]" if labels else "")
+        lines.append(f"{name:<34}{stat['count']:>7}{stat['mean'] * 1000:>9.1f}{stat['p50'] * 1000:>9.1f}"
+                     f"{stat['p95'] * 1000:>9.1f}")
+    for model, tps in recorder.tokens_per_second().items():
+        lines.append(f"tokens/s {model} : {tps:.1f}")
+    return "\n".join(lines)
+
+
+def spawn_fake_servers(n, args):
+    """
+    n faux serveurs Ollama, chacun dans son propre process (comme plusieurs machines).
+    :return: (liste des process, liste des URL)
+    """
+    import httpx
+
+    procs, hosts = [], []
+    for _ in range(n):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        procs.append(subprocess.Popen(
+            [sys.executable, "-m", "bench.fake_ollama", "--port", str(port), "--latency-ms", str(args.latency_ms),
+             "--jitter-ms", str(args.jitter_ms), "--token-ms", str(args.token_ms), "--fail-rate", str(args.fail_rate)],
+            cwd=SRC_DIR, stdout=subprocess.DEVNULL))
+        hosts.append(f"http://127.0.0.1:{port}")
+
+    deadline = time.monotonic() + 30
+    for host in hosts:
+        while True:
+            try:
+                if httpx.get(f"{host}/api/version", timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Le faux serveur {host} ne démarre pas")
+            time.sleep(0.1)
+    return procs, hosts
+
+
+def run(args):
+    rows = []
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_"))
+    if args.images_dir:
+        images = sorted(Path(args.images_dir).glob("*.jpg"))[:args.images]
+    else:
+        images = make_images(args.images, work_dir / "images")
+
+    scenarios = set(args.scenarios)
+    if "execute" in scenarios:
+        for workers in args.workers:
+            rows += bench_execute(images, args.model, workers, repeat=args.repeat, verbose=args.verbose)
+    if "cache" in scenarios:
+        from core.ResponseCache import ResponseCache
+        cache = ResponseCache(work_dir / "responses.sqlite")
+        # 1er passage : cache vide, 2e passage : tout vient du cache
+        rows += bench_execute(images, args.model, max(args.workers), repeat=2, cache=cache,
+                              verbose=args.verbose, label="execute+cache")
+        cache.close()
+    if "model" in scenarios:
+        rows.append(bench_pipeline_model(images, args.model, verbose=args.verbose))
+    if "stream" in scenarios:
+        rows.append(bench_pipeline_stream(images, args.model, verbose=args.verbose))
+    if "clip" in scenarios:
+        rows += bench_pipeline_clip(sorted(TEST_IMAGES_DIR.glob("*.png")), verbose=args.verbose)
+    if "service" in scenarios:
+        rows += bench_service(images, args.model, max(args.workers), verbose=args.verbose)
+    return rows
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmarks de bout en bout (depuis src/)")
+    parser.add_argument("scenarios", nargs="*", default=None,
+                        help="parmi execute, cache, model, stream, clip, service (par défaut : execute cache model stream)")
+    parser.add_argument("--images", type=int, default=50, help="nombre d'images")
+    parser.add_argument("--images-dir", default=None, help="dossier de .jpg à utiliser au lieu d'images synthétiques")
+    parser.add_argument("--workers", type=lambda s: [int(w) for w in s.split(",")], default=[1, 4],
+                        help="max_workers testés pour execute, ex: 1,4,8")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--model", default="llava")
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="latence du faux Ollama")
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--token-ms", type=float, default=5.0, help="délai par token en streaming")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="proportion de requêtes en erreur 500")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--host", default=None, help="vrai serveur Ollama à utiliser au lieu du faux")
+    parser.add_argument("--endpoints", type=int, default=1,
+                        help="nombre de faux serveurs (un process chacun) derrière un OllamaPool")
+    parser.add_argument("--kill-endpoint-after", type=float, default=None,
+                        help="tue le 1er faux serveur après ce nombre de secondes (éjection / renvoi des requêtes)")
+    parser.add_argument("--retries", type=int, default=None, help="OLLAMA_RETRIES (retry sur erreur transitoire)")
+    parser.add_argument("--timeout", type=float, default=None, help="OLLAMA_TIMEOUT (s) par requête")
+    parser.add_argument("--json", default=None, help="fichier où écrire les résultats")
+    parser.add_argument("--metrics", default=None,
+                        help="préfixe des fichiers de mesures par étape : <préfixe>.jsonl et <préfixe>.prom")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    args.scenarios = args.scenarios or ["execute", "cache", "model", "stream"]
+    known = {"execute", "cache", "model", "stream", "clip", "service"}
+    if set(args.scenarios) - known:
+        parser.error(f"scénario inconnu : {', '.join(sorted(set(args.scenarios) - known))}")
+
+    server = None
+    procs = []
+    if args.host is None and args.endpoints > 1:
+        procs, hosts = spawn_fake_servers(args.endpoints, args)
+        host = hosts[0]
+        # Model passe alors par un OllamaPool (cf core/OllamaPool.get_default_client)
+        os.environ["OLLAMA_HOSTS"] = ",".join(hosts)
+        if args.kill_endpoint_after is not None:
+            threading.Timer(args.kill_endpoint_after, procs[0].kill).start()
+    elif args.host is None:
+        from bench.fake_ollama import FakeOllamaServer
+        server = FakeOllamaServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, token_ms=args.token_ms,
+                                  fail_rate=args.fail_rate, seed=args.seed).start()
+        host = server.url
+    else:
+        host = args.host
+    os.environ["OLLAMA_HOST"] = host
+    if args.retries is not None:
+        os.environ["OLLAMA_RETRIES"] = str(args.retries)
+    if args.timeout is not None:
+        os.environ["OLLAMA_TIMEOUT"] = str(args.timeout)
+    print(f"Ollama : {os.environ.get('OLLAMA_HOSTS') or host}" + (" (faux serveur)" if args.host is None else ""))
+
+    try:
+        rows = run(args)
+    finally:
+        if server is not None:
+            stats = server.stats()
+            server.stop()
+        for proc in procs:
+            proc.kill()
+    print(format_table(rows))
+    print(format_stages())
+    if server is not None:
+        print(f"faux Ollama : {stats['requests']} requêtes, {stats['failures']} erreurs injectées, "
+              f"{stats['max_in_flight']} en parallèle au maximum")
+    from core.Instrumentation import get_recorder
+    from core.OllamaPool import get_default_client
+    client = get_default_client()
+    client_stats = client.stats()
+    retries = sum(v for (name, _), v in get_recorder().counters.items() if name == "ollama_retries_total")
+    print(f"client : {retries} retry, circuit {client_stats['circuit']}")
+    for endpoint in client_stats.get("endpoints", []):
+        print(f"endpoint {endpoint['host']} : {endpoint['requests']} requêtes, {endpoint['failures']} erreurs"
+              + (" (éjecté)" if endpoint['ejected'] else ""))
+    client.close()
+
+    if args.metrics:
+        from core.Instrumentation import get_recorder
+        recorder = get_recorder()
+        print(f"Mesures : {recorder.export_jsonl(args.metrics + '.jsonl')}, "
+              f"{recorder.write_prometheus(args.metrics + '.prom')}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items()}, "results": rows,
+                       "fake_ollama": stats if server is not None else None}, f, indent=2)
+    return rows
@@ -0,0 +1,262 @@
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+
+DEFAULT_STORE_DIR = Path(__file__).resolve().parent.parent / "data" / "cache" / "captions"
+
+_WHITESPACE = " \t\n\r"
+
+
+class _JsonStream:
+    """
+    Lecture d'un gros fichier json par morceaux : on ne garde en mémoire que la valeur en cours de lecture.
+    """
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # on jette ce qui a déjà été lu
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Fin de fichier json inattendue")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"json invalide : '{char}' attendu à la position {self.pos}, trouvé '{self.buf[self.pos]}'")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # un nombre coupé en fin de morceau se décode quand même ("12" au lieu de "123", "1" au lieu de
+            # "1.5e3") : on relit avec le morceau suivant
+            cut = end == len(self.buf) or (isinstance(value, (int, float)) and self.buf[end] in ".eE")
+            if cut and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        """Éléments du tableau qui commence ici, un par un."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+
+def iter_json_array(path, key):
+    """
+    Générateur sur les éléments du tableau `key` de l'objet racine d'un fichier json
+    (ex: les 'annotations' d'un fichier COCO) sans charger le fichier entier.
+    Les autres tableaux de la racine ('images', 'licenses'...) sont parcourus élément par élément et jetés.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        stream = _JsonStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            name = stream.value()
+            stream.expect(":")
+            if name == key:
+                yield from stream.items()
+                return
+            if stream.peek() == "[":
+                for _ in stream.items():
+                    pass
+            else:
+                stream.value()
+            if stream.peek() == "}":
+                return
+            stream.expect(",")
+
+
+class CaptionStore(Mapping):
+    """
+    Légendes de référence COCO dans une base SQLite indexée par image_id (remplace captions_map.pkl).
+        - construite une fois en lisant le json des annotations en streaming (pas de json.load du fichier entier)
+        - les légendes ne sont lues qu'à la demande : get(img_id) ou get_many(img_ids) pour un lot
+        - se comporte comme un dictionnaire {img_id: [légendes]} en lecture, donc utilisable tel quel
+          comme coco_captions de Model ou comme références de Scorer
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise FileNotFoundError(f"Base de légendes introuvable : {self.path}")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        self._len = None
+
+    @classmethod
+    def build(cls, json_path, path, batch_size=10_000):
+        """
+        Lit les annotations du json en streaming et écrit la base (dans un fichier temporaire, puis renommé).
+        """
+        print(f"Construction de la base de légendes depuis {json_path}...")
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        if tmp.exists():
+            tmp.unlink()
+
+        conn = sqlite3.connect(str(tmp))
+        try:
+            conn.execute("CREATE TABLE captions (image_id INTEGER NOT NULL, caption TEXT NOT NULL)")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            batch = []
+            count = 0
+            for ann in iter_json_array(json_path, "annotations"):
+                batch.append((ann["image_id"], ann["caption"]))
+                if len(batch) >= batch_size:
+                    conn.executemany("INSERT INTO captions VALUES (?, ?)", batch)
+                    count += len(batch)
+                    batch = []
+            conn.executemany("INSERT INTO captions VALUES (?, ?)", batch)
+            count += len(batch)
+            # index créé après l'insertion, c'est beaucoup plus rapide
+            conn.execute("CREATE INDEX idx_image_id ON captions(image_id)")
+
+            stat = os.stat(json_path)
+            meta = {"source": str(os.path.abspath(json_path)), "size": str(stat.st_size),
+                    "mtime": str(stat.st_mtime), "captions": str(count)}
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp, path)
+        print(f"{count} légendes indexées dans {path}")
+        return cls(path)
+
+    @classmethod
+    def from_json(cls, json_path, store_dir=DEFAULT_STORE_DIR):
+        """
+        Ouvre la base construite à partir de json_path (une par fichier, dans store_dir),
+        et la (re)construit si elle n'existe pas ou si le json a changé.
+        """
+        path = Path(store_dir) / f"{Path(json_path).stem}.sqlite"
+        if path.exists():
+            store = cls(path)
+            stat = os.stat(json_path)
+            meta = store.meta()
+            if meta.get("size") == str(stat.st_size) and meta.get("mtime") == str(stat.st_mtime):
+                return store
+            store.close()
+        return cls.build(json_path, path)
+
+    def meta(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+
+    def get(self, img_id, default=None):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT caption FROM captions WHERE image_id = ? ORDER BY rowid", (img_id,)
+            ).fetchall()
+        if not rows:
+            return default
+        return [r[0] for r in rows]
+
+    def get_many(self, img_ids, chunk_size=500):
+        """
+        Légendes d'un lot d'images en quelques requêtes : {img_id: [légendes]} (les ids inconnus sont absents).
+        """
+        img_ids = list(dict.fromkeys(img_ids))
+        found = {}
+        with self.lock:
+            for start in range(0, len(img_ids), chunk_size):
+                chunk = img_ids[start:start + chunk_size]
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT image_id, caption FROM captions WHERE image_id IN ({marks}) ORDER BY rowid", chunk
+                )
+                for img_id, caption in rows:
+                    found.setdefault(img_id, []).append(caption)
+        # dans l'ordre demandé
+        return {i: found[i] for i in img_ids if i in found}
+
+    def __getitem__(self, img_id):
+        captions = self.get(img_id)
+        if captions is None:
+            raise KeyError(img_id)
+        return captions
+
+    def __contains__(self, img_id):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM captions WHERE image_id = ? LIMIT 1", (img_id,)).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        with self.lock:
+            ids = [r[0] for r in self.conn.execute("SELECT DISTINCT image_id FROM captions ORDER BY image_id")]
+        return iter(ids)
+
+    def __len__(self):
+        if self._len is None:
+            with self.lock:
+                self._len = self.conn.execute("SELECT COUNT(DISTINCT image_id) FROM captions").fetchone()[0]
+        return self._len
+
+    def items(self, batch_size=5_000):
+        """Parcours de toutes les légendes, par lots d'images, sans tout charger d'un coup."""
+        last = None
+        while True:
+            with self.lock:
+                if last is None:
+                    rows = self.conn.execute(
+                        "SELECT DISTINCT image_id FROM captions ORDER BY image_id LIMIT ?", (batch_size,))
+                else:
+                    rows = self.conn.execute(
+                        "SELECT DISTINCT image_id FROM captions WHERE image_id > ? ORDER BY image_id LIMIT ?",
+                        (last, batch_size))
+                ids = [r[0] for r in rows]
+            if not ids:
+                return
+            yield from self.get_many(ids).items()
+            last = ids[-1]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    store = CaptionStore.from_json(os.getenv("DATASET_PATH", "") + "annotations/captions_val2017.json")
+    print(f"{len(store)} images dans {store.path}")
@@ -0,0 +1,308 @@
+"""
+    Backends CPU pour les encodeurs image et texte de CLIP (CLIP_BACKEND dans le .env) :
+        - torch   : PyTorch FP32 eager (référence, et seul backend utilisé sur GPU)
+        - int8    : quantification dynamique int8 des couches Linear (torch.ao.quantization.quantize_dynamic)
+        - onnx    : export ONNX des deux tours (fait une fois, data/cache/clip_onnx/) exécuté par ONNX Runtime
+        - compile : torch.compile des deux tours
+    CLIP_THREADS fixe le nombre de threads (torch.set_num_threads, intra_op_num_threads d'ONNX Runtime).
+    Garde-fou : un backend autre que torch n'est utilisé que s'il donne le même top-1 que FP32 sur la recherche
+    texte -> image des images de data/test et des embeddings proches (cosinus) ; sinon on revient à FP32.
+    Le verdict est gardé dans data/cache/clip_backend_guard.json.
+    Benchmark (depuis src/) : python -m core.ClipBackend --backends torch,int8,onnx,compile --threads 4
+"""
+
+import argparse
+import inspect
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+load_dotenv()
+
+BACKENDS = ("torch", "int8", "onnx", "compile")
+CACHE_DIR = Path(__file__).resolve().parent.parent / "data" / "cache"
+TEST_IMAGES_DIR = Path(__file__).resolve().parent.parent / "data" / "test"
+GUARD_QUESTIONS = ["a dog on a couch", "a plate of food", "a bathroom sink", "two dogs playing", "a garage door",
+                   "a dog", "food on a table", "a white sink and a mirror"]
+# seuils du garde-fou : accord du top-1 avec FP32 et cosinus minimal entre embeddings
+MIN_TOP1_AGREEMENT = 1.0
+MIN_COSINE = 0.98
+
+
+def clip_threads():
+    threads = os.getenv("CLIP_THREADS", "")
+    return int(threads) if threads.strip() else None
+
+
+def _towers(model):
+    """Modules (image, texte) qui renvoient directement les embeddings normalisés L2."""
+    import torch
+
+    class ImageTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, pixel_values):
+            feats = self.clip.get_image_features(pixel_values=pixel_values)
+            return feats / feats.norm(dim=-1, keepdim=True)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, input_ids, attention_mask):
+            feats = self.clip.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+            return feats / feats.norm(dim=-1, keepdim=True)
+
+    return ImageTower(model).eval(), TextTower(model).eval()
+
+
+class TorchEncoder:
+    """Encodeur PyTorch : image(pixel_values) et text(input_ids, attention_mask) -> np.ndarray [n, D] normalisé."""
+
+    name = "torch"
+
+    def __init__(self, model, device="cpu"):
+        self.device = device
+        self.dim = model.config.projection_dim
+        self.image_tower, self.text_tower = _towers(model)
+
+    def image(self, pixel_values):
+        import torch
+        with torch.inference_mode():
+            return self.image_tower(torch.as_tensor(pixel_values).to(self.device)).cpu().numpy()
+
+    def text(self, input_ids, attention_mask):
+        import torch
+        with torch.inference_mode():
+            return self.text_tower(torch.as_tensor(input_ids).to(self.device),
+                                   torch.as_tensor(attention_mask).to(self.device)).cpu().numpy()
+
+
+class Int8Encoder(TorchEncoder):
+    name = "int8"
+
+    def __init__(self, model, device="cpu"):
+        import torch
+        # copie quantifiée : le modèle FP32 reste intact (référence du garde-fou)
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        super().__init__(quantized, "cpu")
+
+
+class CompiledEncoder(TorchEncoder):
+    name = "compile"
+
+    def __init__(self, model, device="cpu"):
+        import torch
+        super().__init__(model, device)
+        # dynamic=True : une seule compilation quelle que soit la taille des lots
+        self.image_tower = torch.compile(self.image_tower, dynamic=True)
+        self.text_tower = torch.compile(self.text_tower, dynamic=True)
+
+
+class OnnxEncoder:
+    name = "onnx"
+
+    def __init__(self, model, device="cpu", model_name="clip", threads=None):
+        import onnxruntime as ort
+
+        self.dim = model.config.projection_dim
+        export_dir = CACHE_DIR / "clip_onnx" / model_name.replace("/", "__")
+        image_path, text_path = export_dir / "image.onnx", export_dir / "text.onnx"
+        if not (image_path.exists() and text_path.exists()):
+            self.export(model, export_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        providers = ["CPUExecutionProvider"]
+        self.image_session = ort.InferenceSession(str(image_path), options, providers=providers)
+        self.text_session = ort.InferenceSession(str(text_path), options, providers=providers)
+
+    @staticmethod
+    def export(model, export_dir):
+        """Exporte les deux tours en ONNX (batch et longueur de texte dynamiques)."""
+        import torch
+
+        export_dir.mkdir(parents=True, exist_ok=True)
+        image_tower, text_tower = _towers(model)
+        size = model.config.vision_config.image_size
+        kwargs = {"opset_version": 17}
+        # exporteur TorchScript : pas besoin du paquet onnx
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        print(f"Export ONNX de CLIP dans {export_dir}...")
+        with torch.inference_mode():
+            tmp = export_dir / "image.tmp.onnx"
+            torch.onnx.export(image_tower, (torch.zeros(1, 3, size, size),), str(tmp),
+                              input_names=["pixel_values"], output_names=["embeddings"],
+                              dynamic_axes={"pixel_values": {0: "batch"}, "embeddings": {0: "batch"}}, **kwargs)
+            os.replace(tmp, export_dir / "image.onnx")
+            ids = torch.ones(1, 8, dtype=torch.long)
+            tmp = export_dir / "text.tmp.onnx"
+            torch.onnx.export(text_tower, (ids, torch.ones_like(ids)), str(tmp),
+                              input_names=["input_ids", "attention_mask"], output_names=["embeddings"],
+                              dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                            "attention_mask": {0: "batch", 1: "sequence"},
+                                            "embeddings": {0: "batch"}}, **kwargs)
+            os.replace(tmp, export_dir / "text.onnx")
+
+    def image(self, pixel_values):
+        pixel_values = np.asarray(pixel_values, dtype=np.float32)
+        return self.image_session.run(None, {"pixel_values": pixel_values})[0]
+
+    def text(self, input_ids, attention_mask):
+        return self.text_session.run(None, {"input_ids": np.asarray(input_ids, dtype=np.int64),
+                                            "attention_mask": np.asarray(attention_mask, dtype=np.int64)})[0]
+
+
+ENCODERS = {"torch": TorchEncoder, "int8": Int8Encoder, "compile": CompiledEncoder, "onnx": OnnxEncoder}
+
+
+def make_encoder(backend, model, device="cpu", model_name="clip", threads=None):
+    if backend not in ENCODERS:
+        raise ValueError(f"CLIP_BACKEND inconnu : {backend} (parmi {', '.join(BACKENDS)})")
+    if backend == "onnx":
+        return OnnxEncoder(model, device, model_name=model_name, threads=threads)
+    return ENCODERS[backend](model, device)
+
+
+# --- garde-fou ---------------------------------------------------------------------------------------------------
+
+def _test_inputs(processor, images_dir=TEST_IMAGES_DIR, questions=GUARD_QUESTIONS):
+    paths = sorted(Path(images_dir).glob("*.png"))
+    images = []
+    for path in paths:
+        with Image.open(path) as img:
+            images.append(img.convert("RGB"))
+    pixels = processor(images=images, return_tensors="np")["pixel_values"]
+    tokens = processor(text=questions, return_tensors="np", padding=True, truncation=True)
+    return paths, pixels, tokens
+
+
+def agreement(encoder, reference, processor, images_dir=TEST_IMAGES_DIR, questions=GUARD_QUESTIONS):
+    """
+    Compare un encodeur à la référence FP32 sur les images de test :
+        top1 : part des questions pour lesquelles la meilleure image est la même qu'en FP32
+        min_cosine : plus petit cosinus entre les embeddings (images et textes) des deux encodeurs
+    """
+    _, pixels, tokens = _test_inputs(processor, images_dir, questions)
+    ref_img, ref_txt = reference.image(pixels), reference.text(tokens["input_ids"], tokens["attention_mask"])
+    img, txt = encoder.image(pixels), encoder.text(tokens["input_ids"], tokens["attention_mask"])
+    top1 = float(np.mean((ref_txt @ ref_img.T).argmax(axis=1) == (txt @ img.T).argmax(axis=1)))
+    cosines = np.concatenate([(ref_img * img).sum(axis=1), (ref_txt * txt).sum(axis=1)])
+    return {"top1": top1, "min_cosine": float(cosines.min()), "mean_cosine": float(cosines.mean())}
+
+
+def passes(result):
+    return result["top1"] >= MIN_TOP1_AGREEMENT and result["min_cosine"] >= MIN_COSINE
+
+
+def _guard_key(backend, model_name):
+    import torch
+    key = f"{backend}|{model_name}|torch {torch.__version__}"
+    if backend == "onnx":
+        import onnxruntime
+        key += f"|ort {onnxruntime.__version__}"
+    return key
+
+
+def guarded_encoder(backend, model, processor, device="cpu", model_name="clip", threads=None):
+    """
+    Encodeur du backend demandé s'il passe le garde-fou (verdict mis en cache), sinon l'encodeur FP32.
+    Un backend qui ne peut pas être construit (onnxruntime absent...) retombe aussi sur FP32.
+    """
+    reference = TorchEncoder(model, device)
+    if backend == "torch" or device != "cpu":
+        return reference
+    try:
+        encoder = make_encoder(backend, model, device, model_name, threads)
+    except Exception as e:
+        print(f"Backend CLIP {backend} indisponible ({type(e).__name__}: {e}), on reste en FP32")
+        return reference
+
+    guard_path = CACHE_DIR / "clip_backend_guard.json"
+    verdicts = json.loads(guard_path.read_text(encoding="utf-8")) if guard_path.exists() else {}
+    key = _guard_key(backend, model_name)
+    if key not in verdicts:
+        result = agreement(encoder, reference, processor)
+        verdicts[key] = {**result, "ok": passes(result)}
+        guard_path.parent.mkdir(parents=True, exist_ok=True)
+        guard_path.write_text(json.dumps(verdicts, indent=1), encoding="utf-8")
+    verdict = verdicts[key]
+    if not verdict["ok"]:
+        print(f"Backend CLIP {backend} écarté : top-1 {verdict['top1']:.0%} et cosinus min "
+              f"{verdict['min_cosine']:.3f} par rapport à FP32, on reste en FP32")
+        return reference
+    return encoder
+
+
+# --- benchmark ---------------------------------------------------------------------------------------------------
+
+def benchmark(backends=BACKENDS, threads=None, batch_size=16, repeat=5, model_name="openai/clip-vit-base-patch32"):
+    """
+    Images/s et textes/s de chaque backend sur les images de test (répétées pour remplir les lots), et accord
+    avec FP32. La 1re passe (compilation, export, chargement) est mesurée à part.
+    """
+    import torch
+    from transformers import CLIPModel, CLIPProcessor
+
+    if threads:
+        torch.set_num_threads(threads)
+    model = CLIPModel.from_pretrained(model_name).eval()
+    processor = CLIPProcessor.from_pretrained(model_name)
+    reference = TorchEncoder(model)
+    _, pixels, tokens = _test_inputs(processor)
+    pixels = np.resize(pixels, (batch_size,) + pixels.shape[1:])
+
+    rows = []
+    for backend in backends:
+        try:
+            t = time.perf_counter()
+            encoder = make_encoder(backend, model, model_name=model_name, threads=threads)
+            encoder.image(pixels)
+            encoder.text(tokens["input_ids"], tokens["attention_mask"])
+            cold = time.perf_counter() - t
+        except Exception as e:
+            print(f"{backend:<8} indisponible : {type(e).__name__}: {e}")
+            continue
+        t = time.perf_counter()
+        for _ in range(repeat):
+            encoder.image(pixels)
+        images_per_s = repeat * len(pixels) / (time.perf_counter() - t)
+        t = time.perf_counter()
+        for _ in range(repeat):
+            encoder.text(tokens["input_ids"], tokens["attention_mask"])
+        texts_per_s = repeat * len(tokens["input_ids"]) / (time.perf_counter() - t)
+        rows.append({"backend": backend, "cold_s": cold, "images_per_s": images_per_s, "texts_per_s": texts_per_s,
+                     **agreement(encoder, reference, processor)})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark et garde-fou des backends CPU de CLIP")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--threads", type=int, default=clip_threads())
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rows = benchmark([b.strip() for b in args.backends.split(",") if b.strip()], args.threads, args.batch_size,
+                     args.repeat)
+    print(f"{'backend':<9}{'1re passe s':>12}{'images/s':>10}{'textes/s':>10}{'top-1':>8}{'cos min':>9}  garde-fou")
+    for row in rows:
+        print(f"{row['backend']:<9}{row['cold_s']:>12.2f}{row['images_per_s']:>10.1f}{row['texts_per_s']:>10.1f}"
+              f"{row['top1']:>8.0%}{row['min_cosine']:>9.4f}  {'ok' if passes(row) else 'ÉCARTÉ'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_INDEX_DIR = Path(__file__).resolve().parent.parent / "data" / "cache" / "clip_index"
+
+
+class ClipIndex:
+    """
+    Index persistant des embeddings d'images CLIP (normalisés L2).
+        - embeddings.f32 : matrice float32 [N, D] brute, ouverte en memory-map. Les nouvelles lignes sont ajoutées
+          à la fin du fichier : ajouter une image n'écrit que sa ligne, sans relire ni réécrire la matrice
+        - manifest.json  : chemin -> (hash du contenu, mtime, taille), hash de chaque ligne et dimension D
+    Une image n'est encodée qu'une fois par contenu : un fichier renommé ou en double réutilise la même ligne.
+    Les lignes des images supprimées restent dans le fichier (ignorées, et réutilisées si l'image revient) ;
+    le fichier n'est compacté que quand elles dépassent COMPACT_RATIO des lignes.
+    Une requête n'encode alors que le texte et fait un produit scalaire vectorisé.
+    """
+
+    COMPACT_RATIO = 0.5
+    # lignes copiées à la fois pendant le compactage
+    COMPACT_CHUNK = 4096
+
+    def __init__(self, encode_images, index_dir=DEFAULT_INDEX_DIR, model_name="openai/clip-vit-base-patch32"):
+        """
+        :param encode_images: fonction (liste de chemins) -> np.ndarray [n, D] d'embeddings normalisés
+        :param index_dir: dossier où sont stockés embeddings.f32 et manifest.json
+        :param model_name: nom du modèle CLIP, l'index est invalidé s'il change
+        """
+        self.encode_images = encode_images
+        self.index_dir = Path(index_dir)
+        self.model_name = model_name
+        self.emb_path = self.index_dir / "embeddings.f32"
+        self.manifest_path = self.index_dir / "manifest.json"
+        self.lock = threading.Lock()
+
+        self.files = {}   # chemin -> {"hash", "mtime", "size"}
+        self.hashes = []  # ligne i de la matrice = embedding de hashes[i]
+        self.row_of = {}  # hash -> ligne
+        self.dim = None
+        self.embeddings = None
+        # incrémenté à chaque écriture, permet aux moteurs de recherche construits dessus de savoir s'ils sont périmés
+        self.version = 0
+        self._load()
+
+    def _load(self):
+        if not (self.manifest_path.exists() and self.emb_path.exists()):
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("model") != self.model_name:
+            print("Index CLIP créé avec un autre modèle, on le reconstruit.")
+            return
+        hashes, dim = manifest["hashes"], manifest["dim"]
+        # des octets en trop = lignes d'un ajout interrompu avant le manifest, écrasées au prochain ajout
+        if self.emb_path.stat().st_size < len(hashes) * dim * 4:
+            print("Index CLIP incohérent, on le reconstruit.")
+            return
+        self.files = manifest["files"]
+        self.hashes = hashes
+        self.row_of = {h: i for i, h in enumerate(hashes)}
+        self.dim = dim
+        self._map()
+
+    def _map(self):
+        if not self.hashes:
+            self.embeddings = np.zeros((0, self.dim or 0), dtype=np.float32)
+            return
+        self.embeddings = np.memmap(self.emb_path, dtype=np.float32, mode="r", shape=(len(self.hashes), self.dim))
+
+    def _save_manifest(self):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_manifest = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_manifest, "w", encoding="utf-8") as f:
+            json.dump({"model": self.model_name, "dim": self.dim, "files": self.files, "hashes": self.hashes}, f)
+        os.replace(tmp_manifest, self.manifest_path)
+        self.version += 1
+
+    def _append(self, hashes, embeddings):
+        """Ajoute des lignes à la fin du fichier (les lignes existantes ne sont ni relues ni réécrites)."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        # on lâche le memory-map avant d'écrire dans le fichier (obligatoire sous Windows)
+        self.embeddings = None
+        with open(self.emb_path, "r+b" if self.emb_path.exists() else "wb") as f:
+            f.seek(len(self.hashes) * self.dim * 4)
+            f.truncate()
+            f.write(embeddings.tobytes())
+        for h in hashes:
+            self.row_of[h] = len(self.hashes)
+            self.hashes.append(h)
+
+    def _compact(self, keep):
+        """Réécrit le fichier avec seulement les lignes keep, par morceaux (la matrice n'est jamais chargée en entier)."""
+        tmp_emb = self.emb_path.with_suffix(".tmp")
+        with open(tmp_emb, "wb") as f:
+            for start in range(0, len(keep), self.COMPACT_CHUNK):
+                f.write(np.ascontiguousarray(self.embeddings[keep[start:start + self.COMPACT_CHUNK]]).tobytes())
+        self.embeddings = None
+        os.replace(tmp_emb, self.emb_path)
+        self.hashes = [self.hashes[i] for i in keep]
+        self.row_of = {h: i for i, h in enumerate(self.hashes)}
+
+    @staticmethod
+    def _hash_file(path):
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def update(self, paths):
+        """
+        Met à jour l'index de façon incrémentale : les fichiers nouveaux ou modifiés sont encodés et ajoutés
+        à la fin de la matrice, les fichiers qui n'existent plus sur le disque sont retirés du manifest.
+        """
+        with self.lock:
+            # entrées du manifest appliquées seulement une fois les embeddings écrits : si l'encodage échoue,
+            # l'index reste tel qu'il était (et le fichier sera réencodé au prochain appel)
+            pending = {}
+            to_encode = {}
+
+            for path in map(os.path.abspath, map(str, paths)):
+                stat = os.stat(path)
+                entry = self.files.get(path)
+                if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                    continue
+                # nouveau fichier ou fichier modifié : on recalcule le hash du contenu
+                file_hash = self._hash_file(path)
+                pending[path] = {"hash": file_hash, "mtime": stat.st_mtime, "size": stat.st_size}
+                if file_hash not in self.row_of and file_hash not in to_encode:
+                    to_encode[file_hash] = path
+
+            if to_encode:
+                print(f"Index CLIP : {len(to_encode)} image(s) à encoder")
+                try:
+                    self._append(list(to_encode), self.encode_images(list(to_encode.values())))
+                finally:
+                    if self.embeddings is None:
+                        self._map()
+
+            self.files.update(pending)
+            removed = [p for p in self.files if not os.path.exists(p)]
+            for p in removed:
+                del self.files[p]
+            changed = bool(pending or removed)
+
+            if changed:
+                used = {e["hash"] for e in self.files.values()}
+                if len(self.hashes) - len(used) > self.COMPACT_RATIO * len(self.hashes):
+                    self._compact([i for i, h in enumerate(self.hashes) if h in used])
+                    self._map()
+                self._save_manifest()
+
+    def get(self, paths):
+        """
+        Renvoie la matrice [len(paths), D] des embeddings (dans l'ordre de paths).
+        Les chemins doivent déjà être dans l'index (cf update).
+        """
+        with self.lock:
+            rows = [self.row_of[self.files[os.path.abspath(str(p))]["hash"]] for p in paths]
+            return np.asarray(self.embeddings[rows])
+
+    def similarities(self, text_embedding, paths):
+        """
+        Similarité cosinus entre un embedding texte normalisé [D] et chaque image de paths (mise à jour comprise).
+        """
+        self.update(paths)
+        return self.get(paths) @ np.asarray(text_embedding, dtype=np.float32)
+
+    def __len__(self):
+        return len({e["hash"] for e in self.files.values()})
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from core.Instrumentation import get_recorder
+from core.Model import Model, ModelResponses, gt_captions, images_ids
+from core.OllamaPool import get_default_client
+from core.preprocess import model_target, prepare_bytes
+
+
+class GridExecutor:
+    """
+    Exécute une grille modèles × prompts × images (ce que font les boucles de main.ipynb et main_compare.ipynb) :
+        - chaque image est lue une seule fois et encodée une fois par taille cible (les modèles qui ont la même
+          cible partagent les octets, gardés en mémoire pendant toute la grille)
+        - les cellules sont groupées par modèle pour ne charger chaque modèle qu'une fois : on commence par un
+          modèle déjà chargé dans Ollama (ps), on le précharge explicitement (warm-up) avec keep_alive, puis on le
+          décharge (keep_alive=0) avant de passer au suivant pour libérer la mémoire
+        - les cellules déjà terminées (dans results_path) sont sautées ; dans une cellule interrompue, les images
+          déjà traitées reviennent du ResponseCache
+        - une image illisible ou impossible à encoder est sortie du lot et comptée dans "failed" de ses cellules
+    Le résultat est un dict {(modèle, prompt_id): cellule}, chaque cellule ayant "responses" et "gt_captions"
+    à passer à Scorer.compute_scores (cf score()).
+    """
+
+    def __init__(self, models, prompts, imgs_path, coco_captions, max_workers=1, options=None, cache=None,
+                 preprocess=True, keep_alive="10m", unload=True, results_path=None, client=None, recorder=None):
+        """
+        :param keep_alive: durée pendant laquelle Ollama garde le modèle chargé entre deux requêtes
+        :param unload: décharge chaque modèle quand ses cellules sont finies
+        :param results_path: fichier JSON des cellules terminées (None = pas de reprise)
+        """
+        self.models = [m for m in models if m]
+        self.prompts = prompts
+        self.imgs_path = list(imgs_path)
+        self.coco_captions = coco_captions
+        self.max_workers = max_workers
+        self.options = options
+        self.cache = cache
+        self.preprocess = preprocess
+        self.keep_alive = keep_alive
+        self.unload = unload
+        self.results_path = Path(results_path) if results_path else None
+        self.client = client or get_default_client()
+        self.recorder = recorder or get_recorder()
+        # {img_path: (octets, sha256)} et {cible: {img_path: (octets, hash pour le cache)}}
+        self._raw = {}
+        self._encoded = {}
+        # images illisibles ou impossibles à encoder : {cible: {img_path: erreur}}
+        self._errors = {}
+
+    # --- images ------------------------------------------------------------------------------------------
+
+    def _read(self, img_path):
+        try:
+            with open(img_path, "rb") as f:
+                data = f.read()
+        except Exception as e:
+            return img_path, e
+        return img_path, (data, hashlib.sha256(data).hexdigest())
+
+    def _encode(self, img_path, model_name):
+        raw = self._raw[img_path]
+        if isinstance(raw, Exception) or not self.preprocess:
+            return img_path, raw
+        data, content_hash = raw
+        try:
+            img_bytes, content_hash, target = prepare_bytes(data, model_name, content_hash)
+        except Exception as e:
+            return img_path, e
+        return img_path, (img_bytes, f"{content_hash}:{target}")
+
+    def images_for(self, model_name):
+        """Images encodées pour ce modèle, calculées une seule fois par taille cible."""
+        target = model_target(model_name) if self.preprocess else None
+        if target not in self._encoded:
+            workers = max(1, min(8, os.cpu_count() or 1))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                if not self._raw:
+                    with self.recorder.timer("grid_read"):
+                        self._raw = dict(pool.map(self._read, self.imgs_path))
+                with self.recorder.timer("grid_encode", target=str(target)):
+                    encoded = dict(pool.map(lambda p: self._encode(p, model_name), self.imgs_path))
+            # une image en erreur est sortie du lot (et comptée en échec dans la cellule) sans arrêter la grille
+            self._errors[target] = {p: f"{type(e).__name__}: {e}" for p, e in encoded.items()
+                                    if isinstance(e, Exception)}
+            self._encoded[target] = {p: v for p, v in encoded.items() if p not in self._errors[target]}
+            for p, error in self._errors[target].items():
+                print(f"Erreur sur l'image {p}: {error}")
+            # toutes les cibles de la grille sont encodées : les fichiers d'origine ne servent plus
+            if self.preprocess and {model_target(m) for m in self.models} <= set(self._encoded):
+                self._raw = {}
+        return self._encoded[target]
+
+    def failed_for(self, model_name):
+        """{img_path: erreur} des images qui n'ont pas pu être lues ou encodées pour ce modèle."""
+        target = model_target(model_name) if self.preprocess else None
+        return self._errors.get(target, {})
+
+    # --- ordonnancement ----------------------------------------------------------------------------------
+
+    def _loaded_models(self):
+        try:
+            return {m['model'] for m in self.client.ps()['models']}
+        except Exception:
+            return set()
+
+    def schedule(self, done=()):
+        """Ordre des modèles : ceux déjà chargés dans Ollama d'abord, ceux qui n'ont plus rien à faire retirés."""
+        loaded = self._loaded_models()
+        todo = [m for m in self.models
+                if any((m, i) not in done for i in range(len(self.prompts)))]
+        return sorted(todo, key=lambda m: not ({m, f"{m}:latest"} & loaded))
+
+    def warm_up(self, model_name):
+        """Charge le modèle (requête sans message) pour que la 1re image ne paie pas le chargement."""
+        with self.recorder.timer("model_load", model=model_name):
+            self.client.chat(model=model_name, messages=[], keep_alive=self.keep_alive)
+
+    def release(self, model_name):
+        try:
+            self.client.chat(model=model_name, messages=[], keep_alive=0)
+        except Exception as e:
+            print(f"Impossible de décharger {model_name}: {e}")
+
+    # --- reprise -----------------------------------------------------------------------------------------
+
+    def load_results(self):
+        """Cellules terminées lors d'un précédent run (même modèle et même texte de prompt)."""
+        if self.results_path is None or not self.results_path.exists():
+            return {}
+        with open(self.results_path, encoding="utf-8") as f:
+            saved = json.load(f)
+        ids = {str(i): i for i in images_ids(self.imgs_path)}
+        results = {}
+        for cell in saved:
+            if cell["model"] not in self.models or cell["prompt"] not in self.prompts:
+                continue
+            # une cellule faite sur un autre jeu d'images est refaite
+            if set(cell["responses"]) | set(cell["failed"]) != set(ids):
+                continue
+            responses = ModelResponses({ids[k]: v for k, v in cell["responses"].items()})
+            responses.failed = {ids[k]: v for k, v in cell["failed"].items()}
+            prompt_id = self.prompts.index(cell["prompt"])
+            results[(cell["model"], prompt_id)] = {
+                "model": cell["model"], "prompt_id": prompt_id, "prompt": cell["prompt"],
+                "responses": responses, "gt_captions": gt_captions(self.coco_captions, responses),
+                "failed": responses.failed, "duration": cell["duration"],
+            }
+        return results
+
+    def save_results(self, results):
+        if self.results_path is None:
+            return
+        cells = [{"model": c["model"], "prompt": c["prompt"], "duration": c["duration"],
+                  "responses": {str(k): v for k, v in c["responses"].items()},
+                  "failed": {str(k): v for k, v in c["failed"].items()}}
+                 for c in results.values()]
+        self.results_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.results_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cells, f, ensure_ascii=False)
+        os.replace(tmp, self.results_path)
+
+    # --- exécution ---------------------------------------------------------------------------------------
+
+    def run(self, freq_print=0, retry_failed=False):
+        """
+        Exécute les cellules manquantes et renvoie toutes les cellules de la grille.
+        retry_failed (default False) : refait aussi les cellules terminées où des images ont échoué.
+        """
+        results = self.load_results()
+        done = {key for key, cell in results.items() if not (retry_failed and cell["failed"])}
+        if done:
+            print(f"--- {len(done)} cellule(s) déjà faite(s), sautée(s) ---")
+
+        for model_name in self.schedule(done):
+            images = self.images_for(model_name)
+            errors = self.failed_for(model_name)
+            model = Model(model_name=model_name, prompts=self.prompts,
+                          imgs_path=[p for p in self.imgs_path if p not in errors],
+                          coco_captions=self.coco_captions, max_workers=self.max_workers, options=self.options,
+                          cache=self.cache, preprocess=self.preprocess, recorder=self.recorder, client=self.client,
+                          images=images, keep_alive=self.keep_alive)
+            print(f"--- Modèle {model_name} ---")
+            try:
+                self.warm_up(model_name)
+            except Exception as e:
+                print(f"Warm-up de {model_name} impossible : {e}")
+
+            for prompt_id, prompt in enumerate(self.prompts):
+                if (model_name, prompt_id) in done:
+                    continue
+                start = time.perf_counter()
+                responses, gts = model.execute(prompt_id=prompt_id, freq_print=freq_print)
+                responses.failed.update(zip(images_ids(errors), errors.values()))
+                results[(model_name, prompt_id)] = {
+                    "model": model_name, "prompt_id": prompt_id, "prompt": prompt,
+                    "responses": responses, "gt_captions": gts, "failed": responses.failed,
+                    "duration": time.perf_counter() - start,
+                }
+                self.save_results(results)
+
+            if self.unload:
+                self.release(model_name)
+        return results
+
+    def score(self, scorer, results=None):
+        """{(modèle, prompt_id): scores} avec Scorer.compute_scores sur chaque cellule."""
+        results = results if results is not None else self.run()
+        return {key: scorer.compute_scores(cell["gt_captions"], cell["responses"])
+                for key, cell in results.items() if cell["responses"]}
@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# champs de timing renvoyés par Ollama à la fin de chaque réponse (durées en ns)
+OLLAMA_FIELDS = ("total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                 "eval_count", "eval_duration")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _field(response, name):
+    """Champ d'une réponse ollama (objet pydantic ou dict), None s'il est absent."""
+    try:
+        value = response[name]
+    except (KeyError, TypeError, AttributeError):
+        value = getattr(response, name, None)
+    return value
+
+
+class Recorder:
+    """
+    Mesures structurées de la chaîne (à la place des print) :
+        - durée de chaque étape (chargement/encodage de l'image, attente dans la file, requête Ollama,
+          prétraitement et forward CLIP, chaque métrique du Scorer...), avec des labels (modèle, métrique...)
+        - pour chaque appel Ollama, ses propres compteurs : prompt_eval_count, eval_count, eval_duration,
+          load_duration (et le temps réseau = temps mesuré côté client - total_duration du serveur)
+    Les événements sont gardés en mémoire (les max_events derniers) et, si jsonl_path est donné, ajoutés au fil de
+    l'eau dans un fichier JSONL. prometheus() renvoie un instantané au format texte de Prometheus.
+    """
+
+    def __init__(self, max_events=100_000, max_samples=10_000, jsonl_path=None, enabled=True):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.jsonl_path = Path(jsonl_path) if jsonl_path else None
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=max_events)
+        # (étape, labels) -> {"count", "sum", "samples"}
+        self.stages = {}
+        # (nom, labels) -> valeur
+        self.counters = {}
+
+    def _emit(self, event):
+        event = {"ts": time.time(), **event}
+        self.events.append(event)
+        if self.jsonl_path is not None:
+            self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+
+    def observe(self, stage, duration, **labels):
+        """Enregistre la durée (s) d'une étape."""
+        if not self.enabled:
+            return
+        key = (stage, _labels(labels))
+        with self.lock:
+            stat = self.stages.get(key)
+            if stat is None:
+                stat = self.stages[key] = {"count": 0, "sum": 0.0, "samples": deque(maxlen=self.max_samples)}
+            stat["count"] += 1
+            stat["sum"] += duration
+            stat["samples"].append(duration)
+            self._emit({"kind": "stage", "stage": stage, "duration": duration, **labels})
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def ollama_call(self, model, response=None, wall=None, queued=None, status="ok", **labels):
+        """
+        Un appel Ollama : durée mesurée côté client (wall), attente avant l'envoi (queued)
+        et compteurs renvoyés par le serveur dans la réponse (ou le dernier chunk en streaming).
+        """
+        if not self.enabled:
+            return
+        event = {"kind": "ollama", "model": model, "status": status, "wall": wall, "queued": queued, **labels}
+        if response is not None:
+            for name in OLLAMA_FIELDS:
+                event[name] = _field(response, name)
+        ns = 1e-9
+        server = event.get("total_duration")
+        if wall is not None and server:
+            event["network"] = max(0.0, wall - server * ns)
+        if event.get("eval_count") and event.get("eval_duration"):
+            event["tokens_per_s"] = event["eval_count"] / (event["eval_duration"] * ns)
+
+        self.count("ollama_requests_total", model=model, status=status)
+        if event.get("prompt_eval_count"):
+            self.count("ollama_prompt_eval_tokens_total", event["prompt_eval_count"], model=model)
+        if event.get("eval_count"):
+            self.count("ollama_eval_tokens_total", event["eval_count"], model=model)
+        for name in ("eval_duration", "prompt_eval_duration", "load_duration"):
+            if event.get(name):
+                self.count(f"ollama_{name.replace('_duration', '')}_seconds_total", event[name] * ns, model=model)
+
+        with self.lock:
+            self._emit(event)
+        if wall is not None:
+            self.observe("ollama_request", wall, model=model)
+        if queued is not None:
+            self.observe("queue", queued, model=model)
+        if event.get("network") is not None:
+            self.observe("ollama_network", event["network"], model=model)
+        if server:
+            self.observe("ollama_server", server * ns, model=model)
+
+    def tokens_per_second(self):
+        """Débit de génération par modèle : somme des eval_count / somme des eval_duration."""
+        with self.lock:
+            counters = dict(self.counters)
+        out = {}
+        for (name, labels), value in counters.items():
+            if name == "ollama_eval_tokens_total":
+                seconds = counters.get(("ollama_eval_seconds_total", labels))
+                if seconds:
+                    out[dict(labels).get("model")] = value / seconds
+        return out
+
+    def summary(self):
+        """{(étape, labels): {count, mean, p50, p95, p99}} (durées en s)"""
+        with self.lock:
+            stages = {k: (v["count"], v["sum"], list(v["samples"])) for k, v in self.stages.items()}
+        out = {}
+        for key, (count, total, samples) in stages.items():
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) if samples else (np.nan,) * 3
+            out[key] = {"count": count, "mean": total / count, "p50": float(p50), "p95": float(p95),
+                        "p99": float(p99)}
+        return out
+
+    def export_jsonl(self, path):
+        """Écrit les événements gardés en mémoire dans un fichier JSONL."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+        return path
+
+    def prometheus(self, prefix="vlm"):
+        """Instantané au format texte de Prometheus (étapes en summary, compteurs, tokens/s par modèle)."""
+        lines = [f"# HELP {prefix}_stage_seconds Durée des étapes de la chaîne",
+                 f"# TYPE {prefix}_stage_seconds summary"]
+        for (stage, labels), stat in sorted(self.summary().items()):
+            base = (("stage", stage),) + labels
+            for q in ("p50", "p95", "p99"):
+                quantile = {"p50": "0.5", "p95": "0.95", "p99": "0.99"}[q]
+                lines.append(f"{prefix}_stage_seconds{_format_labels(base, [('quantile', quantile)])} {stat[q]:.6f}")
+            lines.append(f"{prefix}_stage_seconds_sum{_format_labels(base)} {stat['mean'] * stat['count']:.6f}")
+            lines.append(f"{prefix}_stage_seconds_count{_format_labels(base)} {stat['count']}")
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                typed.add(name)
+            lines.append(f"{prefix}_{name}{_format_labels(labels)} {value:g}")
+
+        tps = self.tokens_per_second()
+        if tps:
+            lines.append(f"# TYPE {prefix}_ollama_tokens_per_second gauge")
+            for model, value in sorted(tps.items(), key=lambda kv: str(kv[0])):
+                lines.append(f"{prefix}_ollama_tokens_per_second{_format_labels([('model', model)])} {value:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+        return path
+
+    def reset(self):
+        with self.lock:
+            self.events.clear()
+            self.stages.clear()
+            self.counters.clear()
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    """
+    Recorder partagé par tout le process. METRICS_JSONL dans le .env : fichier où les événements sont ajoutés
+    au fil de l'eau (vide = en mémoire seulement), INSTRUMENTATION=0 pour tout désactiver.
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = Recorder(jsonl_path=os.getenv("METRICS_JSONL") or None,
+                                 enabled=os.getenv("INSTRUMENTATION", "1") != "0")
+        return _recorder
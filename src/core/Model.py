@@ -1,67 +1,290 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
 import ollama
 
+from core.Instrumentation import get_recorder
+from core.OllamaPool import get_default_client
+from core.ResponseCache import ResponseCache, get_default_cache
+from core.preprocess import prepare_image
+
+# digest des modèles ollama (nom -> digest), pour que le cache change si le modèle est re-pull
+_MODEL_DIGESTS = {}
+_DIGEST_LOCK = threading.Lock()
+
+
+def model_digest(model_name, client=ollama):
+   with _DIGEST_LOCK:
+      if model_name not in _MODEL_DIGESTS:
+         digest = model_name
+         try:
+            for m in client.list()['models']:
+               if m['model'] in (model_name, f"{model_name}:latest"):
+                  digest = f"{model_name}@{m['digest']}"
+                  break
+         except Exception:
+            pass
+         _MODEL_DIGESTS[model_name] = digest
+      return _MODEL_DIGESTS[model_name]
+
+
+def images_ids(imgs_path):
+   # Récupère les ids des images dans l'ordre de images_to_process
+   ids = []
+   for path in imgs_path:
+       stem = Path(path).stem
+       try:
+           # Convert to coco (code base Youenn)
+           ids.append(int(stem))
+       except ValueError:
+           # if not possible because not an int we don't convert (code Victor)
+           ids.append(stem)
+   return ids
+
+
+def gt_captions(coco_captions, ids):
+   # une seule requête pour tout le lot si les légendes sont dans un CaptionStore
+   if hasattr(coco_captions, 'get_many'):
+      found = coco_captions.get_many(list(ids))
+   else:
+      found = coco_captions
+   return {img_id: found.get(img_id, "Pas de légende trouvée") for img_id in ids}
+
+
+class ModelResponses(dict):
+   """
+   Réponses renvoyées par Model.execute : {img_id: [descriptions]} comme avant, avec en plus
+   failed = {img_id: "Type: message"} pour les images qui ont échoué (après retry), au lieu de les perdre en silence.
+   """
+
+   def __init__(self, *args, **kwargs):
+      super().__init__(*args, **kwargs)
+      self.failed = {}
+
+
 class Model:
-   def __init__(self, model_name, prompts, imgs_path, coco_captions):
+   def __init__(self, model_name, prompts, imgs_path, coco_captions, max_workers=1, options=None, cache=None,
+                preprocess=True, recorder=None, client=None, images=None, keep_alive=None):
+       """
+       max_workers (default 1) : nombre max de requêtes Ollama en parallèle (1 = séquentiel).
+       options (default None) : options de génération passées à ollama.chat (temperature, num_predict...).
+       cache (default None) : ResponseCache à utiliser. None = cache partagé du process, False = pas de cache.
+       preprocess (default True) : transcode/redimensionne l'image en mémoire pour le modèle (cf core/preprocess.py).
+       coco_captions : dictionnaire {img_id: [légendes]} ou CaptionStore (légendes lues à la demande).
+       recorder (default None) : Recorder des mesures (cf core/Instrumentation.py). None = celui du process.
+       client (default None) : client Ollama (module ollama, ollama.Client, OllamaPool ou ResilientClient).
+                               None = client partagé avec timeout, retry et coupe-circuit (cf core/Resilience.py),
+                               sur OLLAMA_HOSTS (OllamaPool) s'il est dans le .env, sinon sur le serveur par défaut.
+       images (default None) : {img_path: (octets, hash)} déjà lus et encodés (cf core/GridExecutor.py) ;
+                               les images absentes sont lues sur le disque.
+       keep_alive (default None) : durée pendant laquelle Ollama garde le modèle chargé (ex "10m", 0 = le décharger).
+       """
        self.model_name = model_name
        self.imgs_path = imgs_path
        self.prompts = prompts
        self.coco_captions = coco_captions
+       self.max_workers = max_workers
+       self.preprocess = preprocess
+       if cache is None:
+          cache = get_default_cache()
+       self.cache = cache or None
+       self.recorder = recorder or get_recorder()
+       self.client = client or get_default_client()
+       # options réellement envoyées (un ResilientClient borne num_predict) : ce sont elles qui font la clé du cache
+       request_options = getattr(self.client, "request_options", None)
+       self.options = request_options(options) if request_options else options
+       self.images = images or {}
+       self.keep_alive = keep_alive
+
+   def _images_ids(self):
+      return images_ids(self.imgs_path)
 
-   def execute(self, prompt_id, freq_print=10):
+   def _load_image(self, img_path):
       """
-      freq_print (default 10) : if 0 then does not print.
+      Renvoie (octets envoyés à Ollama, hash utilisé dans la clé du cache).
+      """
+      if img_path in self.images:
+         return self.images[img_path]
+      with self.recorder.timer("image_load", model=self.model_name):
+         if self.preprocess:
+            img_bytes, content_hash, target = prepare_image(img_path, self.model_name)
+            return img_bytes, f"{content_hash}:{target}"
+         with open(img_path, 'rb') as f:
+            img_bytes = f.read()
+         return img_bytes, ResponseCache.hash_bytes(img_bytes)
+
+   def _cache_key(self, prompt, img_hash):
+      if self.cache is None:
+         return None
+      return ResponseCache.make_key(img_hash, prompt, model_digest(self.model_name, self.client), self.options)
+
+   def _chat_kwargs(self):
+      return {} if self.keep_alive is None else {'keep_alive': self.keep_alive}
+
+   def _messages(self, prompt, img_bytes):
+      return [{
+         'role': 'user',
+         'content': prompt,
+         'images': [img_bytes]
+      }]
+
+   def _infer(self, prompt, img_path, queued=None):
+      """
+      Un appel Ollama pour une image. Renvoie (description nettoyée, True si elle vient du cache).
+      Passe par le cache si la même image (contenu) a déjà été vue avec ce prompt, ce modèle et ces options.
+      queued : temps (s) passé dans la file avant d'être traité, pour les mesures.
+      """
+      img_bytes, img_hash = self._load_image(img_path)
+
+      key = self._cache_key(prompt, img_hash)
+      if key is not None:
+         cached = self.cache.get(key)
+         self.recorder.count("response_cache_total", model=self.model_name,
+                             result="hit" if cached is not None else "miss")
+         if cached is not None:
+            return cached, True
+
+      start = time.perf_counter()
+      try:
+         reponse = self.client.chat(
+               model=self.model_name,
+               messages=self._messages(prompt, img_bytes),
+               options=self.options,
+               **self._chat_kwargs(),
+             # ex : options={'temperature': 0.1, 'num_predict': 100}
+             # (num_predict limite la longueur pour éviter les boucles infinies de symboles)
+         )
+      except Exception:
+         self.recorder.ollama_call(self.model_name, wall=time.perf_counter() - start, queued=queued, status="error")
+         raise
+      self.recorder.ollama_call(self.model_name, reponse, wall=time.perf_counter() - start, queued=queued)
+      description = reponse['message']['content']
+      description = description.strip().strip('"')
+
+      if key is not None:
+         self.cache.set(key, description)
+      return description, False
+
+   def _run_one(self, n, prompt, img_path, img_id, submitted=None):
+      """
+      Traite une image et renvoie un dict de résultat, sans lever d'exception (pour ne pas casser le pool de threads).
+      submitted : instant (perf_counter) où l'image a été mise dans la file du pool, pour mesurer l'attente.
+      """
+      start = time.perf_counter()
+      queued = start - submitted if submitted is not None else None
+      result = {'index': n, 'img_id': img_id, 'img_path': img_path,
+                'response': None, 'error': None, 'cached': False}
+      try:
+         result['response'], result['cached'] = self._infer(prompt, img_path, queued)
+      except Exception as e:
+         result['error'] = e
+      result['duration'] = time.perf_counter() - start
+      return result
+
+   def iter_execute(self, prompt_id, max_workers=None, ordered=False):
+      """
+      Générateur : renvoie le résultat de chaque image dès qu'il est prêt.
+      Chaque résultat est un dict {index, img_id, img_path, response, error, cached, duration (s)}.
+      max_workers (default None) : overrides self.max_workers.
+      ordered (default False) : if True results come in the order of imgs_path, else in completion order.
+      """
+      images_ids = self._images_ids()
+      workers = max_workers if max_workers is not None else self.max_workers
+      prompt = self.prompts[prompt_id]
+
+      if not workers or workers <= 1:
+         for n, img_path in enumerate(self.imgs_path):
+            yield self._run_one(n, prompt, img_path, images_ids[n])
+         return
+
+      pool = ThreadPoolExecutor(max_workers=workers)
+      try:
+         futures = [pool.submit(self._run_one, n, prompt, p, images_ids[n], time.perf_counter())
+                    for n, p in enumerate(self.imgs_path)]
+         for future in (futures if ordered else as_completed(futures)):
+            yield future.result()
+      finally:
+         # si l'appelant arrête d'itérer on annule les images pas encore envoyées
+         pool.shutdown(wait=True, cancel_futures=True)
+
+   def stream(self, prompt_id, img_index=0):
+      """
+      Générateur de tokens (stream=True d'Ollama) pour une image, pour afficher la réponse au fur et à mesure.
+      La réponse complète est mise en cache à la fin ; si elle est déjà en cache elle est renvoyée en un bloc.
       """
+      prompt = self.prompts[prompt_id]
+      img_bytes, img_hash = self._load_image(self.imgs_path[img_index])
+
+      key = self._cache_key(prompt, img_hash)
+      if key is not None:
+         cached = self.cache.get(key)
+         if cached is not None:
+            yield cached
+            return
 
-      # Récupère les ids des images dans l'ordre de images_to_process
-      images_ids = []
-      for path in self.imgs_path:
-          stem = Path(path).stem
-          try:
-              # Convert to coco (code base Youenn)
-              images_ids.append(int(stem))
-          except ValueError:
-              # if not possible because not an int we don't convert (code Victor)
-              images_ids.append(stem)
+      parts = []
+      start = time.perf_counter()
+      last = None
+      try:
+         for chunk in self.client.chat(
+               model=self.model_name,
+               messages=self._messages(prompt, img_bytes),
+               options=self.options,
+               stream=True,
+               **self._chat_kwargs(),
+         ):
+            if last is None:
+               self.recorder.observe("first_token", time.perf_counter() - start, model=self.model_name)
+            last = chunk
+            token = chunk['message']['content']
+            parts.append(token)
+            yield token
+      except Exception:
+         self.recorder.ollama_call(self.model_name, wall=time.perf_counter() - start, status="error")
+         raise
+      # le dernier chunk (done=True) porte les compteurs d'Ollama
+      self.recorder.ollama_call(self.model_name, last, wall=time.perf_counter() - start)
 
-      print(f"--- Starting analysis. Selected images : {len(images_ids)} ---")
+      if key is not None:
+         self.cache.set(key, "".join(parts).strip().strip('"'))
+
+   def execute(self, prompt_id, freq_print=10, max_workers=None):
+      """
+      freq_print (default 10) : if 0 then does not print.
+      max_workers (default None) : overrides self.max_workers. Above 1, images are sent
+      concurrently but results keep the order of imgs_path.
+      Returns (model_responses, gt_captions_dict) ; model_responses.failed liste les images en échec.
+      """
+      print(f"--- Starting analysis. Selected images : {len(self.imgs_path)} ---")
 
       # Dict of model responses per image (key = image id, value = list of responses)
-      model_responses = {}
+      model_responses = ModelResponses()
 
       num_img = len(self.imgs_path)
 
-      for n,img_path in enumerate(self.imgs_path):
-         img_id = images_ids[n]
+      for result in self.iter_execute(prompt_id, max_workers=max_workers, ordered=True):
+         n, img_id, img_path = result['index'], result['img_id'], result['img_path']
 
-         try:
-            reponse = ollama.chat(
-                  model=self.model_name,
-                  messages=[{
-                     'role': 'user',
-                     'content': self.prompts[prompt_id],
-                     'images': [img_path]
-                  }],
-                #options={
-                 #   'temperature': 0.1,  # Force le modèle à être moins "fou"
-                 #   'num_predict': 100  # Limite la longueur pour éviter les boucles infinies de symboles
-                #}
-            )
-            
-            description = reponse['message']['content']
-            description = description.strip().strip('"')
-            if (freq_print > 0 and n%freq_print == 0):
-               print(f"Analyse {n+1}/{num_img} : {img_id}, {img_path}")
-               print(f"    {description}")
-
-            if img_id not in model_responses:
-                  model_responses[img_id] = []
-            model_responses[img_id].append(description) 
-
-         except Exception as e:
-            print(f"Erreur sur l'image {img_path}: {e}")   
+         if result['error'] is not None:
+            error = result['error']
+            print(f"Erreur sur l'image {img_path}: {error}")
+            model_responses.failed[img_id] = f"{type(error).__name__}: {error}"
+            continue
+
+         description = result['response']
+         if (freq_print > 0 and n%freq_print == 0):
+            print(f"Analyse {n+1}/{num_img} : {img_id}, {img_path}")
+            print(f"    {description}")
+
+         if img_id not in model_responses:
+               model_responses[img_id] = []
+         model_responses[img_id].append(description)
 
       # We create a dictionnary of ground truth captions for the specific images tested below
-      gt_captions_dict = {img_id: self.coco_captions.get(img_id, "Pas de légende trouvée") for img_id in model_responses}
+      gt_captions_dict = gt_captions(self.coco_captions, model_responses)
+
+      if model_responses.failed:
+         print(f"--- {len(model_responses.failed)}/{num_img} image(s) en échec : {list(model_responses.failed)} ---")
 
       return model_responses, gt_captions_dict
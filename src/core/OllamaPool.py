@@ -0,0 +1,277 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import httpx
+import ollama
+from dotenv import load_dotenv
+
+from core.Instrumentation import get_recorder
+
+load_dotenv()
+
+
+class NoEndpointAvailable(RuntimeError):
+    pass
+
+
+def is_endpoint_failure(error):
+    """
+    True si l'erreur vient du serveur (injoignable, coupé, erreur 5xx) : on peut réessayer sur un autre endpoint.
+    Une erreur 4xx (modèle inconnu, requête invalide) serait la même partout, on la remonte directement,
+    comme un timeout de lecture : une génération qui ne finit pas (boucle de symboles) ne finirait pas ailleurs.
+    """
+    if isinstance(error, httpx.ReadTimeout):
+        return False
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code is None or error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+class Endpoint:
+    def __init__(self, host, **client_kwargs):
+        self.host = host.rstrip("/")
+        self.client = ollama.Client(host=self.host, **client_kwargs)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        # False tant que le health check échoue
+        self.healthy = True
+        # incrémenté à chaque éjection : les requêtes en cours sur l'ancienne "génération" sont renvoyées ailleurs
+        self.generation = 0
+
+    def available(self, now):
+        return self.healthy and now >= self.ejected_until
+
+    def stats(self):
+        return {"host": self.host, "outstanding": self.outstanding, "requests": self.requests,
+                "failures": self.failures, "ejected": not self.available(time.monotonic())}
+
+
+class OllamaPool:
+    """
+    Client Ollama sur plusieurs serveurs (même interface que le module ollama pour chat et list) :
+        - chaque requête part sur l'endpoint qui a le moins de requêtes en cours (least outstanding requests)
+        - un endpoint qui enchaîne max_failures erreurs est éjecté pendant eject_time s ; un endpoint qui ne répond
+          plus au health check (/api/version toutes les health_interval s) est éjecté jusqu'à ce qu'il réponde
+        - une requête qui échoue sur un endpoint (injoignable, 5xx) est renvoyée sur un autre, et une requête
+          en cours sur un endpoint qui vient d'être éjecté est abandonnée et renvoyée ailleurs
+    En streaming la requête n'est renvoyée ailleurs que si rien n'a encore été reçu.
+    """
+
+    def __init__(self, hosts, max_failures=3, eject_time=30.0, health_interval=5.0, health_timeout=2.0,
+                 unavailable_wait=30.0, max_in_flight=64, **client_kwargs):
+        """
+        :param hosts: liste d'URL de serveurs Ollama (ex: ["http://box1:11434", "http://box2:11434"])
+        :param unavailable_wait: temps max (s) d'attente d'un endpoint quand ils sont tous éjectés
+        :param max_in_flight: nombre max de requêtes (non streaming) en cours en même temps sur le pool
+        :param client_kwargs: passés à ollama.Client (ex: timeout=...)
+        """
+        if not hosts:
+            raise ValueError("OllamaPool : au moins un endpoint est nécessaire")
+        self.endpoints = [Endpoint(h, **client_kwargs) for h in hosts]
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.unavailable_wait = unavailable_wait
+        self.recorder = get_recorder()
+
+        self.lock = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="ollama-pool")
+        self._closed = threading.Event()
+        self._health_thread = None
+        if health_interval:
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+            self._health_thread.start()
+
+    # --- choix de l'endpoint ---------------------------------------------------------------------------------
+
+    def _acquire(self, exclude=()):
+        """Endpoint disponible avec le moins de requêtes en cours (attend si tous sont éjectés)."""
+        deadline = time.monotonic() + self.unavailable_wait
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                candidates = [e for e in self.endpoints if e.available(now) and e not in exclude]
+                if candidates:
+                    best = min(candidates, key=lambda e: (e.outstanding, e.requests))
+                    best.outstanding += 1
+                    best.requests += 1
+                    return best, best.generation
+                if exclude and all(e in exclude for e in self.endpoints):
+                    raise NoEndpointAvailable("Tous les endpoints Ollama ont échoué pour cette requête")
+                if now >= deadline:
+                    raise NoEndpointAvailable("Aucun endpoint Ollama disponible")
+                # réveillé par une réadmission (health check) ou au plus tard à la prochaine fin d'éjection
+                soonest = min([e.ejected_until for e in self.endpoints if e.healthy] or [now + 0.5])
+                self.lock.wait(timeout=max(0.05, min(soonest, deadline) - now))
+
+    def _release(self, endpoint, error=None):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+            elif is_endpoint_failure(error):
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.max_failures:
+                    self._eject(endpoint, f"{endpoint.consecutive_failures} erreurs de suite ({error})")
+            self.lock.notify_all()
+        self.recorder.count("ollama_endpoint_requests_total", endpoint=endpoint.host,
+                            status="ok" if error is None else "error")
+
+    def _eject(self, endpoint, reason, healthy=True):
+        # appelé avec self.lock
+        if endpoint.available(time.monotonic()):
+            print(f"Endpoint Ollama {endpoint.host} éjecté : {reason}")
+            self.recorder.count("ollama_endpoint_ejections_total", endpoint=endpoint.host)
+            endpoint.generation += 1
+        if healthy:
+            endpoint.ejected_until = time.monotonic() + self.eject_time
+        endpoint.healthy = healthy
+
+    def _ejected_since(self, endpoint, generation):
+        with self.lock:
+            return endpoint.generation != generation
+
+    # --- health checks ---------------------------------------------------------------------------------------
+
+    def check(self, endpoint):
+        try:
+            r = httpx.get(f"{endpoint.host}/api/version", timeout=self.health_timeout)
+            return r.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    def _health_loop(self):
+        while not self._closed.wait(self.health_interval):
+            for endpoint in self.endpoints:
+                healthy = self.check(endpoint)
+                with self.lock:
+                    if not healthy:
+                        self._eject(endpoint, "health check en échec", healthy=False)
+                    elif not endpoint.healthy:
+                        # répond de nouveau (une éjection pour erreurs en cours va quand même jusqu'au bout)
+                        print(f"Endpoint Ollama {endpoint.host} réadmis")
+                        endpoint.healthy = True
+                        endpoint.consecutive_failures = 0
+                        self.lock.notify_all()
+
+    # --- API (comme le module ollama) ------------------------------------------------------------------------
+
+    def chat(self, *args, stream=False, **kwargs):
+        if stream:
+            return self._chat_stream(*args, **kwargs)
+
+        tried = []
+        last_error = None
+        while True:
+            try:
+                endpoint, generation = self._acquire(exclude=tried)
+            except NoEndpointAvailable:
+                if last_error is not None:
+                    raise last_error
+                raise
+            tried.append(endpoint)
+            future = self.executor.submit(endpoint.client.chat, *args, **kwargs)
+            done = threading.Event()
+
+            # l'endpoint reste chargé tant que la requête tourne, même si on ne l'attend plus
+            def finished(f, endpoint=endpoint, done=done):
+                self._release(endpoint, f.exception())
+                done.set()
+
+            future.add_done_callback(finished)
+            while True:
+                try:
+                    return future.result(timeout=0.25)
+                except FutureTimeoutError:
+                    if self._ejected_since(endpoint, generation):
+                        print(f"Requête en cours sur {endpoint.host} (éjecté) renvoyée sur un autre endpoint")
+                        self.recorder.count("ollama_redispatch_total", endpoint=endpoint.host)
+                        break
+                except Exception as e:
+                    done.wait()
+                    if not is_endpoint_failure(e):
+                        raise
+                    last_error = e
+                    self.recorder.count("ollama_redispatch_total", endpoint=endpoint.host)
+                    break
+
+    def _chat_stream(self, *args, **kwargs):
+        tried = []
+        while True:
+            endpoint, _ = self._acquire(exclude=tried)
+            tried.append(endpoint)
+            received = False
+            try:
+                for chunk in endpoint.client.chat(*args, stream=True, **kwargs):
+                    received = True
+                    yield chunk
+            except Exception as e:
+                self._release(endpoint, e)
+                if received or not is_endpoint_failure(e) or len(tried) == len(self.endpoints):
+                    raise
+                self.recorder.count("ollama_redispatch_total", endpoint=endpoint.host)
+                continue
+            except GeneratorExit:
+                self._release(endpoint)
+                raise
+            self._release(endpoint)
+            return
+
+    def list(self):
+        endpoint, _ = self._acquire()
+        try:
+            result = endpoint.client.list()
+        except Exception as e:
+            self._release(endpoint, e)
+            raise
+        self._release(endpoint)
+        return result
+
+    def ps(self):
+        """Modèles chargés sur les endpoints disponibles (réunis, comme un seul serveur)."""
+        now = time.monotonic()
+        models = {}
+        for endpoint in [e for e in self.endpoints if e.available(now)]:
+            try:
+                for m in endpoint.client.ps()['models']:
+                    models.setdefault(m['model'], m)
+            except Exception:
+                continue
+        return {'models': list(models.values())}
+
+    def stats(self):
+        with self.lock:
+            return [e.stats() for e in self.endpoints]
+
+    def close(self):
+        self._closed.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_default_client():
+    """
+    Client utilisé par Model par défaut : un OllamaPool si OLLAMA_HOSTS (liste d'URL séparées par des virgules)
+    est défini dans le .env, sinon un client sur OLLAMA_HOST / localhost ; dans les deux cas enveloppé dans un
+    ResilientClient (timeout, retry, coupe-circuit réglés par OLLAMA_TIMEOUT et OLLAMA_RETRIES).
+    """
+    from core.Resilience import ResilientClient, RetryPolicy
+
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            policy = RetryPolicy.from_env()
+            hosts = [h.strip() for h in os.getenv("OLLAMA_HOSTS", "").split(",") if h.strip()]
+            client = OllamaPool(hosts, timeout=policy.http_timeout()) if hosts else None
+            _default_client = ResilientClient(client, policy)
+        return _default_client
@@ -0,0 +1,271 @@
+import os
+import random
+import threading
+import time
+
+import httpx
+import ollama
+from dotenv import load_dotenv
+
+from core.Instrumentation import get_recorder
+from core.OllamaPool import is_endpoint_failure
+
+load_dotenv()
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class GenerationTimeout(TimeoutError):
+    pass
+
+
+def is_transient(error):
+    """
+    Erreur qui vaut la peine d'être retentée : serveur injoignable ou coupé, surcharge (429) ou 5xx.
+    Un timeout de lecture n'en est pas une : la génération qui boucle recommencerait à l'identique.
+    """
+    if isinstance(error, GenerationTimeout):
+        return False
+    if isinstance(error, ollama.ResponseError) and error.status_code == 429:
+        return True
+    return is_endpoint_failure(error)
+
+
+class RetryPolicy:
+    """
+    timeout : temps max (s) d'une requête. Passé au client HTTP : à l'expiration la connexion est coupée,
+              ce qui arrête aussi la génération côté Ollama (ex: boucle infinie de symboles). Pas retentée.
+    connect_timeout : temps max (s) pour se connecter, court pour passer vite à l'essai ou l'endpoint suivant
+    deadline : temps max (s) d'un appel, essais compris (défaut : timeout) ; aucun essai n'est relancé au-delà
+    num_predict : nombre max de tokens générés, imposé à options.num_predict de chaque requête (0 = pas de limite)
+    max_attempts : nombre d'essais au total pour une erreur transitoire
+    base_delay / max_delay : backoff exponentiel avec jitter complet, attente uniforme dans [0, min(max, base * 2^n)]
+    """
+
+    def __init__(self, timeout=300.0, max_attempts=3, base_delay=0.5, max_delay=10.0, connect_timeout=10.0,
+                 deadline=None, num_predict=1024, seed=None):
+        self.timeout = timeout
+        self.connect_timeout = min(connect_timeout, timeout)
+        self.deadline = deadline if deadline is not None else timeout
+        self.num_predict = num_predict
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = random.Random(seed)
+
+    @classmethod
+    def from_env(cls):
+        return cls(timeout=float(os.getenv("OLLAMA_TIMEOUT", "300")),
+                   max_attempts=int(os.getenv("OLLAMA_RETRIES", "2")) + 1,
+                   num_predict=int(os.getenv("OLLAMA_NUM_PREDICT", "1024")))
+
+    def http_timeout(self):
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+    def delay(self, attempt):
+        return self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def cap(self, options):
+        """options avec num_predict borné par la politique."""
+        if not self.num_predict:
+            return options
+        options = dict(options or {})
+        n = options.get("num_predict")
+        if n is None or n < 0 or n > self.num_predict:
+            options["num_predict"] = self.num_predict
+        return options
+
+
+class CircuitBreaker:
+    """
+    Coupe-circuit : après failure_threshold échecs de suite, les envois sont mis en pause pendant reset_timeout s
+    (au lieu d'enchaîner des erreurs sur toutes les images restantes), puis une seule requête d'essai passe :
+    si elle réussit le circuit se referme, sinon il se rouvre. Un appel qui attend plus de max_wait s lève
+    CircuitOpenError (l'image est alors comptée en échec).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, max_wait=300.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Condition()
+
+    def before_call(self):
+        """Bloque tant que le circuit est ouvert. Renvoie True si cet appel est la requête d'essai."""
+        deadline = time.monotonic() + self.max_wait
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.state == self.CLOSED:
+                    return False
+                if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                    self.state = self.HALF_OPEN
+                if self.state == self.HALF_OPEN and not self.probing:
+                    self.probing = True
+                    return True
+                if now >= deadline:
+                    raise CircuitOpenError(f"Circuit ouvert depuis {now - self.opened_at:.0f}s, Ollama ne répond pas")
+                wake = self.opened_at + self.reset_timeout if self.state == self.OPEN else now + 1.0
+                self.lock.wait(timeout=max(0.05, min(wake, deadline) - now))
+
+    def success(self, probe=False):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print("Circuit Ollama refermé")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+            self.lock.notify_all()
+
+    def release(self, probe=False):
+        """Libère la requête d'essai qui n'a été comptée ni en succès ni en échec (interrompue)."""
+        if not probe:
+            return
+        with self.lock:
+            self.probing = False
+            self.lock.notify_all()
+
+    def failure(self, probe=False):
+        with self.lock:
+            self.failures += 1
+            if probe:
+                self.probing = False
+            if (probe or self.state == self.HALF_OPEN or self.failures >= self.failure_threshold) \
+                    and self.state != self.OPEN:
+                print(f"Circuit Ollama ouvert après {self.failures} échecs, pause de {self.reset_timeout:.0f}s")
+                get_recorder().count("ollama_circuit_open_total")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self.lock.notify_all()
+
+
+class ResilientClient:
+    """
+    Client Ollama (même interface que le module ollama pour chat et list) avec timeout par requête,
+    retry avec backoff exponentiel + jitter sur les erreurs transitoires, et coupe-circuit.
+    Peut envelopper un ollama.Client ou un OllamaPool (qui renvoie déjà les requêtes d'un serveur à l'autre).
+    """
+
+    def __init__(self, client=None, policy=None, breaker=None):
+        """
+        :param client: client à envelopper. None = ollama.Client sur OLLAMA_HOST avec le timeout de la politique
+        """
+        self.policy = policy or RetryPolicy.from_env()
+        self.breaker = breaker or CircuitBreaker()
+        if client is None or client is ollama:
+            client = ollama.Client(timeout=self.policy.http_timeout())
+        self.client = client
+        self.recorder = get_recorder()
+
+    def _retry_delay(self, error, attempt, start):
+        """Attente avant le prochain essai, None s'il n'y en a pas (erreur définitive, essais ou deadline épuisés)."""
+        if not is_transient(error) or attempt + 1 >= self.policy.max_attempts:
+            return None
+        delay = self.policy.delay(attempt)
+        if time.monotonic() - start + delay >= self.policy.deadline:
+            return None
+        return delay
+
+    def _settle(self, probe, error=None):
+        """Compte le résultat d'un appel pour le coupe-circuit (libère toujours la requête d'essai)."""
+        if error is None:
+            self.breaker.success(probe)
+        elif is_transient(error):
+            self.breaker.failure(probe)
+        elif probe:
+            if isinstance(error, (httpx.ReadTimeout, GenerationTimeout)):
+                # la requête d'essai n'a pas abouti : le circuit reste ouvert
+                self.breaker.failure(probe)
+            else:
+                # erreur de la requête (4xx), le serveur répond : on referme
+                self.breaker.success(probe)
+
+    def request_options(self, options):
+        """Options réellement envoyées à Ollama (num_predict borné), à utiliser dans la clé du cache."""
+        return self.policy.cap(options)
+
+    def chat(self, *args, stream=False, **kwargs):
+        kwargs["options"] = self.request_options(kwargs.get("options"))
+        if stream:
+            return self._chat_stream(*args, **kwargs)
+        attempt = 0
+        start = time.monotonic()
+        while True:
+            probe = self.breaker.before_call()
+            try:
+                response = self.client.chat(*args, **kwargs)
+            except Exception as e:
+                self._settle(probe, e)
+                delay = self._retry_delay(e, attempt, start)
+                if delay is None:
+                    raise
+                self.recorder.count("ollama_retries_total", error=type(e).__name__)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._settle(probe)
+            return response
+
+    def _chat_stream(self, *args, **kwargs):
+        """Le retry n'est possible que tant qu'aucun token n'a été reçu ; le timeout porte sur toute la réponse."""
+        attempt = 0
+        first_start = time.monotonic()
+        while True:
+            probe = self.breaker.before_call()
+            start = time.monotonic()
+            received = False
+            settled = False
+            try:
+                stream = self.client.chat(*args, stream=True, **kwargs)
+                for chunk in stream:
+                    received = True
+                    yield chunk
+                    if time.monotonic() - start > self.policy.timeout:
+                        # coupe la connexion, Ollama arrête de générer
+                        stream.close()
+                        raise GenerationTimeout(f"Réponse en streaming plus longue que {self.policy.timeout}s")
+                self._settle(probe)
+                settled = True
+                return
+            except Exception as e:
+                self._settle(probe, e)
+                settled = True
+                delay = None if received else self._retry_delay(e, attempt, first_start)
+                if delay is None:
+                    raise
+                self.recorder.count("ollama_retries_total", error=type(e).__name__)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except GeneratorExit:
+                # l'appelant arrête de lire : le serveur a répondu, la requête d'essai est terminée
+                self._settle(probe)
+                settled = True
+                raise
+            finally:
+                if not settled:
+                    self.breaker.release(probe)
+
+    def list(self):
+        return self.client.list()
+
+    def ps(self):
+        return self.client.ps()
+
+    def stats(self):
+        out = {"circuit": self.breaker.state}
+        if hasattr(self.client, "stats"):
+            out["endpoints"] = self.client.stats()
+        return out
+
+    def close(self):
+        if hasattr(self.client, "close"):
+            self.client.close()
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_CACHE_PATH = Path(__file__).resolve().parent.parent / "data" / "cache" / "responses.sqlite"
+
+
+class ResponseCache:
+    """
+    Cache disque (SQLite) des réponses Ollama.
+        La clé est le hash du contenu de l'image + le prompt + le modèle (nom et digest) + les options
+        de génération. Relancer un scoring ne régénère donc pas les légendes déjà obtenues.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=100_000, max_age=None, enabled=True):
+        """
+        :param path: fichier sqlite
+        :param max_entries: nombre max de réponses gardées (les plus anciennement utilisées sont supprimées)
+        :param max_age: âge max d'une entrée en secondes (None = pas de limite)
+        :param enabled: si False le cache est contourné (toujours un miss, rien n'est écrit)
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses(accessed)")
+        self.conn.commit()
+
+    @staticmethod
+    def hash_bytes(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def make_key(image_hash, prompt, model, options=None):
+        payload = json.dumps(
+            {"image": image_hash, "prompt": prompt, "model": model, "options": options or {}},
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_age is not None and now - row[1] > self.max_age:
+                # trop vieux : on supprime et on compte un miss
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, response):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._evict(now)
+            self.conn.commit()
+
+    def _evict(self, now):
+        if self.max_age is not None:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age,))
+        if self.max_entries is not None:
+            count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": size,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Cache partagé par tout le process. RESPONSE_CACHE=0 dans le .env le désactive,
+    RESPONSE_CACHE_PATH permet de changer le fichier.
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            enabled = os.getenv("RESPONSE_CACHE", "1") not in ("0", "false", "False")
+            path = os.getenv("RESPONSE_CACHE_PATH", str(DEFAULT_CACHE_PATH))
+            _default_cache = ResponseCache(path=path, enabled=enabled)
+        return _default_cache
@@ -0,0 +1,249 @@
+import os
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Seuil sur la similarité cosinus brute texte/image de CLIP ViT-B/32.
+# Contrairement à l'ancienne softmax sur l'album, il ne dépend pas du nombre d'images.
+# Se recalibre avec calibrate_threshold sur des couples (question, image) annotés :
+# python -m core.VectorSearch --calibrate (couples de data/test, cf core/rag.py calibrate_min_score).
+CLIP_MIN_SCORE = float(os.getenv("CLIP_MIN_SCORE", "0.22"))
+
+# au dessus de ce nombre d'images on passe sur l'index approché
+APPROX_MIN_SIZE = 100_000
+
+
+def _top_k(scores, k):
+    """Indices des k meilleurs scores, triés par score décroissant."""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+def _kmeans(x, k, n_iter=20, seed=0):
+    """K-means (distance L2) en numpy, l'affectation est faite par blocs pour limiter la mémoire."""
+    rng = np.random.default_rng(seed)
+    k = min(k, x.shape[0])
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].copy()
+    assign = np.zeros(x.shape[0], dtype=np.int64)
+
+    for _ in range(n_iter):
+        assign = _assign(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        # somme par cluster : on trie par cluster puis reduceat sur les débuts de blocs
+        order = np.argsort(assign, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(x[order], starts, axis=0) / counts[~empty, None]
+        # cluster vide : on le ré-initialise sur un point au hasard
+        if empty.any():
+            centroids[empty] = x[rng.choice(x.shape[0], int(empty.sum()), replace=False)]
+    return centroids, assign
+
+
+def _assign(x, centroids, block=8192):
+    c_norm = (centroids ** 2).sum(axis=1)
+    out = np.empty(x.shape[0], dtype=np.int64)
+    for i in range(0, x.shape[0], block):
+        # ||x - c||² = ||x||² - 2 x.c + ||c||², ||x||² ne change pas l'argmin
+        d = c_norm[None, :] - 2 * x[i:i + block] @ centroids.T
+        out[i:i + block] = d.argmin(axis=1)
+    return out
+
+
+class ExactSearch:
+    """
+    Recherche exacte : produit scalaire vectorisé sur tous les embeddings (normalisés => cosinus).
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, query, k=5):
+        scores = np.asarray(self.embeddings @ query, dtype=np.float32)
+        idx = _top_k(scores, k)
+        return idx, scores[idx]
+
+
+class IVFPQIndex:
+    """
+    Index approché IVF + Product Quantization, en numpy.
+        - IVF : les vecteurs sont répartis dans nlist listes (k-means), on ne parcourt que les nprobe listes
+          les plus proches de la requête.
+        - PQ : le résidu (vecteur - centroïde de sa liste) est découpé en m sous-vecteurs, chacun codé sur
+          un octet (256 centroïdes). Le score est obtenu par tables de correspondance (ADC).
+        - les meilleurs candidats sont ensuite re-classés avec les vrais vecteurs (rerank).
+    """
+
+    def __init__(self, embeddings, nlist=None, m=32, nprobe=16, rerank=100, train_size=50_000, seed=0):
+        self.embeddings = embeddings
+        n, d = embeddings.shape
+        if d % m != 0:
+            raise ValueError(f"La dimension {d} doit être un multiple de m={m}")
+        self.nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        self.m = m
+        self.dsub = d // m
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(embeddings[rng.choice(n, min(n, train_size), replace=False)], dtype=np.float32)
+
+        # 1. quantification grossière
+        self.coarse, _ = _kmeans(sample, self.nlist, seed=seed)
+        self.nlist = self.coarse.shape[0]
+
+        # 2. PQ appris sur les résidus de l'échantillon
+        residuals = sample - self.coarse[_assign(sample, self.coarse)]
+        self.pq = np.stack([
+            _kmeans(residuals[:, j * self.dsub:(j + 1) * self.dsub], 256, n_iter=10, seed=seed)[0]
+            for j in range(m)
+        ])  # [m, 256, dsub]
+
+        # 3. encodage de tous les vecteurs, par blocs
+        assign = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, m), dtype=np.uint8)
+        for i in range(0, n, 16384):
+            block = np.asarray(embeddings[i:i + 16384], dtype=np.float32)
+            a = _assign(block, self.coarse)
+            r = block - self.coarse[a]
+            assign[i:i + 16384] = a
+            for j in range(m):
+                codes[i:i + 16384, j] = _assign(r[:, j * self.dsub:(j + 1) * self.dsub], self.pq[j])
+
+        # listes inversées : vecteurs triés par liste + offsets
+        self.order = np.argsort(assign, kind="stable")
+        self.codes = codes[self.order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.nlist))])
+
+    def search(self, query, k=5, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        query = np.asarray(query, dtype=np.float32)
+
+        # produit scalaire : q.x ≈ q.c + somme_j q_j.pq_j[code_j]
+        coarse_scores = self.coarse @ query
+        lists = _top_k(coarse_scores, nprobe)
+        lut = np.einsum("jkd,jd->jk", self.pq, query.reshape(self.m, self.dsub))  # [m, 256]
+
+        cand, approx = [], []
+        for l in lists:
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if start == end:
+                continue
+            codes = self.codes[start:end]
+            approx.append(coarse_scores[l] + lut[np.arange(self.m), codes].sum(axis=1))
+            cand.append(self.order[start:end])
+        if not cand:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        cand = np.concatenate(cand)
+        approx = np.concatenate(approx)
+
+        # re-classement exact des meilleurs candidats
+        # (indices triés pour lire le memory-map dans l'ordre)
+        best = np.sort(cand[_top_k(approx, max(k, self.rerank))])
+        exact = np.asarray(self.embeddings[best] @ query, dtype=np.float32)
+        idx = _top_k(exact, k)
+        return best[idx], exact[idx]
+
+
+class VectorSearch:
+    """
+    Moteur de recherche top-k sur des embeddings normalisés.
+    Recherche exacte pour les petits albums, IVF-PQ au dessus de approx_min_size images.
+    """
+
+    def __init__(self, embeddings, approx_min_size=APPROX_MIN_SIZE, **ivf_params):
+        self.embeddings = embeddings
+        if embeddings.shape[0] >= approx_min_size:
+            print(f"Construction de l'index IVF-PQ ({embeddings.shape[0]} vecteurs)...")
+            self.engine = IVFPQIndex(embeddings, **ivf_params)
+        else:
+            self.engine = ExactSearch(embeddings)
+
+    def search(self, query, k=5, min_score=None):
+        """
+        :param query: embedding normalisé [D]
+        :param k: nombre de résultats
+        :param min_score: seuil de similarité cosinus (None = pas de filtre)
+        :return: liste de (indice, score) triée par score décroissant
+        """
+        idx, scores = self.engine.search(query, k)
+        return [(int(i), float(s)) for i, s in zip(idx, scores) if min_score is None or s >= min_score]
+
+
+def balanced_accuracy(positive_scores, negative_scores, threshold):
+    """Moyenne de la part des bons couples gardés (score >= seuil) et de celle des mauvais écartés."""
+    pos = np.asarray(positive_scores, dtype=np.float32)
+    neg = np.asarray(negative_scores, dtype=np.float32)
+    return float((np.mean(pos >= threshold) + np.mean(neg < threshold)) / 2)
+
+
+def calibrate_threshold(positive_scores, negative_scores):
+    """
+    Choisit le seuil qui sépare au mieux les scores des bons couples (question, image) des mauvais
+    (maximise la balanced accuracy).
+    """
+    pos = np.sort(np.asarray(positive_scores, dtype=np.float32))
+    neg = np.sort(np.asarray(negative_scores, dtype=np.float32))
+    candidates = np.unique(np.concatenate([pos, neg]))
+    best_t, best_acc = CLIP_MIN_SCORE, -1.0
+    for t in candidates:
+        tpr = 1 - np.searchsorted(pos, t, side="left") / len(pos)
+        tnr = np.searchsorted(neg, t, side="left") / len(neg)
+        acc = (tpr + tnr) / 2
+        if acc > best_acc:
+            best_t, best_acc = float(t), acc
+    return best_t
+
+
+def benchmark(n=100_000, d=512, n_queries=100, k=10, nprobes=(1, 4, 8, 16, 32), seed=0):
+    """
+    Compare l'index IVF-PQ à la recherche exacte sur des données synthétiques groupées :
+    recall@k et latence moyenne par requête.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((1000, d)).astype(np.float32)
+    data = centers[rng.integers(0, 1000, n)] + 0.5 * rng.standard_normal((n, d)).astype(np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    queries = data[rng.choice(n, n_queries, replace=False)] + 0.1 * rng.standard_normal((n_queries, d)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact = ExactSearch(data)
+    start = time.perf_counter()
+    truth = [set(exact.search(q, k)[0].tolist()) for q in queries]
+    exact_ms = (time.perf_counter() - start) / n_queries * 1000
+    print(f"Exact     : {exact_ms:7.2f} ms/requête, recall@{k} = 1.000")
+
+    start = time.perf_counter()
+    ivf = IVFPQIndex(data, seed=seed)
+    print(f"IVF-PQ construit en {time.perf_counter() - start:.1f}s (nlist={ivf.nlist}, m={ivf.m})")
+
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [set(ivf.search(q, k, nprobe=nprobe)[0].tolist()) for q in queries]
+        ms = (time.perf_counter() - start) / n_queries * 1000
+        recall = np.mean([len(f & t) / k for f, t in zip(found, truth)])
+        results.append({"nprobe": nprobe, "ms": ms, "recall": recall})
+        print(f"nprobe={nprobe:<3}: {ms:7.2f} ms/requête, recall@{k} = {recall:.3f}")
+    return {"exact_ms": exact_ms, "ivf": results}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark IVF-PQ / recherche exacte, ou calibration du seuil CLIP")
+    parser.add_argument("--calibrate", action="store_true", help="recalcule CLIP_MIN_SCORE sur data/test (charge CLIP)")
+    if parser.parse_args().calibrate:
+        from core.rag import calibrate_min_score
+
+        threshold, accuracy, current = calibrate_min_score()
+        print(f"Seuil calibré : {threshold:.3f} (balanced accuracy {accuracy:.2f}), "
+              f"CLIP_MIN_SCORE={CLIP_MIN_SCORE} : {current:.2f}")
+    else:
+        benchmark()
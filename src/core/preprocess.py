@@ -0,0 +1,117 @@
+"""
+    Normalisation des images avant envoi à Ollama.
+    On lit le vrai format (pas l'extension : un .png peut être un webp), on convertit en RGB et on
+    redimensionne en mémoire vers une taille adaptée au modèle (multiple de la taille de patch),
+    puis on envoie directement les octets. Plus besoin de l'essai qui plante puis du fichier _tmp.
+"""
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+# taille max du plus grand côté et multiple de patch par modèle
+# llava 1.6 : CLIP ViT-L/14 en 336 (anyres jusqu'à 672), moondream : SigLIP 378 patch 14,
+# qwen2.5-vl : patch 14 fusionné par 2 => multiple de 28
+MODEL_TARGETS = {
+    "llava": (672, 14),
+    "moondream": (378, 14),
+    "qwen2.5vl": (896, 28),
+}
+DEFAULT_TARGET = (448, 28)
+
+# formats qu'Ollama décode sans problème, les autres sont ré-encodés
+PASSTHROUGH_FORMATS = {"JPEG", "PNG"}
+
+
+def model_target(model_name):
+    """(taille max, multiple de patch) pour un nom de modèle ollama (ex 'qwen2.5vl:3b')"""
+    base = (model_name or "").split(":")[0].lower()
+    return MODEL_TARGETS.get(base, DEFAULT_TARGET)
+
+
+def _target_size(width, height, max_side, multiple):
+    scale = min(1.0, max_side / max(width, height))
+    new_w = max(multiple, round(width * scale / multiple) * multiple)
+    new_h = max(multiple, round(height * scale / multiple) * multiple)
+    return new_w, new_h
+
+
+def normalize_bytes(data, max_side, multiple, quality=90):
+    """
+    Transcode et redimensionne une image en mémoire.
+    :return: octets JPEG (RGB) aux dimensions multiples de `multiple`, plus grand côté <= max_side
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        fmt = img.format
+        rotated = img.getexif().get(0x0112, 1) != 1  # tag EXIF Orientation (photos de téléphone)
+        img = ImageOps.exif_transpose(img)
+        size = _target_size(img.width, img.height, max_side, multiple)
+
+        # déjà au bon format, à la bonne taille et droite : on envoie tel quel
+        if fmt in PASSTHROUGH_FORMATS and not rotated and size == (img.width, img.height) and img.mode in ("RGB", "L"):
+            return data
+
+        img = img.convert("RGB")
+        if size != (img.width, img.height):
+            img = img.resize(size, Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality)
+        return out.getvalue()
+
+
+class NormalizedImageCache:
+    """
+    Cache mémoire (LRU, borné en octets) des images normalisées, clé = hash du contenu + cible.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def set(self, key, data):
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and self.items:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old)
+
+
+_normalized_cache = NormalizedImageCache()
+
+
+def prepare_image(img_path, model_name):
+    """
+    Lit une image et renvoie (octets normalisés pour ce modèle, hash du fichier d'origine, cible).
+    """
+    with open(img_path, "rb") as f:
+        data = f.read()
+    return prepare_bytes(data, model_name)
+
+
+def prepare_bytes(data, model_name, content_hash=None):
+    """Comme prepare_image, pour une image déjà lue (content_hash : sha256 de data s'il est déjà calculé)."""
+    content_hash = content_hash or hashlib.sha256(data).hexdigest()
+    max_side, multiple = model_target(model_name)
+    target = f"{max_side}/{multiple}"
+
+    key = f"{content_hash}:{target}"
+    normalized = _normalized_cache.get(key)
+    if normalized is None:
+        normalized = normalize_bytes(data, max_side, multiple)
+        _normalized_cache.set(key, normalized)
+    return normalized, content_hash, target
@@ -1,62 +1,278 @@
 from dotenv import load_dotenv
-import torch
+import numpy as np
 from pathlib import Path
 import re
+import threading
+from collections import OrderedDict
 
 load_dotenv()
-from transformers import CLIPModel, CLIPProcessor
 from PIL import Image
 import time
 import os
 from core.Model import Model
+from core.ClipBackend import TEST_IMAGES_DIR, clip_threads, guarded_encoder
+from core.ClipIndex import ClipIndex, DEFAULT_INDEX_DIR
+from core.Instrumentation import get_recorder
+from core.VectorSearch import VectorSearch, CLIP_MIN_SCORE, balanced_accuracy, calibrate_threshold
 import gc
 
-# load
-# CPU or GPU
-device = "cuda" if torch.cuda.is_available() else "cpu"
-# load clip model
-model_clip = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
-processor_clip = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+CLIP_NAME = "openai/clip-vit-base-patch32"
+# taille des lots pour encoder l'album (à baisser sur les machines avec peu de RAM)
+CLIP_BATCH_SIZE = int(os.getenv("CLIP_BATCH_SIZE", "16"))
+# backend CPU des encodeurs CLIP : torch (FP32), int8, onnx ou compile (cf core/ClipBackend.py)
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "torch").strip() or "torch"
+
+# CLIP (torch + transformers) n'est chargé qu'au premier usage, une seule fois par process
+_clip = None
+_clip_encoder = None
+_clip_lock = threading.Lock()
+clip_load_time = None
+
+_clip_index = None
+# derniers moteurs de recherche construits : clé album -> VectorSearch
+SEARCH_ENGINES = 8
+_search_engines = OrderedDict()
+_search_lock = threading.Lock()
+
+# couples annotés de data/test pour calibrer CLIP_MIN_SCORE : questions qui décrivent chaque image, et questions
+# sans rapport avec aucune des images (le seuil doit les écarter)
+CALIBRATION_PAIRS = {
+    "bathroom.png": ["a bathroom sink", "a white sink and a mirror", "a toilet in a bathroom"],
+    "dog.png": ["a dog on a couch", "a dog"],
+    "dogs.png": ["two dogs playing", "dogs outside"],
+    "food.png": ["a plate of food", "food on a table"],
+    "garage.png": ["a garage door", "a garage"],
+}
+CALIBRATION_OFF_TOPIC = ["a red sports car on a highway", "a snowy mountain", "an airplane in the sky",
+                         "a person surfing a wave", "a city skyline at night", "a cat sleeping on a keyboard"]
+
+
+def get_clip():
+    """
+    Charge CLIP au premier appel (import de torch/transformers compris) et le garde pour tout le process
+    :return: (model_clip, processor_clip, device)
+    """
+    global _clip, _clip_encoder, clip_load_time
+    with _clip_lock:
+        if _clip is None:
+            start = time.perf_counter()
+            import torch
+            from transformers import CLIPModel, CLIPProcessor
+
+            threads = clip_threads()
+            if threads:
+                torch.set_num_threads(threads)
+            # CPU or GPU
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model_clip = CLIPModel.from_pretrained(CLIP_NAME).to(device)
+            model_clip.eval()
+            processor_clip = CLIPProcessor.from_pretrained(CLIP_NAME)
+            # backend choisi, s'il donne les mêmes résultats que FP32 sur data/test (sinon FP32)
+            _clip_encoder = guarded_encoder(CLIP_BACKEND, model_clip, processor_clip, device, CLIP_NAME, threads)
+            _clip = (model_clip, processor_clip, device)
+            clip_load_time = time.perf_counter() - start
+            print(f"CLIP chargé en {clip_load_time:.2f}s ({device}, {_clip_encoder.name})")
+        return _clip
+
+
+def get_clip_encoder():
+    """
+    Encodeur CLIP du backend actif : image(pixel_values) et text(input_ids, attention_mask) -> embeddings normalisés
+    """
+    get_clip()
+    return _clip_encoder
+
+
+def encode_images(images_path, batch_size=CLIP_BATCH_SIZE):
+    """
+    Encode des images avec CLIP et renvoie les embeddings normalisés L2 (np.ndarray [n, D])
+    Les images sont lues depuis le disque par lots de batch_size, sans autograd, et les tenseurs de pixels
+    sont libérés entre deux lots : la mémoire ne dépend pas de la taille de l'album.
+    :param images_path: liste de chemins
+    :param batch_size: nombre d'images encodées à la fois
+    :return:
+    """
+    _, processor_clip, device = get_clip()
+    encoder = get_clip_encoder()
+    recorder = get_recorder()
+    out = np.empty((len(images_path), encoder.dim), dtype=np.float32)
+
+    start = time.perf_counter()
+    for i in range(0, len(images_path), batch_size):
+        batch_paths = images_path[i:i + batch_size]
+        images = []
+        # on sépare lecture, prétraitement (resize / normalisation) et forward pour savoir où part le temps
+        with recorder.timer("clip_image_load", batch=len(batch_paths)):
+            for path in batch_paths:
+                with Image.open(path) as img:
+                    images.append(img.convert("RGB"))
+
+        with recorder.timer("clip_preprocess", batch=len(batch_paths)):
+            pixels = processor_clip(images=images, return_tensors="np")["pixel_values"]
+        with recorder.timer("clip_forward", batch=len(batch_paths), device=device, backend=encoder.name):
+            out[i:i + len(batch_paths)] = encoder.image(pixels)
+
+        # on libère les pixels avant le lot suivant
+        del images, pixels
+
+    duration = time.perf_counter() - start
+    if len(images_path) > 0:
+        print(f"CLIP : {len(images_path)} images encodées en {duration:.2f}s "
+              f"({len(images_path) / max(duration, 1e-9):.1f} images/s)")
+    return out
+
+
+def encode_text(text):
+    """
+    Encode un texte avec CLIP et renvoie l'embedding normalisé L2 (np.ndarray [D])
+    """
+    return encode_texts([text])[0]
+
+
+def encode_texts(texts):
+    """
+    Encode plusieurs textes en un seul forward CLIP (np.ndarray [n, D], normalisés L2)
+    """
+    _, processor_clip, device = get_clip()
+    encoder = get_clip_encoder()
+    recorder = get_recorder()
+    with recorder.timer("clip_text_preprocess", batch=len(texts)):
+        tokens = processor_clip(text=list(texts), return_tensors="np", padding=True, truncation=True)
+    with recorder.timer("clip_text_forward", device=device, batch=len(texts), backend=encoder.name):
+        return encoder.text(tokens["input_ids"], tokens["attention_mask"])
+
+
+def get_clip_index():
+    """
+    Index persistant des embeddings d'images (partagé par tout le process)
+    """
+    global _clip_index
+    # backend réellement utilisé (FP32 si le garde-fou a refusé CLIP_BACKEND)
+    backend = get_clip_encoder().name
+    with _search_lock:
+        if _clip_index is None:
+            # un index par backend, chacun dans son dossier : les embeddings int8 / ONNX ne sont pas mélangés
+            # avec ceux en FP32, et changer de backend ne réencode pas l'album déjà indexé par l'autre
+            name = CLIP_NAME if backend == "torch" else f"{CLIP_NAME}:{backend}"
+            _clip_index = ClipIndex(encode_images, index_dir=DEFAULT_INDEX_DIR / backend, model_name=name)
+        return _clip_index
+
+
+def get_search_engine(images_path):
+    """
+    Moteur de recherche top-k sur les embeddings de l'album, reconstruit seulement si l'album ou l'index change
+    (les SEARCH_ENGINES derniers albums sont gardés, pour le service partagé entre plusieurs sessions)
+    """
+    index = get_clip_index()
+    index.update(images_path)
+    key = (index.version, tuple(images_path))
+    with _search_lock:
+        engine = _search_engines.get(key)
+        if engine is not None:
+            _search_engines.move_to_end(key)
+            return engine
+    engine = VectorSearch(index.get(images_path))
+    with _search_lock:
+        _search_engines[key] = engine
+        while len(_search_engines) > SEARCH_ENGINES:
+            _search_engines.popitem(last=False)
+    return engine
+
+
+def calibrate_min_score(images_dir=TEST_IMAGES_DIR, pairs=None, off_topic=None):
+    """
+    Recalibre le seuil de similarité sur les images de data/test : les bons couples sont (question, son image),
+    les mauvais (question hors sujet, chaque image). Les images sont encodées sans passer par l'index.
+    :return: (seuil calibré, sa balanced accuracy, balanced accuracy de CLIP_MIN_SCORE)
+    """
+    pairs = pairs or CALIBRATION_PAIRS
+    off_topic = off_topic or CALIBRATION_OFF_TOPIC
+    names = list(pairs)
+    images = encode_images([str(Path(images_dir) / name) for name in names])
+    positive = np.concatenate([encode_texts(pairs[name]) @ images[i] for i, name in enumerate(names)])
+    negative = (encode_texts(off_topic) @ images.T).ravel()
+    threshold = calibrate_threshold(positive, negative)
+    current = balanced_accuracy(positive, negative, CLIP_MIN_SCORE)
+    return threshold, balanced_accuracy(positive, negative, threshold), current
+
+
+def search_clip(questions, images_path, k=5, min_score=CLIP_MIN_SCORE):
+    """
+    Renvoie les k images les plus proches de la question avec leur similarité cosinus brute
+    :param questions: prompt (déjà préprocessé)
+    :param images_path:
+    :param k: nombre d'images renvoyées
+    :param min_score: seuil de similarité cosinus, les images en dessous ne sont pas renvoyées
+    :return: liste de (chemin, score) triée par score décroissant
+    """
+    if len(images_path) == 0 or questions == "":
+        return []
+    return search_embedding(encode_text(questions), images_path, k=k, min_score=min_score)
 
 
-def analis_clip(questions, images_path, treshold=0.4):
+def search_embedding(query, images_path, k=5, min_score=CLIP_MIN_SCORE):
+    """
+    Comme search_clip avec la question déjà encodée (embedding normalisé [D])
+    """
+    recorder = get_recorder()
+    # mise à jour de l'index (encode seulement les images nouvelles ou modifiées)
+    with recorder.timer("clip_index_update"):
+        engine = get_search_engine(images_path)
+    with recorder.timer("clip_search", album=len(images_path)):
+        results = engine.search(query, k=k, min_score=min_score)
+    return [(images_path[i], score) for i, score in results]
+
+
+def analis_clip(questions, images_path, treshold=CLIP_MIN_SCORE):
     """
     Une fonction qui applqiue le modèle de clip (d'open-ai)et renvoies  la photo qui a le plus de chance de correspondre au prompt
+    Les embeddings des images viennent de l'index persistant : seules les images nouvelles ou modifiées sont encodées,
+    la question est encodée puis on fait une recherche top-k (cf search_clip).
     :param questions: prompt
     :param images_path:
-    :param treshold: le seuil de confiance
+    :param treshold: le seuil de confiance (similarité cosinus, indépendant de la taille de l'album)
     :return:
     """
-    images = [Image.open(path) for path in images_path]
-    if len(images) <= 1 or questions == "":
+    if len(images_path) <= 1 or questions == "":
         print("erreur il ya moins d'une image ou la question est vide")
     else:
-        inputs = processor_clip(text=questions, return_tensors="pt", images=images, padding=True).to(device)
-
-        # probs calcul
-        outputs = model_clip(**inputs)
-        probs = outputs.logits_per_image.softmax(dim=0)
-
-        best_idx = probs.argmax().item()
-        best_score = probs.max().item()
+        results = search_clip(questions, images_path, k=1, min_score=treshold)
 
         # si on est en dessous du seuil de confiance alors on ne renvoie rien
-        if best_score > treshold:
-
-            print(f"Image choisie : {images_path[best_idx]} (Confiance: {best_score:.2f})")
-            return images_path[best_idx]
+        if results:
+            best_img, best_score = results[0]
+            print(f"Image choisie : {best_img} (Score: {best_score:.2f})")
+            return best_img
         else:
             print("Pas de bonne image trouvé")
             return None
 
 
-def pipeline_rag(questions, images_path, model=os.getenv("DEFAULT_MODEL")):
+def run_inference(questions, image, model, cache=None):
+    """
+    Un appel au modèle ollama sur une image, lève une exception si le modèle n'a pas répondu
+    """
+    chat_model = Model(
+        model_name=model,
+        prompts=[questions],
+        imgs_path=[image],
+        coco_captions={},
+        cache=cache
+    )
+    res, _ = chat_model.execute(prompt_id=0, freq_print=0)
+    if not res:
+        raise RuntimeError(f"Pas de réponse du modèle {model} pour {image} : {'; '.join(res.failed.values())}")
+    return res[list(res.keys())[0]][0]
+
+
+def pipeline_rag(questions, images_path, model=os.getenv("DEFAULT_MODEL"), cache=None):
     """
     Une fonction qui devait faire toute la pipeline du RAG mais ensuite on a découpé en deux pour pouvoir
     affciher sur l'app
     :param questions:
     :param images_path:
     :param model:
+    :param cache: ResponseCache (None = cache partagé, False = pas de cache)
     :return:
     """
     prompt_clip = preprocess_prompt(questions)
@@ -65,35 +281,11 @@ def pipeline_rag(questions, images_path, model=os.getenv("DEFAULT_MODEL")):
     if best_img is None:
         return None, None
 
-    def run_inf(p):
-        chat_model = Model(
-            model_name=model,
-            prompts=[questions],
-            imgs_path=[p],
-            coco_captions={}
-        )
-        res, _ = chat_model.execute(prompt_id=0, freq_print=0)
-        return res[list(res.keys())[0]][0]
-
     try:
-        print("Try 1...")
-        bot_response = run_inf(best_img)
+        bot_response = run_inference(questions, best_img, model, cache)
     except Exception as e:
-        print(f"Err 1: {e}")
-        try:
-            print("Resize...")
-            with Image.open(best_img) as img:
-                # Force multiples de 28 (pour le décupage en patch)
-                new_img = img.resize((448, 448), Image.LANCZOS)
-                tmp = best_img.replace(".", "_tmp.")
-                new_img.save(tmp)
-                best_img = tmp
-
-            bot_response = run_inf(best_img)
-            print("Ok 2")
-        except Exception as e2:
-            print(f"Err 2: {e2}")
-            return None, best_img
+        print(f"Err: {e}")
+        return None, best_img
 
     gc.collect()
     print(f"response : {bot_response}")
@@ -114,50 +306,60 @@ def pipeline_clip(questions, images_path):
     return best_img
 
 
-def pipeline_model(questions, image, model=os.getenv("DEFAULT_MODEL")):
+def pipeline_clip_topk(questions, images_path, k=5):
+    """
+    Comme pipeline_clip mais renvoie les k meilleures images avec leur score
+    :param questions:
+    :param images_path:
+    :param k:
+    :return: liste de (chemin, score)
+    """
+    prompt_clip = preprocess_prompt(questions)
+    return search_clip(prompt_clip, images_path, k=k)
+
+
+def pipeline_model(questions, image, model=os.getenv("DEFAULT_MODEL"), cache=None, stream=False):
     """
     pipeline complète pour le modèle ollama
     :param questions:
     :param image:
     :param model:
+    :param cache: ResponseCache (None = cache partagé, False = pas de cache)
+    :param stream: si True renvoie un générateur de tokens (pour st.write_stream) au lieu de la réponse complète
     :return:
     """
+    if stream:
+        return stream_model(questions, image, model, cache)
 
-    def run_inf(p):
-        chat_model = Model(
-            model_name=model,
-            prompts=[questions],
-            imgs_path=[p],
-            coco_captions={}
-        )
-        res, _ = chat_model.execute(prompt_id=0, freq_print=0)
-        return res[list(res.keys())[0]][0]
-
-    # La on fait un try si l'image passe pas on redimenssionne puis on retente (c'est à cause de certains formats
-    # d'image (.webpng qui peuvent être mal encoé mais qu   nd m^mee s'appeler .png)
+    # l'image est transcodée / redimensionnée en mémoire avant l'envoi (core/preprocess.py),
+    # plus besoin de retenter avec une copie _tmp redimensionnée si le format passe mal
     try:
-        print("Try 1...")
-        bot_response = run_inf(image)
+        bot_response = run_inference(questions, image, model, cache)
     except Exception as e:
-        print(f"Err 1: {e}")
-        try:
-            print("Resize...")
-            with Image.open(image) as img:
-                # Force multiples de 28 (pour le décupage en patch)
-                new_img = img.resize((448, 448), Image.LANCZOS)
-                tmp = image.replace(".", "_tmp.")
-                new_img.save(tmp)
-                best_img = tmp
-
-            bot_response = run_inf(best_img)
-            print("Ok 2")
-        except Exception as e2:
-            print(f"Err 2: {e2}")
-            return "Ann error occured on the image size or type", best_img
+        print(f"Err: {e}")
+        return "Ann error occured on the image size or type"
     print(f"response : {bot_response}")
     return bot_response
 
 
+def stream_model(questions, image, model=os.getenv("DEFAULT_MODEL"), cache=None):
+    """
+    Générateur des tokens de la réponse du modèle ollama, au fur et à mesure qu'ils arrivent
+    """
+    chat_model = Model(
+        model_name=model,
+        prompts=[questions],
+        imgs_path=[image],
+        coco_captions={},
+        cache=cache
+    )
+    try:
+        yield from chat_model.stream(prompt_id=0)
+    except Exception as e:
+        print(f"Err: {e}")
+        yield "Ann error occured on the image size or type"
+
+
 def preprocess_prompt(prompt):
     """
     preprocess prompt for CLIP on met en minuscule et on enlève les caractères spéciaux
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_INDEX_DIR = Path(__file__).resolve().parent.parent / "data" / "cache" / "chair_index"
+
+
+class ChairIndex:
+    """
+    Index compact des objets présents dans chaque image COCO, pour CHAIR.
+        - ids.npy   : ids des images triés (int64)
+        - masks.npy : masque de 80 bits par image (2 x uint64), bit k = la catégorie k est annotée dans l'image
+        - categories.json : noms des catégories dans l'ordre des bits
+    Construit une seule fois à partir de instances_val2017.json, puis ouvert en memory-map.
+    """
+
+    def __init__(self, ids, masks, categories):
+        self.ids = ids
+        self.masks = masks
+        self.categories = categories
+        self.cat_index = {name: k for k, name in enumerate(categories)}
+
+    @classmethod
+    def build(cls, instances_path, index_dir):
+        """Lit le json des instances (lent, une seule fois) et écrit l'index."""
+        print(f"Construction de l'index CHAIR depuis {instances_path}...")
+        stat = os.stat(instances_path)
+        with open(instances_path, 'r') as f:
+            data = json.load(f)
+
+        categories = [c['name'] for c in sorted(data['categories'], key=lambda c: c['id'])]
+        if len(categories) > 128:
+            raise ValueError("L'index CHAIR supporte 128 catégories au maximum")
+        bit_of = {c['id']: k for k, c in enumerate(sorted(data['categories'], key=lambda c: c['id']))}
+
+        ids = np.array(sorted({img['id'] for img in data['images']} |
+                              {ann['image_id'] for ann in data['annotations']}), dtype=np.int64)
+        row_of = {int(i): r for r, i in enumerate(ids)}
+        masks = np.zeros((len(ids), 2), dtype=np.uint64)
+        for ann in data['annotations']:
+            k = bit_of[ann['category_id']]
+            masks[row_of[ann['image_id']], k // 64] |= np.uint64(1 << (k % 64))
+        del data
+
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / "ids.npy", ids)
+        np.save(index_dir / "masks.npy", masks)
+        with open(index_dir / "categories.json", "w", encoding="utf-8") as f:
+            json.dump({"source": str(instances_path), "size": stat.st_size, "mtime": stat.st_mtime,
+                       "categories": categories}, f)
+        return cls(ids, masks, categories)
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = Path(index_dir)
+        with open(index_dir / "categories.json", "r", encoding="utf-8") as f:
+            categories = json.load(f)["categories"]
+        ids = np.load(index_dir / "ids.npy", mmap_mode="r")
+        masks = np.load(index_dir / "masks.npy", mmap_mode="r")
+        return cls(ids, masks, categories)
+
+    @classmethod
+    def load_or_build(cls, instances_path, index_dir=None):
+        """
+        Charge l'index s'il existe (un dossier par fichier d'instances), sinon le construit.
+        Il est reconstruit si le fichier d'instances a changé depuis (taille ou date de modification).
+        """
+        index_dir = Path(index_dir) if index_dir else DEFAULT_INDEX_DIR / Path(instances_path).stem
+        if (index_dir / "masks.npy").exists() and (index_dir / "categories.json").exists():
+            with open(index_dir / "categories.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            stat = os.stat(instances_path)
+            if meta.get("size") == stat.st_size and meta.get("mtime") == stat.st_mtime:
+                return cls.load(index_dir)
+            print("Fichier d'instances modifié, on reconstruit l'index CHAIR.")
+        return cls.build(instances_path, index_dir)
+
+    def rows(self, img_ids):
+        """Ligne de chaque image dans l'index (-1 si l'image n'est pas annotée)."""
+        img_ids = np.asarray(img_ids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, img_ids)
+        pos = np.clip(pos, 0, len(self.ids) - 1)
+        found = np.asarray(self.ids[pos]) == img_ids
+        return np.where(found, pos, -1)
+
+    def contains(self, img_ids, cat_ids):
+        """
+        Test de bits vectorisé : pour chaque couple (image, catégorie) dit si la catégorie est dans l'image.
+        :param img_ids: ids d'images (COCO)
+        :param cat_ids: indices de catégories (cf cat_index), même longueur
+        """
+        rows = self.rows(img_ids)
+        cat_ids = np.asarray(cat_ids, dtype=np.int64)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=bool)
+        words = np.asarray(self.masks[np.maximum(rows, 0), cat_ids // 64])
+        bits = (words >> (cat_ids % 64).astype(np.uint64)) & np.uint64(1)
+        return (bits == 1) & (rows >= 0)
+
+    def objects(self, img_id):
+        """Noms des catégories présentes dans une image (set vide si inconnue)."""
+        try:
+            row = int(self.rows([img_id])[0])
+        except (TypeError, ValueError):
+            return set()
+        if row < 0:
+            return set()
+        lo, hi = (int(w) for w in self.masks[row])
+        mask = lo | (hi << 64)
+        return {name for k, name in enumerate(self.categories) if mask >> k & 1}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_chair_index(instances_path):
+    """
+    Index partagé par tout le process (un par fichier d'instances).
+    """
+    key = os.path.abspath(str(instances_path))
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = ChairIndex.load_or_build(instances_path)
+        return _indexes[key]
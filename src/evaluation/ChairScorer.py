@@ -1,7 +1,90 @@
-import json
 import string
 import os
 
+import numpy as np
+
+from evaluation.ChairIndex import get_chair_index
+
+# pluriels que les règles simples (+s, +es, y -> ies) ne savent pas faire
+IRREGULAR_PLURALS = {
+    "person": "people", "man": "men", "woman": "women", "child": "children",
+    "mouse": "mice", "knife": "knives", "foot": "feet", "tooth": "teeth",
+    "goose": "geese", "leaf": "leaves", "shelf": "shelves", "wolf": "wolves",
+}
+
+
+def plural_forms(word, irregular=IRREGULAR_PLURALS):
+    """Formes plurielles possibles d'un mot anglais."""
+    forms = set()
+    if word in irregular:
+        forms.add(irregular[word])
+    if word.endswith(("s", "x", "z", "ch", "sh")):
+        forms.add(word + "es")
+    elif word.endswith("y") and len(word) > 1 and word[-2] not in "aeiou":
+        forms.add(word[:-1] + "ies")
+    else:
+        forms.add(word + "s")
+    forms.discard(word)
+    return forms
+
+
+class ObjectMatcher:
+    """
+    Recherche multi-motifs par trie de mots : tous les synonymes (et leurs pluriels) sont compilés une fois
+    dans un trie, puis chaque légende est parcourue de gauche à droite en gardant la correspondance la plus
+    longue ('stop sign' plutôt que 'sign', 'hot dog' plutôt que 'dog').
+    """
+
+    _END = object()
+
+    def __init__(self, synonyms, irregular_plurals=None):
+        irregular = dict(IRREGULAR_PLURALS)
+        irregular.update(irregular_plurals or {})
+        self.trie = {}
+        self.max_len = 0
+        self.punct = str.maketrans('', '', string.punctuation)
+
+        for phrase, target in synonyms.items():
+            words = phrase.split()
+            self._add(words, target)
+            # pluriel sur le dernier mot ('traffic lights', 'hot dogs')
+            for plural in plural_forms(words[-1], irregular):
+                # un pluriel ne doit pas écraser un synonyme qui existe déjà (ex: 'glasses')
+                if " ".join(words[:-1] + [plural]) not in synonyms:
+                    self._add(words[:-1] + [plural], target)
+
+    def _add(self, words, target):
+        node = self.trie
+        for w in words:
+            node = node.setdefault(w, {})
+        node[self._END] = target
+        self.max_len = max(self.max_len, len(words))
+
+    def extract(self, text):
+        words = text.lower().translate(self.punct).split()
+        found = []
+        i, n = 0, len(words)
+        while i < n:
+            node, best, best_end = self.trie, None, i
+            j = i
+            while j < n and j - i < self.max_len:
+                node = node.get(words[j])
+                if node is None:
+                    break
+                j += 1
+                if self._END in node:
+                    best, best_end = node[self._END], j
+            if best is not None:
+                found.append(best)
+                i = best_end
+            else:
+                i += 1
+        return found
+
+    def extract_batch(self, captions):
+        return [self.extract(c) for c in captions]
+
+
 class ChairScorer:
     """
     CHAIR (Caption Hallucination Assessment with Image Relevance)
@@ -10,117 +93,130 @@ class ChairScorer:
         (basé sur la liste d'objets connus par exemple grace une segmentation).
     """
 
-    def __init__(self, instances_path, synonyms_path):
+    def __init__(self, instances_path, synonyms_path, irregular_plurals=None):
         """
         Initialise le calculateur CHAIR.
         :param instances_path: Chemin vers instances_val2017.json
         :param synonyms_path: Chemin vers coco_synonyms_SOTA.txt
+        :param irregular_plurals: dict singulier -> pluriel en plus de IRREGULAR_PLURALS
         """
-        self.coco_objects = self._load_coco_data(instances_path)
+        # index compact image -> masque de catégories, construit une fois puis partagé (cf ChairIndex)
+        self.index = get_chair_index(instances_path)
         self.synonyms = self._load_synonyms(synonyms_path)
+        # matcher multi-motifs compilé une fois à partir des synonymes
+        self.matcher = ObjectMatcher(self.synonyms, irregular_plurals=irregular_plurals)
 
     def _load_synonyms(self, path):
-        """Charge le fichier texte de mapping mot -> catégorie"""
+        """
+        Charge le fichier texte de mapping synonyme -> catégorie.
+        Chaque ligne est 'source cible' où source et cible peuvent avoir plusieurs mots
+        (ex: 'stop light traffic light'). La cible est le plus long suffixe qui est une catégorie COCO.
+        """
         if not os.path.exists(path):
             raise FileNotFoundError(f"Fichier de synonymes introuvable : {path}")
-            
+
+        categories = set(self.index.categories)
         mapping = {}
         with open(path, 'r', encoding='utf-8') as f:
             for line in f:
-                parts = line.strip().split()
-                if len(parts) >= 2:
-                    # Le dernier mot est la catégorie cible (ex: 'traffic light')
-                    # Les mots avant sont le synonyme (ex: 'stop light')
-                    # Mais pour simplifier le format txt ci-dessus, on suppose souvent 
-                    # mot_source -> mot_cible_coco (qui peut avoir des espaces)
-                    
-                    # Pour notre format simple : le dernier token est la target, le reste est la source
-                    # Mais attention, 'traffic light' (COCO) a un espace.
-                    # Astuce : On va charger intelligemment.
-                    
-                    # Cas simple du fichier fourni :
-                    # col 1 = source, col 2...N = target
-                    source = parts[0]
-                    target = " ".join(parts[1:])
-                    mapping[source] = target
+                parts = line.strip().lower().split()
+                if len(parts) < 2:
+                    continue
+                split = next((k for k in range(1, len(parts)) if " ".join(parts[k:]) in categories), None)
+                if split is None:
+                    # cible inconnue : ancien format, 1er mot = source, le reste = cible
+                    split = 1
+                mapping[" ".join(parts[:split])] = " ".join(parts[split:])
         return mapping
 
-    def _load_coco_data(self, instances_path):
-        with open(instances_path, 'r') as f:
-            data = json.load(f)
-        
-        cats = {c['id']: c['name'] for c in data['categories']}
-        img_to_objs = {}
-        
-        for ann in data['annotations']:
-            img_id = ann['image_id']
-            cat_name = cats[ann['category_id']]
-            if img_id not in img_to_objs:
-                img_to_objs[img_id] = set()
-            img_to_objs[img_id].add(cat_name)
-            
-        return img_to_objs
-
     def _extract_objects(self, text):
         """
-        Extrait les objets en gérant les mots simples et les mots composés (doublets).
+        Extrait les objets d'une légende (n-grammes de toute longueur, correspondance la plus longue, pluriels).
         """
-        # Nettoyage
-        text = text.lower().translate(str.maketrans('', '', string.punctuation))
-        words = text.split()
-        
-        found_objects = []
-        skip_next = False
-        
-        # On parcourt les mots pour trouver des correspondances
-        for i in range(len(words)):
-            if skip_next:
-                skip_next = False
-                continue
-                
-            # 1. Essayer les mots composés (ex: "hot dog", "traffic light")
-            if i < len(words) - 1:
-                doublet = f"{words[i]} {words[i+1]}"
-                if doublet in self.synonyms:
-                    found_objects.append(self.synonyms[doublet])
-                    skip_next = True # On saute le prochain mot car déjà utilisé
-                    continue
-            
-            # 2. Essayer le mot simple
-            w = words[i]
-            if w in self.synonyms:
-                found_objects.append(self.synonyms[w])
-            # Gestion basique du pluriel 's' si pas dans le dict
-            elif w.endswith('s') and w[:-1] in self.synonyms:
-                found_objects.append(self.synonyms[w[:-1]])
-                
-        return found_objects
+        return self.matcher.extract(text)
+
+    def extract_batch(self, captions):
+        """
+        Extrait les objets de toutes les légendes d'un coup (ex: toutes celles d'un sweep).
+        """
+        return self.matcher.extract_batch(captions)
+
+    @staticmethod
+    def _coco_id(img_id):
+        # les images hors COCO (ids texte) n'ont aucun objet annoté
+        try:
+            return int(img_id)
+        except (TypeError, ValueError):
+            return -1
+
+    def _mentions(self, model_responses):
+        """
+        Objets mentionnés dans la 1ère légende de chaque image, avec pour chacun s'il est présent dans l'image.
+        :return: {img_id: (liste des objets, np.array de booléens 'présent')}
+        """
+        items = [(img_id, captions[0]) for img_id, captions in model_responses.items() if captions]
+        objects = self.extract_batch([caption for _, caption in items])
+
+        img_ids, cat_ids = [], []
+        for (img_id, _), objs in zip(items, objects):
+            coco_id = self._coco_id(img_id)
+            for obj in objs:
+                img_ids.append(coco_id)
+                cat_ids.append(self.index.cat_index.get(obj, -1))
+
+        # test de bits vectorisé sur l'index (un objet hors catégories COCO compte comme halluciné)
+        img_ids = np.array(img_ids, dtype=np.int64)
+        cat_ids = np.array(cat_ids, dtype=np.int64)
+        known = cat_ids >= 0
+        present = np.zeros(len(cat_ids), dtype=bool)
+        present[known] = self.index.contains(img_ids[known], cat_ids[known])
+
+        mentions = {}
+        start = 0
+        for (img_id, _), objs in zip(items, objects):
+            mentions[img_id] = (objs, present[start:start + len(objs)])
+            start += len(objs)
+        return mentions
 
     def compute_score(self, model_responses):
         """
         Calcul les scores CHAIR.
         model_responses: Dictionnaire {img_id: ["caption"]}
         """
-        hallucinated_objects = 0
-        total_objects = 0
-        
-        for img_id, captions in model_responses.items():
-            if not captions: continue
-            
-            caption = captions[0]
-            
-            gt_objects = self.coco_objects.get(img_id, set())
-            generated_objects = self._extract_objects(caption)
-            
-            for obj in generated_objects:
-                total_objects += 1
-                if obj not in gt_objects:
-                    hallucinated_objects += 1
-            
+        mentions = self._mentions(model_responses)
+        total_objects = sum(len(objs) for objs, _ in mentions.values())
+        hallucinated_objects = sum(int((~present).sum()) for _, present in mentions.values())
+
         chair_score = (hallucinated_objects / total_objects) if total_objects > 0 else 0.0
-        
+
         return chair_score
-    
+
+    def compute_per_image(self, model_responses):
+        """
+        CHAIR par image.
+            CHAIR_i : part des objets mentionnés qui ne sont pas dans l'image
+            CHAIR_s : 1 si la légende contient au moins un objet halluciné
+        :return: (agrégat {"CHAIR_i", "CHAIR_s"}, {img_id: {"CHAIR_i", "CHAIR_s", "mentioned", "hallucinated"}})
+        """
+        mentions = self._mentions(model_responses)
+        per_image = {}
+        for img_id, (objs, present) in mentions.items():
+            hallucinated = [o for o, p in zip(objs, present) if not p]
+            per_image[img_id] = {
+                "CHAIR_i": len(hallucinated) / len(objs) if objs else 0.0,
+                "CHAIR_s": 1.0 if hallucinated else 0.0,
+                "mentioned": objs,
+                "hallucinated": hallucinated,
+            }
+
+        total_objects = sum(len(v["mentioned"]) for v in per_image.values())
+        total_hallucinated = sum(len(v["hallucinated"]) for v in per_image.values())
+        aggregate = {
+            "CHAIR_i": total_hallucinated / total_objects if total_objects else 0.0,
+            "CHAIR_s": sum(v["CHAIR_s"] for v in per_image.values()) / len(per_image) if per_image else 0.0,
+        }
+        return aggregate, per_image
+
     def test(self, model_responses):
         hallucinated_objects = 0
         total_objects = 0
@@ -131,7 +227,7 @@ class ChairScorer:
             # On prend la première caption par défaut
             caption = captions[0]
             
-            gt_objects = self.coco_objects.get(img_id, set())
+            gt_objects = self.index.objects(self._coco_id(img_id))
             print(f"GROUND TRUTH objects in image : {gt_objects}")
             generated_objects = self._extract_objects(caption)
             print(f"RESPONSE objects in image : {generated_objects}")
@@ -1,6 +1,9 @@
+import atexit
 import os
 import subprocess
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 class MeteorScorer:
     """
@@ -8,15 +11,21 @@ class MeteorScorer:
         Corrige la rigidité de BLEU. Prend en compte les correspondances exacts, mais aussi le stemming (racine des mots) et les synonymes.
         Additionellement il regarde l'ordre des mots pour évaluer sur le sens de la phrase : "Le chat mange la souris" vs "La souris mange le chat".
         Charge les synonymes via WordNet ce qu'il fait via Java.
+
+    Protocole -stdio de meteor-1.5 :
+        "SCORE ||| ref1 ||| ref2 ||| hyp"  -> 1 ligne : les stats du segment (nombres séparés par des espaces)
+        "EVAL ||| stats1 ||| ... ||| statsN" -> N lignes (score de chaque segment) puis 1 ligne : le score du corpus
+    On lit exactement ce nombre de lignes, sinon on se désynchronise (c'était le bug du '14.0 9.0...').
+    cancel (threading.Event) : un calcul dont l'event est levé s'arrête, cf cancel().
     """
 
     def __init__(self, java_path="java"):
         import pycocoevalcap.meteor.meteor as meteor_script_module
-        
+
         # On importe le .jar
         base_path = os.path.dirname(os.path.abspath(meteor_script_module.__file__))
         self.meteor_jar = os.path.join(base_path, 'meteor-1.5.jar')
-        
+
         if not os.path.exists(self.meteor_jar):
              potential = os.path.join(base_path, 'data', 'meteor-1.5.jar')
              if os.path.exists(potential):
@@ -27,18 +36,58 @@ class MeteorScorer:
 
         # on alloue 2G de ram à meteor pour eviter les crashs.
         self.meteor_cmd = [
-            java_path, '-Duser.language=en', '-Duser.country=US', 
-            '-jar', '-Xmx2G', self.meteor_jar, 
+            str(java_path), '-Duser.language=en', '-Duser.country=US',
+            '-jar', '-Xmx2G', self.meteor_jar,
             '-', '-', '-stdio', '-l', 'en', '-norm'
         ]
 
+        self.process = None
+        self.lock = threading.Lock()
+        # event du calcul en cours, protégé par son propre verrou (self.lock est tenu pendant tout le calcul)
+        self.active = None
+        self.active_lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        # stderr n'est pas lu : on le jette pour que le pipe ne se remplisse pas et ne bloque pas java
         self.process = subprocess.Popen(
             self.meteor_cmd,
             cwd=os.path.dirname(self.meteor_jar),
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=os.environ 
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            env=os.environ
         )
-        self.lock = threading.Lock()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    @contextmanager
+    def _serving(self, cancel):
+        with self.lock:
+            with self.active_lock:
+                self.active = cancel
+            try:
+                if not self.alive():
+                    self._start()
+                yield
+            finally:
+                with self.active_lock:
+                    self.active = None
+
+    def _check(self, cancel):
+        if cancel is not None and cancel.is_set():
+            # la JVM a pu être tuée au milieu d'une réponse : elle sera relancée au prochain appel
+            self.close()
+            raise RuntimeError("Calcul METEOR annulé")
+
+    def cancel(self, cancel):
+        """
+        Tue la JVM si elle travaille pour ce calcul (cancel doit déjà être levé) : la lecture en cours échoue
+        et le verrou est libéré, l'appel suivant repart sur une JVM neuve au lieu d'attendre ou de lire sa sortie.
+        """
+        with self.active_lock:
+            process = self.process
+            if self.active is cancel and process is not None:
+                process.kill()
 
     def _clean_input(self, text):
         """Nettoyage agressif pour éviter la désynchronisation"""
@@ -46,47 +95,66 @@ class MeteorScorer:
         # Supprime sauts de ligne et séparateurs METEOR
         return text.replace('\n', ' ').replace('\r', ' ').replace('|||', '').strip()
 
+    def _send(self, line):
+        self.process.stdin.write(f"{line}\n".encode('utf-8'))
+        self.process.stdin.flush()
+
+    def _readline(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("Le process METEOR s'est arrêté")
+        return line.decode('utf-8').strip()
+
     def _stat(self, hypothesis_str, reference_list):
         hypothesis_str = self._clean_input(hypothesis_str)
         reference_list = [self._clean_input(ref) for ref in reference_list]
-        
+
         score_line = ' ||| '.join(('SCORE', ' ||| '.join(reference_list), hypothesis_str))
-        
-        self.process.stdin.write(f"{score_line}\n".encode('utf-8'))
-        self.process.stdin.flush()
-        return self.process.stdout.readline().decode('utf-8').strip()
+        self._send(score_line)
+        stat = self._readline()
+        # une ligne de stats ne contient que des nombres
+        [float(x) for x in stat.split()]
+        return stat
 
-    def compute_score(self, gts, res):
-        imgIds = sorted(list(gts.keys()))
-        eval_line = 'EVAL'
-        
-        with self.lock:
-            for i in imgIds:
+    def stats(self, gts, res, img_ids, cancel=None):
+        """
+        Stats METEOR de chaque segment (dans l'ordre de img_ids). Redémarre la JVM si elle est morte.
+        """
+        out = []
+        with self._serving(cancel):
+            for i in img_ids:
+                self._check(cancel)
                 try:
-                    stat = self._stat(res[i][0], gts[i])
-                    eval_line += ' ||| {}'.format(stat)
+                    out.append(self._stat(res[i][0], gts[i]))
                 except Exception:
-                    # Stat vide si une image plante
-                    eval_line += ' ||| 0.0'
-
-            self.process.stdin.write(f"{eval_line}\n".encode('utf-8'))
-            self.process.stdin.flush()
-            
-            score_str = self.process.stdout.readline().decode('utf-8').strip()
-            
-            # Gestion des réponses parasites (le bug du '14.0 9.0...')
-            if " " in score_str: 
-                # On essaie de lire la ligne suivante, parfois le score est caché derrière
-                try:
-                    next_line = self.process.stdout.readline().decode('utf-8').strip()
-                    if next_line and " " not in next_line: score_str = next_line
-                except: 
-                    pass
+                    self._check(cancel)
+                    # Stat vide si une image plante (on relance java si c'est lui qui est tombé)
+                    out.append(None)
+                    if not self.alive():
+                        self._start()
+        return out
 
+    def evaluate(self, stats, cancel=None):
+        """
+        Score du corpus à partir des stats de tous les segments.
+        :return: (score du corpus, liste des scores par segment)
+        """
+        stats = [s for s in stats if s is not None]
+        if not stats:
+            raise RuntimeError("Aucune stat METEOR calculée")
+        with self._serving(cancel):
+            self._check(cancel)
             try:
-                return float(score_str.replace(',', '.')), []
-            except:
-                return 0.0, []
+                self._send(' ||| '.join(['EVAL'] + stats))
+                segment_scores = [float(self._readline()) for _ in stats]
+                return float(self._readline().replace(',', '.')), segment_scores
+            except Exception:
+                self._check(cancel)
+                raise
+
+    def compute_score(self, gts, res, cancel=None):
+        imgIds = sorted(list(gts.keys()))
+        return self.evaluate(self.stats(gts, res, imgIds, cancel), cancel)
 
     def close(self):
         if self.process:
@@ -94,6 +162,70 @@ class MeteorScorer:
                 self.process.kill()
                 self.process.wait()
             except: pass
-    
+            self.process = None
+
     def __del__(self):
-        self.close()
\ No newline at end of file
+        self.close()
+
+
+class MeteorPool:
+    """
+    Pool de JVM METEOR gardées ouvertes entre les appels (WordNet n'est chargé qu'une fois par JVM).
+    Les images sont réparties entre les JVM pour calculer les stats en parallèle, puis toutes les stats
+    sont fusionnées dans un seul EVAL : le score du corpus est le même qu'avec une seule JVM.
+    """
+
+    def __init__(self, java_path="java", size=2):
+        self.java_path = java_path
+        self.workers = [MeteorScorer(java_path=java_path) for _ in range(size)]
+
+    def compute_score(self, gts, res, cancel=None):
+        imgIds = sorted(list(gts.keys()))
+        n = len(self.workers)
+        shards = [imgIds[k::n] for k in range(n)]
+
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            shard_stats = list(pool.map(lambda k: self.workers[k].stats(gts, res, shards[k], cancel), range(n)))
+
+        # on remet les stats dans l'ordre des imgIds
+        stats_by_id = {}
+        for shard, stats in zip(shards, shard_stats):
+            stats_by_id.update(zip(shard, stats))
+        return self.workers[0].evaluate([stats_by_id[i] for i in imgIds], cancel)
+
+    def cancel(self, cancel):
+        for worker in self.workers:
+            worker.cancel(cancel)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_meteor_pool(java_path="java", size=2):
+    """
+    Pool partagé par tout le process (un par couple java_path / taille), fermé à la sortie de python.
+    """
+    key = (str(java_path), size)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = MeteorPool(java_path=java_path, size=size)
+        return _pools[key]
+
+
+def cancel_meteor(cancel):
+    """
+    Arrête le calcul METEOR de l'event cancel (levé avant l'appel) dans tous les pools, cf Scorer.compute_scores.
+    """
+    for pool in list(_pools.values()):
+        pool.cancel(cancel)
+
+
+@atexit.register
+def _close_pools():
+    for pool in _pools.values():
+        pool.close()
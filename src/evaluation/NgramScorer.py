@@ -0,0 +1,245 @@
+import math
+import threading
+
+import numpy as np
+from scipy import sparse
+
+from evaluation.ReferenceCorpus import ReferenceCorpus, ngram_counts, sanitize_text
+
+
+class NgramScorer:
+    """
+    Moteur CIDEr-D / BLEU vectorisé sur des matrices creuses de comptes de n-grammes.
+        - construit une fois à partir d'un ReferenceCorpus : vocabulaire des n-grammes des références,
+          matrice tf-idf des références, normes, longueurs et comptes max par image (pour BLEU)
+        - l'IDF de CIDEr vient des document frequencies de tout le corpus (ex: COCO val2017 entier),
+          le score d'une image ne dépend donc plus des autres images évaluées dans le même batch
+        - côté candidats on ne fait que compter les n-grammes, le reste est fait en opérations creuses
+
+    Mêmes formules que pycocoevalcap (CIDEr-D : clipping + pénalité de longueur gaussienne, x10 ;
+    BLEU : longueur de référence 'closest'). Avec un corpus réduit aux images évaluées on retrouve exactement
+    les scores de pycocoevalcap, cf parity_check.
+    """
+
+    def __init__(self, corpus, n=4, sigma=6.0):
+        self.n = n
+        self.sigma = sigma
+        self.corpus = corpus
+
+        # 1. vocabulaire et matrice des comptes des références (une ligne par légende)
+        self.vocab = {}
+        rows, cols, vals = [], [], []
+        max_rows, max_cols, max_vals = [], [], []
+        self.ref_span = {}
+        ref_len, ref_blen = [], []
+        r = 0
+        for img_row, img_id in enumerate(corpus.refs):
+            start = r
+            max_counts = {}
+            for counts, length in zip(corpus.counts[img_id], corpus.lengths[img_id]):
+                for ngram, count in counts.items():
+                    col = self.vocab.setdefault(ngram, len(self.vocab))
+                    rows.append(r)
+                    cols.append(col)
+                    vals.append(count)
+                    if count > max_counts.get(col, 0):
+                        max_counts[col] = count
+                ref_len.append(length)
+                # comme pycocoevalcap, la "longueur" CIDEr est le nombre de bigrammes
+                ref_blen.append(max(length - 1, 0))
+                r += 1
+            self.ref_span[img_id] = (img_row, start, r)
+            max_rows.extend([img_row] * len(max_counts))
+            max_cols.extend(max_counts.keys())
+            max_vals.extend(max_counts.values())
+
+        V = len(self.vocab)
+        self.ref_counts = sparse.csr_matrix((np.array(vals, dtype=np.float64), (rows, cols)), shape=(r, V))
+        self.ref_max = sparse.csr_matrix((np.array(max_vals, dtype=np.float64), (max_rows, max_cols)),
+                                         shape=(len(corpus.refs), V))
+        self.ref_len = np.array(ref_len, dtype=np.float64)
+        self.ref_blen = np.array(ref_blen, dtype=np.float64)
+
+        # matrice [V, n] qui somme les colonnes par ordre de n-gramme
+        order = np.empty(V, dtype=np.int64)
+        for ngram, col in self.vocab.items():
+            order[col] = len(ngram) - 1
+        self.by_order = sparse.csr_matrix((np.ones(V), (np.arange(V), order)), shape=(V, n))
+
+        # 2. idf sur tout le corpus : log(N images) - log(max(1, df))
+        self.log_n = np.log(float(len(corpus.refs)))
+        df = np.array([corpus.df.get(ngram, 0) for ngram in self._ngrams_by_col()], dtype=np.float64)
+        self.idf = self.log_n - np.log(np.maximum(1.0, df))
+
+        self.ref_tfidf = self.ref_counts.multiply(self.idf[None, :]).tocsr()
+        self.ref_norm = np.sqrt((self.ref_tfidf.power(2) @ self.by_order).toarray())
+
+    def _ngrams_by_col(self):
+        ngrams = [None] * len(self.vocab)
+        for ngram, col in self.vocab.items():
+            ngrams[col] = ngram
+        return ngrams
+
+    def _cook_candidates(self, captions):
+        """
+        Matrice creuse des comptes des candidats (n-grammes du vocabulaire), plus ce qui sort du vocabulaire :
+        contribution à la norme tf-idf (df = 0 => poids log N), longueur en mots et en bigrammes.
+        """
+        rows, cols, vals = [], [], []
+        oov_sq = np.zeros((len(captions), self.n))
+        lengths = np.zeros(len(captions))
+        for i, caption in enumerate(captions):
+            words = caption.split()
+            lengths[i] = len(words)
+            for ngram, count in ngram_counts(words, self.n).items():
+                col = self.vocab.get(ngram)
+                if col is None:
+                    oov_sq[i, len(ngram) - 1] += (count * self.log_n) ** 2
+                else:
+                    rows.append(i)
+                    cols.append(col)
+                    vals.append(count)
+        counts = sparse.csr_matrix((np.array(vals, dtype=np.float64), (rows, cols)),
+                                   shape=(len(captions), len(self.vocab)))
+        return counts, oov_sq, lengths
+
+    def _pairs(self, img_ids):
+        """Pour chaque couple (candidat, légende de référence) : indice du candidat et ligne de la référence."""
+        cand_idx, ref_idx, img_rows = [], [], []
+        for i, img_id in enumerate(img_ids):
+            img_row, start, end = self.ref_span[img_id]
+            cand_idx.extend([i] * (end - start))
+            ref_idx.extend(range(start, end))
+            img_rows.append(img_row)
+        return np.array(cand_idx, dtype=np.int64), np.array(ref_idx, dtype=np.int64), np.array(img_rows, dtype=np.int64)
+
+    def _prepare(self, res):
+        img_ids = [i for i in res if i in self.ref_span]
+        missing = [i for i in res if i not in self.ref_span]
+        if missing:
+            raise KeyError(f"Images absentes du corpus de référence : {missing[:5]}")
+        captions = [sanitize_text(res[i][0]) for i in img_ids]
+        return img_ids, captions
+
+    def cider(self, res):
+        """
+        CIDEr-D de chaque candidat contre les références du corpus.
+        :param res: Dictionnaire {image_id: [caption_generee]}
+        :return: (score moyen, np.array des scores par image dans l'ordre de res)
+        """
+        img_ids, captions = self._prepare(res)
+        counts, oov_sq, lengths = self._cook_candidates(captions)
+        cand_idx, ref_idx, _ = self._pairs(img_ids)
+
+        hyp = counts.multiply(self.idf[None, :]).tocsr()
+        hyp_norm = np.sqrt((hyp.power(2) @ self.by_order).toarray() + oov_sq)
+        hyp_blen = np.maximum(lengths - 1, 0)
+
+        # somme de min(hyp, ref) * ref par ordre de n-gramme, pour tous les couples d'un coup
+        h = hyp[cand_idx]
+        r = self.ref_tfidf[ref_idx]
+        overlap = (h.minimum(r).multiply(r) @ self.by_order).toarray()
+
+        denom = hyp_norm[cand_idx] * self.ref_norm[ref_idx]
+        val = np.divide(overlap, denom, out=overlap.copy(), where=denom != 0)
+        delta = hyp_blen[cand_idx] - self.ref_blen[ref_idx]
+        val *= np.exp(-(delta ** 2) / (2 * self.sigma ** 2))[:, None]
+
+        pair_score = val.mean(axis=1)
+        n_refs = np.bincount(cand_idx, minlength=len(img_ids))
+        scores = np.bincount(cand_idx, weights=pair_score, minlength=len(img_ids)) / n_refs * 10.0
+        return float(np.mean(scores)), scores
+
+    def bleu(self, res):
+        """
+        BLEU 1 à 4 du corpus (longueur de référence 'closest', comme pycocoevalcap).
+        :return: (liste des scores BLEU-1..4 du corpus, liste par ordre des scores par image)
+        """
+        small, tiny = 1e-9, 1e-15
+        img_ids, captions = self._prepare(res)
+        counts, _, testlen = self._cook_candidates(captions)
+        cand_idx, ref_idx, img_rows = self._pairs(img_ids)
+
+        # n-grammes corrects : min(compte candidat, compte max dans une référence)
+        correct = (counts.minimum(self.ref_max[img_rows]) @ self.by_order).toarray()
+        guess = np.maximum(0, testlen[:, None] - np.arange(self.n)[None, :])
+
+        # longueur de référence la plus proche (à égalité la plus courte)
+        ref_lens = self.ref_len[ref_idx]
+        key = np.abs(ref_lens - testlen[cand_idx]) * 1e6 + ref_lens
+        starts = np.flatnonzero(np.r_[True, cand_idx[1:] != cand_idx[:-1]])
+        best = np.minimum.reduceat(key, starts)
+        reflen = np.round(best % 1e6)
+
+        # scores par image
+        ratios = (testlen + tiny) / (reflen + small)
+        per_image = np.cumprod((correct + tiny) / (guess + small), axis=1) ** (1.0 / np.arange(1, self.n + 1))
+        penalty = np.where(ratios < 1, np.exp(1 - 1 / ratios), 1.0)
+        per_image = per_image * penalty[:, None]
+
+        # score du corpus
+        total_correct = correct.sum(axis=0)
+        total_guess = guess.sum(axis=0)
+        bleus = np.cumprod((total_correct + tiny) / (total_guess + small)) ** (1.0 / np.arange(1, self.n + 1))
+        ratio = (testlen.sum() + tiny) / (reflen.sum() + small)
+        if ratio < 1:
+            bleus = bleus * math.exp(1 - 1 / ratio)
+        return [float(b) for b in bleus], [per_image[:, k].tolist() for k in range(self.n)]
+
+
+_scorers = {}
+_scorers_lock = threading.Lock()
+
+
+def get_ngram_scorer(corpus):
+    """
+    Moteur partagé par tout le process pour un corpus donné (sa construction prend quelques secondes).
+    """
+    with _scorers_lock:
+        if id(corpus) not in _scorers:
+            _scorers[id(corpus)] = (corpus, NgramScorer(corpus))
+        return _scorers[id(corpus)][1]
+
+
+def parity_check(gts, res, tol=1e-6):
+    """
+    Compare le moteur à pycocoevalcap sur les mêmes entrées. Le corpus est réduit aux images de gts
+    pour avoir les mêmes document frequencies que pycocoevalcap (qui les calcule sur le batch).
+    :return: dict {métrique: (pycocoevalcap, moteur)}, lève AssertionError si l'écart dépasse tol
+    """
+    from pycocoevalcap.bleu.bleu import Bleu
+    from pycocoevalcap.cider.cider import Cider
+
+    gts = {i: [sanitize_text(c) for c in caps] for i, caps in gts.items()}
+    res = {i: [sanitize_text(c) for c in caps] for i, caps in res.items()}
+    engine = NgramScorer(ReferenceCorpus(gts))
+
+    ref_cider, _ = Cider().compute_score(gts, res)
+    ref_bleu, _ = Bleu(4).compute_score(gts, res, verbose=0)
+    cider, _ = engine.cider(res)
+    bleu, _ = engine.bleu(res)
+
+    results = {"CIDEr": (float(ref_cider), cider)}
+    for k in range(4):
+        results[f"Bleu_{k + 1}"] = (float(ref_bleu[k]), bleu[k])
+    for name, (expected, got) in results.items():
+        assert abs(expected - got) <= tol, f"{name} : pycocoevalcap {expected} != moteur {got}"
+    return results
+
+
+if __name__ == "__main__":
+    gts = {
+        1: ["A dog lying on a couch.", "A brown dog sleeps on the sofa", "dog resting on a couch in a living room"],
+        2: ["A plate of food on a table", "food on a white plate", "a dinner plate with vegetables and meat"],
+        3: ["A man riding a bike down the street", "a person on a bicycle", "a cyclist riding on a city road"],
+        4: ["Two dogs playing in the grass", "a couple of dogs running on a lawn", "dogs play outside"],
+    }
+    res = {
+        1: ["a dog sleeping on a couch"],
+        2: ["a plate of food with meat"],
+        3: ["a man riding a bicycle on a road"],
+        4: ["a cat on a table"],
+    }
+    for name, (expected, got) in parity_check(gts, res).items():
+        print(f"{name:<8} pycocoevalcap={expected:.6f} moteur={got:.6f}")
+    print("Parité OK")
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import pickle
+import string
+import threading
+from collections import Counter
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent.parent / "data" / "cache" / "references"
+
+_PUNCT = str.maketrans('', '', string.punctuation)
+
+
+def sanitize_text(text):
+    text = text.lower()
+    text = text.replace('\n', ' ').replace('\r', ' ')
+    text = text.translate(_PUNCT)
+    text = " ".join(text.split())
+    return text
+
+
+def ngram_counts(words, n=4):
+    """Compte des n-grammes (1 à n) d'une liste de mots, comme precook de pycocoevalcap."""
+    counts = Counter()
+    for k in range(1, n + 1):
+        for i in range(len(words) - k + 1):
+            counts[tuple(words[i:i + k])] += 1
+    return counts
+
+
+class CleanCaptions(dict):
+    """
+    Dictionnaire {img_id: [captions]} déjà nettoyé : Scorer.sanitize_dict le renvoie tel quel.
+    """
+
+
+class ReferenceCorpus:
+    """
+    Légendes de référence COCO préparées une seule fois pour toutes les métriques et tous les runs :
+        - refs : légendes nettoyées (minuscules, sans ponctuation)
+        - counts : compte des n-grammes (1 à 4) de chaque légende
+        - lengths : longueur (en mots) de chaque légende
+        - df : nombre d'images dont les références contiennent chaque n-gramme (document frequency de CIDEr),
+               calculé sur tout le corpus et pas seulement sur les images évaluées
+    Le tout est mis en cache sur disque (clé = chemin, taille et date de modification du fichier de légendes).
+    """
+
+    def __init__(self, captions, n=4):
+        """
+        :param captions: dictionnaire {img_id: [liste_de_captions_reference]} (ex: captions_map.pkl, CaptionStore)
+        """
+        self.n = n
+        self.refs = CleanCaptions()
+        self.counts = {}
+        self.lengths = {}
+        self.df = Counter()
+
+        for img_id, caps in captions.items():
+            clean = [sanitize_text(c) for c in caps]
+            self.refs[img_id] = clean
+            words = [c.split() for c in clean]
+            self.counts[img_id] = [ngram_counts(w, n) for w in words]
+            self.lengths[img_id] = [len(w) for w in words]
+            self.df.update(set(ng for c in self.counts[img_id] for ng in c))
+
+    @classmethod
+    def from_pickle(cls, captions_path, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        Charge le corpus préparé depuis le cache s'il existe, sinon le construit depuis captions_map.pkl
+        ou depuis une base de légendes CaptionStore (.sqlite).
+        """
+        # clé sans relire le fichier (la base .sqlite peut être grosse), comme CaptionStore.from_json
+        stat = os.stat(captions_path)
+        key = f"{os.path.abspath(captions_path)}|{stat.st_size}|{stat.st_mtime}"
+        cache_path = Path(cache_dir) / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.pkl"
+        if cache_path.exists():
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+
+        print(f"Préparation des légendes de référence ({captions_path})...")
+        if Path(captions_path).suffix == ".sqlite":
+            from core.CaptionStore import CaptionStore
+            store = CaptionStore(captions_path)
+            corpus = cls(store)
+            store.close()
+        else:
+            with open(captions_path, "rb") as f:
+                corpus = cls(pickle.load(f))
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(corpus, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_path)
+        return corpus
+
+    def __contains__(self, img_id):
+        return img_id in self.refs
+
+    def __len__(self):
+        return len(self.refs)
+
+    def get(self, img_ids):
+        """Sous-ensemble {img_id: [légendes nettoyées]} pour les images demandées."""
+        return CleanCaptions((i, self.refs[i]) for i in img_ids)
+
+
+_corpora = {}
+_corpora_lock = threading.Lock()
+
+
+def get_reference_corpus(captions_path):
+    """
+    Corpus partagé par tout le process (un par fichier de légendes).
+    """
+    key = os.path.abspath(str(captions_path))
+    with _corpora_lock:
+        if key not in _corpora:
+            _corpora[key] = ReferenceCorpus.from_pickle(captions_path)
+        return _corpora[key]
@@ -1,41 +1,90 @@
-import string
 from pycocoevalcap.bleu.bleu import Bleu
 from pycocoevalcap.cider.cider import Cider
-from pycocoevalcap.spice.spice import Spice
 
+from core.CaptionStore import CaptionStore
+from core.Instrumentation import get_recorder
 from evaluation.ChairScorer import ChairScorer
-from evaluation.MeteorScorer import MeteorScorer
-from evaluation.SpiceScorer import SpiceScorer
+from evaluation.MeteorScorer import cancel_meteor, get_meteor_pool
+from evaluation.SpiceScorer import cancel_spice, get_spice_scorer
+from evaluation.NgramScorer import get_ngram_scorer
+from evaluation.ReferenceCorpus import ReferenceCorpus, CleanCaptions, get_reference_corpus, sanitize_text
 
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 from pathlib import Path
 load_dotenv()
 
-JAVA_PATH = Path(os.getenv('JAVA_PATH'))
-print(JAVA_PATH)
+def default_java_path():
+    """
+    Chemin de java lu dans le .env au moment où on en a besoin (et plus à l'import), 'java' si absent.
+    """
+    return Path(os.getenv('JAVA_PATH', 'java'))
+
+
 class Scorer:
-    def __init__(self, path_instances, path_synonyms, java_path = JAVA_PATH):
+    def __init__(self, path_instances, path_synonyms, java_path = None, meteor_workers = None, spice_memory_mb = None,
+                 references = None):
+        """
+        meteor_workers : nombre de JVM METEOR (défaut METEOR_WORKERS du .env, sinon 2), 2G de RAM chacune.
+        spice_memory_mb : budget mémoire de la JVM SPICE (défaut SPICE_MEMORY_MB du .env, sinon 4096),
+                          les légendes sont découpées en morceaux pour le respecter.
+        references : ReferenceCorpus (légendes de référence déjà nettoyées, n-grammes et df précalculés),
+                     CaptionStore, ou chemin vers captions_map.pkl / la base .sqlite. Partagé par toutes les métriques.
+        """
         self.path_instances = path_instances
         self.path_synonyms = path_synonyms
-        self.java_path = java_path 
+        self.java_path = java_path if java_path is not None else default_java_path()
+        self.meteor_workers = meteor_workers or int(os.getenv('METEOR_WORKERS', '2'))
+        self.spice_memory_mb = spice_memory_mb or int(os.getenv('SPICE_MEMORY_MB', '4096'))
+        if isinstance(references, CaptionStore):
+            references = references.path
+        if references is not None and not isinstance(references, ReferenceCorpus):
+            references = get_reference_corpus(references)
+        self.references = references
+        # ChairScorer créé au premier calcul de CHAIR
+        self._chair = None
 
     def sanitize_text(self, text):
-      text = text.lower()
-      text = text.replace('\n', ' ').replace('\r', ' ') 
-      text = text.translate(str.maketrans('', '', string.punctuation))
-      text = " ".join(text.split())
-      return text
+      return sanitize_text(text)
 
     def sanitize_dict(self, data_dict):
         """
         Applique le nettoyage sur tout un dictionnaire {id: [liste_captions]}
+        (un dictionnaire déjà nettoyé, CleanCaptions, est renvoyé tel quel)
         """
-        clean_dict = {}
+        if isinstance(data_dict, CleanCaptions):
+            return data_dict
+        clean_dict = CleanCaptions()
         for img_id, captions in data_dict.items():
             clean_dict[img_id] = [self.sanitize_text(c) for c in captions]
         return clean_dict
 
+    def sanitize_refs(self, gts):
+        """
+        Références nettoyées : prises dans le corpus préparé quand il y en a un, nettoyées ici sinon.
+        """
+        if isinstance(gts, CleanCaptions) or self.references is None:
+            return self.sanitize_dict(gts)
+        clean_dict = CleanCaptions()
+        for img_id, captions in gts.items():
+            if img_id in self.references:
+                clean_dict[img_id] = self.references.refs[img_id]
+            else:
+                clean_dict[img_id] = [self.sanitize_text(c) for c in captions]
+        return clean_dict
+
+    def _ngram_engine(self, res):
+        """
+        Moteur CIDEr/BLEU vectorisé (cf NgramScorer) si on a un corpus de référence qui contient toutes les images,
+        None sinon (on repasse alors sur pycocoevalcap)
+        """
+        if self.references is None or not all(i in self.references for i in res):
+            return None
+        return get_ngram_scorer(self.references)
+
     def compute_bleu(self, gts, res):
         """
         BLEU (Bilingual Evaluation Understudy)
@@ -49,15 +98,20 @@ class Scorer:
         """
         print(f"Calcul de Bleu...")
 
-        gts = self.sanitize_dict(gts)
+        gts = self.sanitize_refs(gts)
         res = self.sanitize_dict(res)
 
         eval_result = {}
 
         scorer, methods = (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"])
-        
-        # global score, individual scores 
-        score, _ = scorer.compute_score(gts,res)
+
+        engine = self._ngram_engine(res)
+        if engine is not None:
+            # moteur vectorisé (mêmes scores que pycocoevalcap)
+            score, _ = engine.bleu(res)
+        else:
+            # global score, individual scores
+            score, _ = scorer.compute_score(gts,res)
 
         for m, s in zip(methods,score):
             eval_result[m] = s
@@ -65,7 +119,7 @@ class Scorer:
         return eval_result
     
     # TODO Bibliothèque galère à utiliser sur windows à cause des passage en java (à tester avec JAVA 8)
-    def compute_meteor(self, gts, res):
+    def compute_meteor(self, gts, res, cancel=None):
         """
         METEOR
         Corrige la rigidité de BLEU. Prend en compte les correspondances exacts, mais aussi le stemming (racine des mots) et les synonymes.
@@ -76,26 +130,17 @@ class Scorer:
 
          gts: Dictionnaire {image_id: [liste_de_captions_reference]}
          res: Dictionnaire {image_id: [liste_de_captions_generees]}
+         cancel: threading.Event qui arrête le calcul (timeout de compute_scores)
         """
         print("Calcul de METEOR...")
-        gts = self.sanitize_dict(gts)
+        gts = self.sanitize_refs(gts)
         res = self.sanitize_dict(res)
-        
-        scorer = None
-        try:
-            # demarre java
-            scorer = MeteorScorer(java_path=self.java_path)
-            
-            score, _ = scorer.compute_score(gts, res)
-            return score
-            
-        except Exception as e:
-            print(f"Erreur METEOR: {e}")
-            return 0.0
-            
-        finally:
-            if scorer:
-                scorer.close()
+
+        # les JVM sont démarrées au premier appel puis réutilisées par les appels suivants
+        pool = get_meteor_pool(java_path=self.java_path, size=self.meteor_workers)
+
+        score, _ = pool.compute_score(gts, res, cancel=cancel)
+        return score
 
     
     def compute_cider(self,gts,res):
@@ -112,16 +157,22 @@ class Scorer:
         """
         print(f"Calcul de CIDEr...")
 
-        gts = self.sanitize_dict(gts)
+        gts = self.sanitize_refs(gts)
         res = self.sanitize_dict(res)
 
+        engine = self._ngram_engine(res)
+        if engine is not None:
+            # idf calculé sur tout le corpus de référence : le score ne dépend pas de la taille du batch
+            score, _ = engine.cider(res)
+            return score
+
         scorer = Cider()
 
         score, _ = scorer.compute_score(gts,res)
 
         return score
     
-    def compute_spice(self, gts, res):
+    def compute_spice(self, gts, res, cancel=None):
         """
         SPICE (Semantic Propositional Image Caption Evaluation)
         transforme les captions (ground truth et response) en "graphes de scène" et compare ensuite ces graphes.
@@ -129,58 +180,142 @@ class Scorer:
         """
         print(f"Calcul de SPICE...")
 
+        # les erreurs remontent : compute_scores marque alors SPICE en échec (NaN) au lieu d'un faux 0.0
         first_id = next(iter(res))
         if not res[first_id] or len(res[first_id][0].strip()) == 0:
-            print("ATTENTION: Caption vide détectée. SPICE annulé pour éviter le crash.")
-            return 0.0, []
+            raise ValueError("Caption vide détectée, SPICE annulé pour éviter le crash")
     
         try:
-         spice_scorer = SpiceScorer()
+         # moteur partagé : le cache des graphes de scène des références est réutilisé entre modèles et prompts
+         spice_scorer = get_spice_scorer(java_path=self.java_path, memory_budget_mb=self.spice_memory_mb)
         except Exception as e:
          print(f"Erreur à l'init de SPICE (Java manquant ?): {e}")
-         return None
+         raise
 
-        gts = self.sanitize_dict(gts)
+        gts = self.sanitize_refs(gts)
         res = self.sanitize_dict(res)
 
-        avg_score, scores_detailed = spice_scorer.compute_score(gts, res, java_path=self.java_path)
+        avg_score, scores_detailed = spice_scorer.compute_score(gts, res, cancel=cancel)
         return avg_score, scores_detailed
         
     
-    def compute_chair(self,res):
+    def _chair_scorer(self):
+        # créé au premier appel puis réutilisé (l'index des objets COCO est lui partagé par tout le process)
+        if self._chair is None:
+            self._chair = ChairScorer(self.path_instances,self.path_synonyms)
+        return self._chair
+
+    def compute_chair(self,res, per_image=False):
         """
         CHAIR (Caption Hallucination Assessment with Image Relevance)
         C'est une métrique spécialisée pour détecter les hallucinations. 
         Elle calcule le pourcentage d'objets mentionnés dans la légende qui ne sont pas présents dans l'image 
         (basé sur la liste d'objets connus par exemple grace une segmentation).
+
+        per_image: si True renvoie (agrégat CHAIR_i / CHAIR_s, scores par image) au lieu du score global
         """
         print(f"Calcul de CHAIR...")
 
         res = self.sanitize_dict(res)
         
-        scorer = ChairScorer(self.path_instances,self.path_synonyms)
+        scorer = self._chair_scorer()
+        if per_image:
+            return scorer.compute_per_image(res)
         score = scorer.compute_score(res)
         return score
     
-    def compute_scores(self,gts,res):
-        eval_result = {}
-
-        # CIDEr
-        eval_result["CIDEr"] = self.compute_cider(gts,res)
+    def _metric_jobs(self, gts, res, cancel):
+        """
+        Une fonction par métrique, chacune renvoie un dict {nom: score}
+        cancel : {métrique: threading.Event} pour arrêter les JVM de METEOR et SPICE
+        """
+        return {
+            "CIDEr": lambda: {"CIDEr": self.compute_cider(gts,res)},
+            "BLEU": lambda: self.compute_bleu(gts,res),
+            "METEOR": lambda: {"METEOR": self.compute_meteor(gts,res,cancel=cancel["METEOR"])},
+            "SPICE": lambda: {"SPICE": self.compute_spice(gts,res,cancel=cancel["SPICE"])[0]},
+            "CHAIR": lambda: {"CHAIR": self.compute_chair(res)},
+        }
+
+    # arrêt d'une métrique qui tourne encore après son timeout (les autres se terminent d'elles-mêmes)
+    CANCELLERS = {"METEOR": cancel_meteor, "SPICE": cancel_spice}
+
+    # noms des scores renvoyés par chaque métrique, pour marquer l'échec d'une métrique
+    METRIC_KEYS = {
+        "CIDEr": ["CIDEr"],
+        "BLEU": ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"],
+        "METEOR": ["METEOR"],
+        "SPICE": ["SPICE"],
+        "CHAIR": ["CHAIR"],
+    }
+
+    def _timed(self, name, job):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = job()
+            status = "ok"
+            return result, time.perf_counter() - start
+        finally:
+            get_recorder().observe("metric", time.perf_counter() - start, metric=name, status=status)
 
-        # BLEU
-        bleu_result = self.compute_bleu(gts,res)
-        eval_result = eval_result | bleu_result
+    def compute_scores(self, gts, res, parallel=False, timeout=None):
+        """
+        Calcule toutes les métriques. Le résultat contient aussi le temps de chaque métrique ("<métrique>_Time", en s).
 
-        # METEOR
-        eval_result["METEOR"] = self.compute_meteor(gts,res)
+        PARAMETERS :
 
-        # SPICE
-        avg_spice,_ = self.compute_spice(gts,res)
-        eval_result["SPICE"] = avg_spice
+         parallel: si True les métriques tournent en même temps dans un pool de threads
+                   (METEOR et SPICE sont des JVM externes, le temps total devient celui de la plus lente)
+         timeout: temps max (s) par métrique en mode parallèle, ou dict {métrique: timeout}
+        """
+        # nettoyage fait une seule fois ici pour toutes les métriques
+        with get_recorder().timer("sanitize"):
+            gts = self.sanitize_refs(gts)
+            res = self.sanitize_dict(res)
+
+        cancel = {name: threading.Event() for name in self.METRIC_KEYS}
+        jobs = self._metric_jobs(gts, res, cancel)
+        outcomes = {}
+
+        if not parallel:
+            for name, job in jobs.items():
+                try:
+                    outcomes[name] = self._timed(name, job)
+                except Exception as e:
+                    print(f"Erreur {name}: {e}")
+                    outcomes[name] = None, None
+        else:
+            pool = ThreadPoolExecutor(max_workers=len(jobs))
+            futures = {name: pool.submit(self._timed, name, job) for name, job in jobs.items()}
+            start = time.perf_counter()
+            for name, future in futures.items():
+                limit = timeout.get(name) if isinstance(timeout, dict) else timeout
+                remaining = None if limit is None else max(0.0, limit - (time.perf_counter() - start))
+                try:
+                    outcomes[name] = future.result(timeout=remaining)
+                except FutureTimeoutError:
+                    print(f"Timeout {name} ({limit}s)")
+                    outcomes[name] = None, limit
+                    # un thread ne s'annule pas : on tue la JVM, sinon elle garderait le moteur partagé
+                    # (verrou, stdio) et bloquerait le prochain compute_scores
+                    cancel[name].set()
+                    if name in self.CANCELLERS:
+                        self.CANCELLERS[name](cancel[name])
+                except Exception as e:
+                    print(f"Erreur {name}: {e}")
+                    outcomes[name] = None, None
+            # on n'attend pas une métrique qui a dépassé son timeout (CIDEr, BLEU, CHAIR finissent seules)
+            pool.shutdown(wait=False, cancel_futures=True)
 
-        # CHAIR
-        eval_result["CHAIR"] = self.compute_chair(res)
+        eval_result = {}
+        for name in jobs:
+            result, duration = outcomes[name]
+            if result is None:
+                # échec marqué par NaN, les autres métriques sont gardées
+                result = {key: float('nan') for key in self.METRIC_KEYS[name]}
+            eval_result = eval_result | result
+        for name in jobs:
+            eval_result[f"{name}_Time"] = outcomes[name][1] if outcomes[name][1] is not None else float('nan')
 
         return eval_result
-    
\ No newline at end of file
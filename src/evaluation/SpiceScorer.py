@@ -1,71 +1,184 @@
-import subprocess
+import json
+import math
+import os
 import platform
-from pycocoevalcap.spice.spice import Spice
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent.parent / "data" / "cache" / "spice"
+
 
-class SpiceScorer(Spice):
+class SpiceScorer:
     """
-    Override de Spice pour pouvoir gerer la RAM conssomée et fonctionner sur Windows
-    
+    Moteur SPICE réutilisable (remplace l'ancien override de Spice qui patchait subprocess.check_call globalement).
+        - la commande java est construite ici et lancée avec subprocess.run : aucun état global modifié, thread-safe
+        - hors Windows, les graphes de scène des légendes sont gardés dans le cache LMDB de SPICE (data/cache/spice)
+          et réutilisés entre modèles et prompts ; warm_references() le remplit à l'avance pour les références.
+          Sous Windows (lmdbjni n'y fonctionne pas), il n'y a pas de cache : chaque appel reparse les références.
+          Le parsing a lieu dans le jar SPICE, qui ne sait pas relire des graphes venant d'ailleurs que de ce cache.
+        - les candidats sont traités par morceaux dimensionnés selon le budget mémoire, puis les F-scores
+          par image sont fusionnés (la moyenne est la même qu'en un seul passage).
+        - cancel (threading.Event) : un calcul dont l'event est levé s'arrête, cf cancel().
     """
-    def compute_score(self, gts, res, java_path):
-        
-        # Détection de l'OS pour utiliser ou non le cache avec Spice
-        current_os = platform.system()
+
+    # mémoire de la JVM hors images : modèles Stanford CoreNLP (parser, lemmatiseur) chargés au démarrage de SPICE
+    RESERVED_MB = 1024
+    # estimation prudente (non mesurée) de la mémoire gardée par image jusqu'à la fin d'un morceau : annotations
+    # CoreNLP et graphes de scène du candidat et de ses ~5 références. Baisser memory_budget_mb ou monter
+    # mb_per_image si la JVM sort en OutOfMemoryError.
+    MB_PER_IMAGE = 4
+
+    def __init__(self, java_path="java", memory_budget_mb=4096, mb_per_image=MB_PER_IMAGE, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        :param java_path: exécutable java 8
+        :param memory_budget_mb: mémoire max de la JVM SPICE (-Xmx)
+        :param mb_per_image: estimation de la mémoire utilisée par image (candidat + références) pour dimensionner les morceaux
+        :param cache_dir: dossier du cache des graphes de scène (non utilisé sous Windows, lmdbjni n'y fonctionne pas)
+        """
+        from pycocoevalcap.spice.get_stanford_models import get_stanford_models
+        import pycocoevalcap.spice.spice as spice_module
+
+        # télécharge Stanford CoreNLP si besoin
+        get_stanford_models()
+
+        self.java_path = str(java_path)
+        self.spice_dir = os.path.dirname(os.path.abspath(spice_module.__file__))
+        self.spice_jar = os.path.join(self.spice_dir, spice_module.SPICE_JAR)
+        self.memory_budget_mb = memory_budget_mb
+        # images par morceau : le budget restant une fois CoreNLP chargé (3072 avec les valeurs par défaut)
+        self.chunk_size = max(1, (memory_budget_mb - self.RESERVED_MB) // mb_per_image)
+
         # Impossible sur Windows
-        is_windows = current_os == 'Windows'
-        
-        original_check_call = subprocess.check_call
-
-        def mocked_check_call(cmd, **kwargs):
-            """
-            Fonction d'override de l'environement et de la librairie Spice pour eviter de planter sur Windows ou avec peu de ram
-            """
-            new_cmd = []
-            
-            if cmd[0] == 'java':
-                new_cmd.append(str(java_path))
-            else:
-                new_cmd.append(str(cmd[0]))
-
-            iterator = iter(cmd[1:])
-            for arg in iterator:
-                # debug
-                if arg == '-silent':
-                    continue 
-                
-                elif arg == '-cache':
-                    if is_windows:
-                        # si windows on n'utilise pas le cache
-                        next(iterator, None) 
-                        continue
-                    else:
-                        new_cmd.append(arg)
-                
-                else:
-                    new_cmd.append(str(arg))
-            
-            new_cmd.insert(1, '-Duser.language=en')
-            new_cmd.insert(2, '-Duser.country=US')
-            
-            try:
-                result = subprocess.run(
-                    new_cmd,
-                    cwd=kwargs.get('cwd'),
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
-                return 0
-            except subprocess.CalledProcessError as e:
-                error_msg = e.stderr.decode('utf-8', errors='replace')
-                print(f"CRASH JAVA SPICE ({error_msg})")
-                raise e
+        self.cache_dir = None if platform.system() == 'Windows' else Path(cache_dir)
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # le cache LMDB n'accepte qu'un seul process SPICE à la fois
+        self.lock = threading.Lock()
+        # JVM en cours et event du calcul qui l'a lancée
+        self.process = None
+        self.active = None
+        self.active_lock = threading.Lock()
 
-        subprocess.check_call = mocked_check_call
-        
+    def cancel(self, cancel):
+        """
+        Tue la JVM si elle tourne pour ce calcul (cancel doit déjà être levé) : le verrou est libéré tout de suite
+        au lieu de bloquer l'appel suivant jusqu'à la fin du morceau.
+        """
+        with self.active_lock:
+            if self.active is cancel and self.process is not None:
+                self.process.kill()
+
+    def _run(self, input_data, cancel=None):
+        """
+        Lance une JVM SPICE sur une liste de {"image_id", "test", "refs"} et renvoie le json de sortie.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix="spice_")
         try:
-            return super().compute_score(gts, res)
-        except Exception:
-            return 0.0, []
+            in_file = os.path.join(tmp_dir, "in.json")
+            out_file = os.path.join(tmp_dir, "out.json")
+            with open(in_file, "w", encoding="utf-8") as f:
+                json.dump(input_data, f)
+
+            cmd = [self.java_path, '-Duser.language=en', '-Duser.country=US',
+                   '-jar', f'-Xmx{self.memory_budget_mb}M', self.spice_jar, in_file,
+                   '-out', out_file, '-subset']
+            if self.cache_dir is not None:
+                cmd += ['-cache', str(self.cache_dir)]
+
+            with self.lock:
+                with self.active_lock:
+                    if cancel is not None and cancel.is_set():
+                        raise RuntimeError("Calcul SPICE annulé")
+                    self.process = subprocess.Popen(cmd, cwd=self.spice_dir,
+                                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    self.active = cancel
+                try:
+                    _, stderr = self.process.communicate()
+                    returncode = self.process.returncode
+                finally:
+                    with self.active_lock:
+                        self.process, self.active = None, None
+
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("Calcul SPICE annulé")
+            if returncode != 0:
+                error_msg = stderr.decode('utf-8', errors='replace')
+                print(f"CRASH JAVA SPICE ({error_msg})")
+                raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+            with open(out_file, "r", encoding="utf-8") as f:
+                return json.load(f)
         finally:
-            subprocess.check_call = original_check_call
\ No newline at end of file
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return math.nan
+
+    def warm_references(self, gts):
+        """
+        Parse toutes les légendes de référence une fois pour remplir le cache des graphes de scène.
+        (chaque image est évaluée contre elle-même, seul le cache nous intéresse)
+        """
+        if self.cache_dir is None:
+            print("Cache SPICE indisponible sur Windows, rien à préparer.")
+            return
+        img_ids = sorted(gts.keys())
+        for start in range(0, len(img_ids), self.chunk_size):
+            chunk = img_ids[start:start + self.chunk_size]
+            self._run([{"image_id": i, "test": gts[i][0], "refs": gts[i]} for i in chunk])
+
+    def compute_score(self, gts, res, cancel=None):
+        """
+        gts: Dictionnaire {image_id: [liste_de_captions_reference]}
+        res: Dictionnaire {image_id: [liste_de_captions_generees]}
+        :return: (moyenne des F-scores 'All', liste des scores détaillés par image dans l'ordre des ids)
+        """
+        img_ids = sorted(res.keys())
+        scores_by_id = {}
+
+        for start in range(0, len(img_ids), self.chunk_size):
+            chunk = img_ids[start:start + self.chunk_size]
+            input_data = [{"image_id": i, "test": res[i][0], "refs": gts[i]} for i in chunk]
+            for item in self._run(input_data, cancel):
+                scores_by_id[item['image_id']] = {
+                    category: {k: self._float(v) for k, v in score.items()}
+                    for category, score in item['scores'].items()
+                }
+
+        scores = [scores_by_id[i] for i in img_ids if i in scores_by_id]
+        if not scores:
+            raise RuntimeError("SPICE n'a renvoyé aucun score")
+        average_score = float(np.mean([s['All']['f'] for s in scores]))
+        return average_score, scores
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def cancel_spice(cancel):
+    """
+    Arrête le calcul SPICE de l'event cancel (levé avant l'appel), cf Scorer.compute_scores.
+    """
+    for engine in list(_engines.values()):
+        engine.cancel(cancel)
+
+
+def get_spice_scorer(java_path="java", memory_budget_mb=4096):
+    """
+    Moteur SPICE partagé par tout le process.
+    """
+    key = (str(java_path), memory_budget_mb)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = SpiceScorer(java_path=java_path, memory_budget_mb=memory_budget_mb)
+        return _engines[key]
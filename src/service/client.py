@@ -0,0 +1,72 @@
+"""
+    Client du service d'inférence (service/server.py), avec les mêmes fonctions que core/rag.py : l'app ou un
+    notebook l'utilise à la place de rag, sans charger CLIP ni appeler Ollama lui-même.
+        from service.client import ServiceClient
+        rag = ServiceClient("http://127.0.0.1:8765")
+        best = rag.pipeline_clip("a dog on a couch", images_path)
+    Les chemins d'images sont lus par le service : il doit tourner sur la même machine (chemins absolus).
+"""
+
+import json
+import os
+
+import httpx
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class ServiceClient:
+    def __init__(self, url=None, timeout=300.0):
+        """
+        :param url: adresse du service (None = INFERENCE_SERVICE_URL du .env)
+        """
+        self.url = (url or os.getenv("INFERENCE_SERVICE_URL", "http://127.0.0.1:8765")).rstrip("/")
+        self.http = httpx.Client(base_url=self.url, timeout=timeout)
+
+    def _post(self, path, payload):
+        r = self.http.post(path, json=payload)
+        if r.status_code != 200:
+            raise RuntimeError(f"Service d'inférence {path} : {r.status_code} {r.text}")
+        return r.json()
+
+    def health(self):
+        return self.http.get("/health").json()
+
+    def encode_texts(self, texts):
+        return np.asarray(self._post("/clip/text", {"texts": list(texts)})["embeddings"], dtype=np.float32)
+
+    def encode_text(self, text):
+        return self.encode_texts([text])[0]
+
+    def pipeline_clip(self, questions, images_path):
+        return self._post("/clip/best", {"question": questions, "images_path": [str(p) for p in images_path]})["image"]
+
+    def pipeline_clip_topk(self, questions, images_path, k=5):
+        results = self._post("/clip/search", {"question": questions, "images_path": [str(p) for p in images_path],
+                                              "k": k})["results"]
+        return [(path, score) for path, score in results]
+
+    def pipeline_model(self, questions, image, model=None, cache=None, stream=False):
+        """
+        Comme rag.pipeline_model (cache est ignoré : c'est le cache du service qui sert).
+        """
+        payload = {"question": questions, "image": str(image), "model": model or os.getenv("DEFAULT_MODEL")}
+        if stream:
+            return self._stream(payload)
+        return self._post("/model", payload)["response"]
+
+    def _stream(self, payload):
+        with self.http.stream("POST", "/model", json={**payload, "stream": True}) as r:
+            if r.status_code != 200:
+                raise RuntimeError(f"Service d'inférence /model : {r.status_code} {r.read().decode()}")
+            for line in r.iter_lines():
+                if line:
+                    message = json.loads(line)
+                    if message.get("done"):
+                        return
+                    yield message["token"]
+
+    def close(self):
+        self.http.close()
@@ -0,0 +1,403 @@
+"""
+    Service d'inférence local et headless : un seul process garde CLIP et parle à Ollama pour toutes les sessions
+    de l'app et les notebooks (cf service/client.py).
+        - les encodages CLIP de textes arrivés en même temps sont regroupés en un seul forward (micro-batching), et
+          les mises à jour de l'index des albums de requêtes simultanées sont fusionnées en une seule
+        - une requête identique à une requête en cours attend son résultat au lieu d'être recalculée (coalescing),
+          en streaming les tokens sont envoyés à tous les clients qui attendent la même réponse
+    Lancement (depuis src/) : python -m service --port 8765, puis INFERENCE_SERVICE_URL=http://127.0.0.1:8765
+    dans le .env pour que l'app passe par le service.
+
+    Routes (JSON) :
+        GET  /health, GET /metrics (format Prometheus)
+        POST /clip/text    {texts}                                  -> {embeddings}
+        POST /clip/search  {question, images_path, k, min_score}    -> {results: [[chemin, score], ...]}
+        POST /clip/best    {question, images_path}                  -> {image: chemin ou null}
+        POST /model        {question, image, model, stream}         -> {response} ou ndjson {token} puis {done}
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+from core.Instrumentation import get_recorder
+
+load_dotenv()
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class MicroBatcher:
+    """
+    Regroupe les éléments soumis en même temps (jusqu'à max_batch, en attendant au plus max_wait_ms après le premier)
+    et appelle fn(liste) une seule fois dans l'executor ; fn renvoie un résultat par élément.
+    Un seul lot tourne à la fois : ce qui arrive pendant un lot part dans le suivant.
+    """
+
+    def __init__(self, fn, executor, max_batch=32, max_wait_ms=5.0, name="batch"):
+        self.fn = fn
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.queue = asyncio.Queue()
+        self.recorder = get_recorder()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0 and self.queue.empty():
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(timeout, 0)))
+                except asyncio.TimeoutError:
+                    break
+            batch = [(item, f) for item, f in batch if not f.cancelled()]
+            if not batch:
+                continue
+            self.recorder.count(f"service_{self.name}_batches_total")
+            self.recorder.count(f"service_{self.name}_items_total", len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.fn, [item for item, _ in batch])
+            except Exception as e:
+                for _, f in batch:
+                    if not f.done():
+                        f.set_exception(e)
+                continue
+            for (_, f), result in zip(batch, results):
+                if not f.done():
+                    f.set_result(result)
+
+
+class Coalescer:
+    """Une seule exécution par clé en cours : les requêtes identiques attendent le même résultat."""
+
+    def __init__(self):
+        self.in_flight = {}
+        self.recorder = get_recorder()
+
+    async def run(self, key, factory, op):
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda f: self.in_flight.pop(key, None))
+        else:
+            self.recorder.count("service_coalesced_total", op=op)
+        # shield : un client qui se déconnecte n'annule pas le calcul des autres
+        return await asyncio.shield(future)
+
+
+class TokenBroadcast:
+    """Tokens d'une réponse en streaming, rejoués puis diffusés à chaque client abonné (dans la boucle asyncio)."""
+
+    _DONE = object()
+
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.queues = []
+
+    def push(self, token):
+        self.tokens.append(token)
+        for q in self.queues:
+            q.put_nowait(token)
+
+    def close(self):
+        self.done = True
+        for q in self.queues:
+            q.put_nowait(self._DONE)
+
+    async def subscribe(self):
+        q = asyncio.Queue()
+        for token in self.tokens:
+            q.put_nowait(token)
+        if self.done:
+            q.put_nowait(self._DONE)
+        self.queues.append(q)
+        try:
+            while (token := await q.get()) is not self._DONE:
+                yield token
+        finally:
+            self.queues.remove(q)
+
+
+class InferenceService:
+    """
+    Serveur HTTP asyncio (stdlib). start()/stop() le lancent dans un thread (tests, bench), serve_forever() au premier
+    plan. backend : module qui fait le travail (core.rag par défaut).
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, backend=None, max_batch=32, max_wait_ms=5.0, workers=8,
+                 preload=False, cache=None):
+        """
+        :param cache: ResponseCache des réponses Ollama (None = cache partagé, False = pas de cache)
+        """
+        if backend is None:
+            from core import rag as backend
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.preload = preload
+        self.cache = cache
+        # CLIP sur un seul thread (un seul modèle, les lots font le parallélisme), Ollama sur plusieurs
+        self.clip_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="service-clip")
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="service")
+        self.recorder = get_recorder()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self._ready = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # --- travail ---------------------------------------------------------------------------------------------
+
+    def _update_index(self, albums):
+        # une seule mise à jour pour tous les albums du lot : les nouvelles images sont encodées ensemble
+        paths = list(dict.fromkeys(p for album in albums for p in album))
+        self.backend.get_clip_index().update(paths)
+        return [None] * len(albums)
+
+    def _encode_texts(self, texts):
+        return list(self.backend.encode_texts(texts))
+
+    async def clip_search(self, question, images_path, k, min_score):
+        question = self.backend.preprocess_prompt(question)
+        if not images_path or question == "":
+            return []
+        key = ("clip", question, tuple(images_path), k, min_score)
+
+        async def compute():
+            query, _ = await asyncio.gather(self.text_batcher.submit(question), self.index_batcher.submit(images_path))
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.clip_executor, lambda: self.backend.search_embedding(
+                query, images_path, k=k, min_score=min_score))
+
+        return await self.coalescer.run(key, compute, "clip")
+
+    @staticmethod
+    def _image_key(image):
+        try:
+            stat = os.stat(image)
+            return image, stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return image, None, None
+
+    async def model(self, question, image, model):
+        key = ("model", model, question, self._image_key(image))
+        loop = asyncio.get_running_loop()
+        return await self.coalescer.run(key, lambda: loop.run_in_executor(
+            self.executor, self.backend.pipeline_model, question, image, model, self.cache), "model")
+
+    def model_stream(self, question, image, model):
+        """Abonnement à la réponse en streaming, partagée avec les requêtes identiques en cours."""
+        key = ("stream", model, question, self._image_key(image))
+        broadcast = self.streams.get(key)
+        if broadcast is None:
+            broadcast = self.streams[key] = TokenBroadcast()
+            loop = asyncio.get_running_loop()
+
+            def produce():
+                try:
+                    for token in self.backend.stream_model(question, image, model, self.cache):
+                        loop.call_soon_threadsafe(broadcast.push, token)
+                finally:
+                    loop.call_soon_threadsafe(finish)
+
+            def finish():
+                self.streams.pop(key, None)
+                broadcast.close()
+
+            self.executor.submit(produce)
+        else:
+            self.recorder.count("service_coalesced_total", op="stream")
+        return broadcast.subscribe()
+
+    # --- HTTP ------------------------------------------------------------------------------------------------
+
+    async def route(self, method, path, body):
+        """Renvoie (statut, payload) ou (200, générateur async de lignes ndjson)."""
+        if path == "/health":
+            return 200, {"status": "ok", "clip_loaded": getattr(self.backend, "_clip", None) is not None}
+        if path == "/metrics":
+            return 200, self.recorder.prometheus()
+        if path not in ("/clip/text", "/clip/search", "/clip/best", "/model"):
+            return 404, {"error": f"route inconnue : {path}"}
+        if method != "POST":
+            return 405, {"error": f"{method} {path} non supporté"}
+
+        if path == "/clip/text":
+            texts = body.get("texts")
+            if not isinstance(texts, list):
+                raise BadRequest("texts doit être une liste")
+            embeddings = await asyncio.gather(*(self.text_batcher.submit(t) for t in texts))
+            return 200, {"embeddings": [e.tolist() for e in embeddings]}
+        if path in ("/clip/search", "/clip/best"):
+            question, images_path = body.get("question", ""), body.get("images_path") or []
+            if path == "/clip/best":
+                # même comportement que rag.pipeline_clip
+                if len(images_path) <= 1:
+                    return 200, {"image": None}
+                results = await self.clip_search(question, images_path, 1, self.backend.CLIP_MIN_SCORE)
+                return 200, {"image": results[0][0] if results else None}
+            results = await self.clip_search(question, images_path, int(body.get("k", 5)),
+                                             body.get("min_score", self.backend.CLIP_MIN_SCORE))
+            return 200, {"results": [[p, s] for p, s in results]}
+        if path == "/model":
+            question, image, model = body.get("question"), body.get("image"), body.get("model")
+            if not question or not image:
+                raise BadRequest("question et image sont obligatoires")
+            model = model or os.getenv("DEFAULT_MODEL")
+            if body.get("stream"):
+                return 200, self.model_stream(question, image, model)
+            return 200, {"response": await self.model(question, image, model)}
+
+    async def _send(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            data, ctype = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            data, ctype = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json"
+        writer.write((f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {ctype}\r\n"
+                      f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                      f"\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+    async def _send_stream(self, writer, tokens, keep_alive):
+        writer.write((f"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1"))
+
+        async def chunk(payload):
+            line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+            writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            await writer.drain()
+
+        async for token in tokens:
+            await chunk({"token": token})
+        await chunk({"done": True})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                data = await reader.readexactly(int(headers.get("content-length", 0)))
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                path = urlsplit(target).path
+
+                with self.recorder.timer("service_request", route=path):
+                    try:
+                        status, payload = await self.route(method, path, json.loads(data) if data else {})
+                    except (BadRequest, json.JSONDecodeError, TypeError, ValueError) as e:
+                        status, payload = 400, {"error": str(e)}
+                    except Exception as e:
+                        status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+                    if hasattr(payload, "__aiter__"):
+                        await self._send_stream(writer, payload, keep_alive)
+                    else:
+                        await self._send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # arrêt du serveur avec des connexions keep-alive encore ouvertes
+            pass
+        finally:
+            writer.close()
+
+    # --- cycle de vie ----------------------------------------------------------------------------------------
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.text_batcher = MicroBatcher(self._encode_texts, self.clip_executor, self.max_batch, self.max_wait_ms,
+                                         name="clip_text")
+        self.index_batcher = MicroBatcher(self._update_index, self.clip_executor, self.max_batch, self.max_wait_ms,
+                                          name="clip_index")
+        self.coalescer = Coalescer()
+        self.streams = {}
+        if self.preload:
+            await self.loop.run_in_executor(self.clip_executor, self.backend.get_clip)
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.clip_executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Service d'inférence partagé (CLIP + Ollama)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=32, help="taille max d'un lot CLIP")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="attente max pour remplir un lot")
+    parser.add_argument("--workers", type=int, default=8, help="requêtes Ollama en parallèle")
+    parser.add_argument("--preload", action="store_true", help="charge CLIP au démarrage")
+    parser.add_argument("--no-cache", action="store_true", help="désactive le cache des réponses Ollama")
+    args = parser.parse_args(argv)
+    service = InferenceService(args.host, args.port, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms,
+                               workers=args.workers, preload=args.preload, cache=False if args.no_cache else None)
+    print(f"Service d'inférence sur {service.url} (INFERENCE_SERVICE_URL={service.url})")
+    service.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# les modules s'importent depuis src/ (from core..., from evaluation...), comme dans les notebooks et l'app
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,65 @@
+import io
+import json
+
+import pytest
+
+from core.CaptionStore import _JsonStream, iter_json_array
+
+COCO = {
+    "info": {"year": 2017, "description": "COCO [val]"},
+    "images": [{"id": 123456, "file_name": "000000123456.jpg"}, {"id": 7, "file_name": "000000000007.jpg"}],
+    "annotations": [
+        {"image_id": 123456, "id": 1, "caption": "A dog, a \"frisbee\" and a ] bracket."},
+        {"image_id": 7, "id": 22, "caption": "Un café à Paris ☕"},
+        {"image_id": 123456, "id": 333, "caption": "", "score": -1.5e-3, "tags": [1, [2, {}]], "ok": True},
+    ],
+    "licenses": [],
+}
+
+
+def stream(text, chunk_size):
+    return _JsonStream(io.StringIO(text), chunk_size=chunk_size)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 20])
+def test_items_match_json_module(chunk_size):
+    text = json.dumps(COCO["annotations"], ensure_ascii=False, indent=1)
+    assert list(stream(text, chunk_size).items()) == COCO["annotations"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3])
+def test_numbers_cut_between_chunks(chunk_size):
+    assert list(stream("[123456, -7.25e10, 0]", chunk_size).items()) == [123456, -7.25e10, 0]
+
+
+def test_empty_array():
+    assert list(stream(" [ ] ", 1).items()) == []
+
+
+@pytest.mark.parametrize("text", ['[{"id": 1}, {"id": 2', '[1, 2', '[{"caption": "a dog'])
+def test_truncated_json_raises(text):
+    with pytest.raises(ValueError):
+        list(stream(text, 4).items())
+
+
+@pytest.mark.parametrize("text", ['[1 2]', '{"id": 1}', '[1,, 2]', '[{"id": 1,}]'])
+def test_invalid_json_raises(text):
+    with pytest.raises(ValueError):
+        list(stream(text, 4).items())
+
+
+@pytest.mark.parametrize("key", ["annotations", "images", "licenses", "missing"])
+def test_iter_json_array(tmp_path, key):
+    path = tmp_path / "captions_val2017.json"
+    path.write_text(json.dumps(COCO, ensure_ascii=False), encoding="utf-8")
+    assert list(iter_json_array(path, key)) == COCO.get(key, [])
+
+
+def test_iter_json_array_truncated_file(tmp_path):
+    path = tmp_path / "captions_val2017.json"
+    text = json.dumps(COCO)
+    path.write_text(text[:text.index('"Un caf')], encoding="utf-8")
+    items = iter_json_array(path, "annotations")
+    assert next(items)["id"] == 1
+    with pytest.raises(ValueError):
+        list(items)
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import evaluation.ChairIndex as chair_index
+from evaluation.ChairScorer import ChairScorer, ObjectMatcher, plural_forms
+
+SYNONYMS = {
+    "dog": "dog", "puppy": "dog", "hot dog": "hot dog", "sign": "stop sign", "stop sign": "stop sign",
+    "traffic light": "traffic light", "person": "person", "man": "person", "glass": "wine glass",
+    "glasses": "glasses", "bus": "bus", "pony": "horse",
+}
+
+
+@pytest.fixture
+def matcher():
+    return ObjectMatcher(SYNONYMS)
+
+
+def test_plural_forms():
+    assert plural_forms("dog") == {"dogs"}
+    assert plural_forms("bus") == {"buses"}
+    assert plural_forms("pony") == {"ponies"}
+    assert plural_forms("toy") == {"toys"}
+    assert plural_forms("man") == {"men", "mans"}
+    assert "people" in plural_forms("person")
+
+
+def test_longest_match_wins(matcher):
+    assert matcher.extract("A hot dog next to a stop sign.") == ["hot dog", "stop sign"]
+    assert matcher.extract("A dog near a sign") == ["dog", "stop sign"]
+    assert matcher.extract("traffic lights over the road") == ["traffic light"]
+    # le mot seul ne forme pas le motif de deux mots
+    assert matcher.extract("heavy traffic") == []
+
+
+def test_plurals_and_punctuation(matcher):
+    assert matcher.extract("Two puppies, three buses and some ponies!") == ["dog", "bus", "horse"]
+    assert matcher.extract("People and men walking") == ["person", "person"]
+    # un pluriel n'écrase pas un synonyme qui existe déjà
+    assert matcher.extract("a pair of glasses") == ["glasses"]
+
+
+def test_extract_batch(matcher):
+    assert matcher.extract_batch(["a dog", "", "a bus"]) == [["dog"], [], ["bus"]]
+
+
+@pytest.fixture
+def scorer(tmp_path, monkeypatch):
+    """ChairScorer sur deux images : 1 contient un chien et une personne, 2 un bus."""
+    monkeypatch.setattr(chair_index, "DEFAULT_INDEX_DIR", tmp_path / "chair_index")
+    categories = [{"id": 1, "name": "person"}, {"id": 6, "name": "bus"}, {"id": 10, "name": "traffic light"},
+                  {"id": 13, "name": "stop sign"}, {"id": 18, "name": "dog"}, {"id": 58, "name": "hot dog"}]
+    instances = {"images": [{"id": 1}, {"id": 2}], "categories": categories,
+                 "annotations": [{"image_id": 1, "category_id": 18}, {"image_id": 1, "category_id": 1},
+                                 {"image_id": 2, "category_id": 6}]}
+    instances_path = tmp_path / "instances_test.json"
+    instances_path.write_text(json.dumps(instances))
+    synonyms_path = tmp_path / "synonyms.txt"
+    synonyms_path.write_text("dog dog\npuppy dog\nstop light traffic light\nred light traffic light\n"
+                             "hotdog hot dog\nman person\nbus bus\n")
+    return ChairScorer(instances_path, synonyms_path)
+
+
+def test_synonyms_file_parsing(scorer):
+    # la cible est le plus long suffixe qui est une catégorie COCO, la source peut avoir plusieurs mots
+    assert scorer.synonyms["stop light"] == "traffic light"
+    assert scorer.synonyms["red light"] == "traffic light"
+    assert scorer.synonyms["hotdog"] == "hot dog"
+    assert scorer.synonyms["puppy"] == "dog"
+
+
+def test_chair_scores(scorer):
+    responses = {1: ["A man with his puppy"], 2: ["A bus at a red light"]}
+    assert scorer.compute_score(responses) == pytest.approx(1 / 4)
+    aggregate, per_image = scorer.compute_per_image(responses)
+    assert per_image[2]["hallucinated"] == ["traffic light"]
+    assert aggregate == {"CHAIR_i": pytest.approx(1 / 4), "CHAIR_s": pytest.approx(1 / 2)}
@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import pytest
+
+from core.ClipIndex import ClipIndex
+
+DIM = 8
+
+
+class FakeEncoder:
+    """Embedding normalisé déduit du contenu du fichier ; fail=True simule un encodage qui plante."""
+
+    def __init__(self):
+        self.encoded = []
+        self.fail = False
+
+    def __call__(self, paths):
+        if self.fail:
+            raise RuntimeError("CLIP indisponible")
+        self.encoded.extend(paths)
+        return np.stack([embedding(open(p, "rb").read()) for p in paths])
+
+
+def embedding(content):
+    vec = np.random.default_rng(list(content)).standard_normal(DIM).astype(np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def write(path, content, mtime=None):
+    path.write_bytes(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture
+def encoder():
+    return FakeEncoder()
+
+
+def make_index(tmp_path, encoder):
+    return ClipIndex(encoder, index_dir=tmp_path / "index")
+
+
+def test_add_is_incremental_and_persisted(tmp_path, encoder):
+    a = write(tmp_path / "a.jpg", b"a")
+    b = write(tmp_path / "b.jpg", b"b")
+    index = make_index(tmp_path, encoder)
+    index.update([a, b])
+    assert len(encoder.encoded) == 2
+
+    c = write(tmp_path / "c.jpg", b"c")
+    index.update([a, b, c])
+    # seule la nouvelle image est encodée
+    assert encoder.encoded[2:] == [str(c)]
+
+    reopened = make_index(tmp_path, encoder)
+    reopened.update([a, b, c])
+    assert len(encoder.encoded) == 3
+    np.testing.assert_allclose(reopened.get([c, a]), np.stack([embedding(b"c"), embedding(b"a")]))
+
+
+def test_duplicate_content_shares_a_row(tmp_path, encoder):
+    a = write(tmp_path / "a.jpg", b"same")
+    b = write(tmp_path / "b.jpg", b"same")
+    index = make_index(tmp_path, encoder)
+    index.update([a, b])
+    assert len(encoder.encoded) == 1
+    assert len(index) == 1
+
+
+def test_modified_file_is_reencoded(tmp_path, encoder):
+    a = write(tmp_path / "a.jpg", b"old", mtime=1_000_000)
+    index = make_index(tmp_path, encoder)
+    index.update([a])
+    write(a, b"new content", mtime=2_000_000)
+    index.update([a])
+    assert len(encoder.encoded) == 2
+    np.testing.assert_allclose(index.get([a])[0], embedding(b"new content"))
+
+
+def test_removed_file_leaves_manifest_and_rows_are_compacted(tmp_path, encoder):
+    paths = [write(tmp_path / f"{i}.jpg", bytes([i])) for i in range(4)]
+    index = make_index(tmp_path, encoder)
+    index.update(paths)
+    for p in paths[:3]:
+        p.unlink()
+    index.update(paths[3:])
+    assert set(index.files) == {str(paths[3])}
+    # 3 lignes mortes sur 4 > COMPACT_RATIO : le fichier est réécrit avec la seule ligne vivante
+    assert index.hashes == [index.files[str(paths[3])]["hash"]]
+    assert os.path.getsize(index.emb_path) == DIM * 4
+    np.testing.assert_allclose(make_index(tmp_path, encoder).get(paths[3:])[0], embedding(bytes([3])))
+
+
+def test_failed_encoding_leaves_index_unchanged(tmp_path, encoder):
+    a = write(tmp_path / "a.jpg", b"a")
+    index = make_index(tmp_path, encoder)
+    index.update([a])
+    b = write(tmp_path / "b.jpg", b"b")
+    encoder.fail = True
+    with pytest.raises(RuntimeError):
+        index.update([a, b])
+    assert set(index.files) == {str(a)}
+    np.testing.assert_allclose(index.get([a])[0], embedding(b"a"))
+
+    # le fichier n'a pas été enregistré comme indexé : il est encodé au prochain appel
+    encoder.fail = False
+    index.update([a, b])
+    np.testing.assert_allclose(index.get([b])[0], embedding(b"b"))
@@ -0,0 +1,10 @@
+from utils.dl import CHECKSUMS, URLS, selftest
+
+
+def test_selftest(tmp_path):
+    """Reprise, extraction en continu, checksum et reprise après suppression du dossier extrait (cf selftest)."""
+    selftest(tmp_path)
+
+
+def test_every_dataset_has_a_checksum():
+    assert set(CHECKSUMS) == set(URLS)
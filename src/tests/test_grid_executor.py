@@ -0,0 +1,138 @@
+import json
+import math
+import time
+
+import ollama
+import pytest
+from PIL import Image
+
+from bench.fake_ollama import FakeOllamaServer
+from core.GridExecutor import GridExecutor
+
+PROMPTS = ["Describe this image.", "Caption this image in ten words."]
+
+
+@pytest.fixture
+def server():
+    with FakeOllamaServer(latency_ms=0) as fake:
+        yield fake
+
+
+@pytest.fixture
+def images(tmp_path):
+    """Trois images COCO valides (ids 1 à 3) et leurs légendes de référence."""
+    paths = []
+    for i, color in enumerate(["red", "green", "blue"], start=1):
+        path = tmp_path / f"{i:012d}.jpg"
+        Image.new("RGB", (64, 48), color).save(path)
+        paths.append(str(path))
+    captions = {i: [f"a {color} square"] for i, color in enumerate(["red", "green", "blue"], start=1)}
+    return paths, captions
+
+
+def make_grid(server, paths, captions, **kwargs):
+    return GridExecutor(["llava"], PROMPTS, paths, captions, cache=False, client=ollama.Client(host=server.url),
+                        **kwargs)
+
+
+def test_unreadable_image_is_reported_in_failed(server, images, tmp_path):
+    paths, captions = images
+    broken = tmp_path / "000000000004.jpg"
+    broken.write_bytes(b"not an image")
+    missing = str(tmp_path / "000000000005.jpg")
+    cells = make_grid(server, paths + [str(broken), missing], captions).run()
+
+    for prompt_id in range(len(PROMPTS)):
+        cell = cells[("llava", prompt_id)]
+        assert set(cell["responses"]) == {1, 2, 3}
+        assert set(cell["failed"]) == {4, 5}
+        assert cell["failed"][5].startswith("FileNotFoundError")
+
+
+def test_finished_cells_are_not_rerun(server, images, tmp_path):
+    paths, captions = images
+    results_path = tmp_path / "grid.json"
+    first = make_grid(server, paths, captions, results_path=results_path).run()
+    requests = server.stats()["requests"]
+
+    again = make_grid(server, paths, captions, results_path=results_path).run()
+    assert server.stats()["requests"] == requests
+    assert {k: dict(c["responses"]) for k, c in again.items()} == {k: dict(c["responses"]) for k, c in first.items()}
+    assert again[("llava", 0)]["gt_captions"] == first[("llava", 0)]["gt_captions"]
+
+
+def test_interrupted_grid_resumes_missing_cells(server, images, tmp_path):
+    paths, captions = images
+    results_path = tmp_path / "grid.json"
+    # seul le 1er prompt a été fait avant l'arrêt
+    GridExecutor(["llava"], PROMPTS[:1], paths, captions, cache=False, client=ollama.Client(host=server.url),
+                 results_path=results_path).run()
+    requests = server.stats()["requests"]
+    cells = make_grid(server, paths, captions, results_path=results_path).run()
+    assert set(cells) == {("llava", 0), ("llava", 1)}
+    # warm-up + une requête par image du 2e prompt + déchargement
+    assert server.stats()["requests"] - requests == len(paths) + 2
+
+
+def test_cells_on_other_images_or_with_failures_are_redone(server, images, tmp_path):
+    paths, captions = images
+    results_path = tmp_path / "grid.json"
+    missing = str(tmp_path / "000000000004.jpg")
+    make_grid(server, paths + [missing], captions, results_path=results_path).run()
+
+    requests = server.stats()["requests"]
+    make_grid(server, paths + [missing], captions, results_path=results_path).run()
+    assert server.stats()["requests"] == requests
+    make_grid(server, paths + [missing], captions, results_path=results_path).run(retry_failed=True)
+    assert server.stats()["requests"] > requests
+
+    requests = server.stats()["requests"]
+    cells = make_grid(server, paths[:2], captions, results_path=results_path).run()
+    assert server.stats()["requests"] > requests
+    assert set(cells[("llava", 0)]["responses"]) == {1, 2}
+
+
+@pytest.fixture
+def scorer(tmp_path, monkeypatch):
+    """Scorer dont METEOR et SPICE plantent (JVM absente) : seules CIDEr, BLEU et CHAIR tournent vraiment."""
+    import evaluation.ChairIndex as chair_index
+    from evaluation.Scorer import Scorer
+
+    monkeypatch.setattr(chair_index, "DEFAULT_INDEX_DIR", tmp_path / "chair_index")
+    instances = tmp_path / "instances.json"
+    instances.write_text(json.dumps({"images": [{"id": i} for i in (1, 2, 3)], "annotations": [],
+                                     "categories": [{"id": 1, "name": "person"}]}))
+    synonyms = tmp_path / "synonyms.txt"
+    synonyms.write_text("person person\n")
+    scorer = Scorer(instances, synonyms)
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("JVM morte")
+
+    # SPICE n'est pas disponible ici non plus (téléchargement de CoreNLP + java)
+    monkeypatch.setattr(scorer, "compute_meteor", crash)
+    monkeypatch.setattr(scorer, "compute_spice", crash)
+    return scorer
+
+
+def test_failed_metric_is_nan(server, images, scorer):
+    paths, captions = images
+    grid = make_grid(server, paths, captions)
+    scores = grid.score(scorer, grid.run())
+    for cell_scores in scores.values():
+        assert math.isnan(cell_scores["METEOR"]) and math.isnan(cell_scores["METEOR_Time"])
+        assert math.isnan(cell_scores["SPICE"])
+        assert not math.isnan(cell_scores["CIDEr"]) and not math.isnan(cell_scores["Bleu_1"])
+        assert cell_scores["CHAIR"] == 0.0
+
+
+def test_metric_timeout_is_nan(images, scorer, monkeypatch):
+    _, captions = images
+    # SPICE bloqué : compute_scores rend la main au timeout au lieu de l'attendre
+    monkeypatch.setattr(scorer, "compute_spice", lambda *args, **kwargs: time.sleep(2))
+    res = {i: ["a colored square"] for i in captions}
+    start = time.perf_counter()
+    scores = scorer.compute_scores(captions, res, parallel=True, timeout={"SPICE": 0.2})
+    assert time.perf_counter() - start < 1.5
+    assert math.isnan(scores["SPICE"]) and scores["SPICE_Time"] == 0.2
+    assert not math.isnan(scores["CIDEr"])
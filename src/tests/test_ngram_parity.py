@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+from evaluation.NgramScorer import parity_check
+
+GTS = {
+    1: ["A dog lying on a couch.", "A brown dog sleeps on the sofa", "dog resting on a couch in a living room"],
+    2: ["A plate of food on a table", "food on a white plate", "a dinner plate with vegetables and meat"],
+    3: ["A man riding a bike down the street", "a person on a bicycle", "a cyclist riding on a city road"],
+    4: ["Two dogs playing in the grass", "a couple of dogs running on a lawn", "dogs play outside"],
+}
+RES = {
+    1: ["a dog sleeping on a couch"],
+    2: ["a plate of food with meat"],
+    3: ["a man riding a bicycle on a road"],
+    4: ["a cat on a table"],
+}
+
+VOCAB = ("a an the dog cat man woman plate food table couch street bike bicycle road grass two of on in with "
+         "riding sitting playing white brown red big small near next to under over").split()
+
+
+def random_case(seed):
+    """Petit corpus aléatoire : vocabulaire réduit pour avoir des n-grammes communs, nombre de références variable."""
+    rng = random.Random(seed)
+
+    def caption():
+        return " ".join(rng.choice(VOCAB) for _ in range(rng.randint(1, 12)))
+
+    img_ids = rng.sample(range(1, 10_000), rng.randint(1, 20))
+    gts = {i: [caption() for _ in range(rng.randint(1, 5))] for i in img_ids}
+    res = {i: [caption()] for i in img_ids}
+    return gts, res
+
+
+def test_parity_fixture():
+    results = parity_check(GTS, RES)
+    assert set(results) == {"CIDEr", "Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"}
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_parity_random(seed):
+    parity_check(*random_case(seed))
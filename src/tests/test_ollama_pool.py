@@ -0,0 +1,78 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bench.harness import spawn_fake_servers
+from core.Instrumentation import get_recorder
+from core.OllamaPool import OllamaPool
+
+MESSAGES = [{"role": "user", "content": "describe the image"}]
+
+
+def fake_servers(n, latency_ms):
+    args = argparse.Namespace(latency_ms=latency_ms, jitter_ms=0.0, token_ms=0.0, fail_rate=0.0)
+    return spawn_fake_servers(n, args)
+
+
+@pytest.fixture
+def servers():
+    """Trois faux serveurs Ollama, chacun dans son process, avec 300 ms de latence."""
+    procs, hosts = fake_servers(3, latency_ms=300)
+    yield procs, hosts
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+
+
+def redispatched():
+    return sum(v for (name, _), v in get_recorder().counters.items() if name == "ollama_redispatch_total")
+
+
+def chat_all(pool, n, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda _: pool.chat(model="llava", messages=MESSAGES), range(n)))
+
+
+def test_least_outstanding_spreads_load(servers):
+    _, hosts = servers
+    pool = OllamaPool(hosts, health_interval=0)
+    try:
+        responses = chat_all(pool, 30, workers=9)
+        assert all(r["message"]["content"] for r in responses)
+        requests = [e["requests"] for e in pool.stats()]
+        assert sum(requests) == 30
+        # 9 requêtes en parallèle sur 3 endpoints : chacun en prend sa part
+        assert min(requests) >= 6
+        assert all(e["outstanding"] == 0 for e in pool.stats())
+    finally:
+        pool.close()
+
+
+def test_killed_endpoint_is_ejected_and_requests_redispatched(servers):
+    procs, hosts = servers
+    pool = OllamaPool(hosts, health_interval=0.2, eject_time=60)
+    before = redispatched()
+    try:
+        with ThreadPoolExecutor(max_workers=9) as executor:
+            futures = [executor.submit(pool.chat, model="llava", messages=MESSAGES) for _ in range(9)]
+            # les 9 requêtes sont en cours (3 par endpoint) quand le 2e serveur s'arrête
+            time.sleep(0.1)
+            procs[1].kill()
+            responses = [f.result(timeout=30) for f in futures]
+
+        assert all(r["message"]["content"] for r in responses)
+        assert redispatched() > before
+        time.sleep(0.5)
+        killed = pool.stats()[1]
+        assert killed["ejected"]
+
+        # les requêtes suivantes ne vont plus que sur les deux serveurs restants
+        counts = [e["requests"] for e in pool.stats()]
+        chat_all(pool, 6, workers=6)
+        after = [e["requests"] for e in pool.stats()]
+        assert after[1] == counts[1]
+        assert after[0] + after[2] == counts[0] + counts[2] + 6
+    finally:
+        pool.close()
@@ -0,0 +1,180 @@
+import httpx
+import ollama
+import pytest
+
+from core.Model import Model
+from core.Resilience import CircuitBreaker, CircuitOpenError, GenerationTimeout, ResilientClient, RetryPolicy
+
+MESSAGES = [{"role": "user", "content": "describe the image"}]
+
+
+class ScriptedClient:
+    """Faux client Ollama : chaque appel consomme le prochain élément du script (exception levée ou réponse)."""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = []
+
+    def _next(self, kwargs):
+        self.calls.append(kwargs)
+        step = self.script.pop(0)
+        if isinstance(step, BaseException):
+            raise step
+        return step
+
+    def chat(self, *args, stream=False, **kwargs):
+        step = self._next(kwargs)
+        if stream:
+            return iter(step)
+        return step
+
+
+def reply(text="ok"):
+    return {"message": {"role": "assistant", "content": text}}
+
+
+def make_client(*script, max_attempts=3, deadline=60.0, breaker=None):
+    policy = RetryPolicy(timeout=30.0, max_attempts=max_attempts, base_delay=0.0, max_delay=0.0,
+                         deadline=deadline, seed=0)
+    breaker = breaker or CircuitBreaker(failure_threshold=2, reset_timeout=0.0, max_wait=1.0)
+    return ResilientClient(ScriptedClient(*script), policy=policy, breaker=breaker)
+
+
+def open_breaker(**kwargs):
+    breaker = CircuitBreaker(**kwargs)
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == breaker.OPEN
+    return breaker
+
+
+# --- coupe-circuit ---
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60.0, max_wait=0.1)
+    breaker.failure()
+    assert breaker.state == breaker.CLOSED
+    breaker.failure()
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_breaker_half_open_lets_a_single_probe_through():
+    breaker = open_breaker(failure_threshold=2, reset_timeout=0.0, max_wait=0.1)
+    assert breaker.before_call() is True
+    assert breaker.state == breaker.HALF_OPEN
+    # la requête d'essai est en cours : les autres attendent
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+@pytest.mark.parametrize("succeeded, state", [(True, CircuitBreaker.CLOSED), (False, CircuitBreaker.OPEN)])
+def test_breaker_probe_outcome(succeeded, state):
+    breaker = open_breaker(failure_threshold=2, reset_timeout=0.0)
+    probe = breaker.before_call()
+    if succeeded:
+        breaker.success(probe)
+    else:
+        breaker.failure(probe)
+    assert breaker.state == state
+    assert not breaker.probing
+
+
+def test_breaker_release_frees_the_probe():
+    breaker = open_breaker(failure_threshold=2, reset_timeout=0.0, max_wait=0.1)
+    probe = breaker.before_call()
+    breaker.release(probe)
+    assert breaker.state == breaker.HALF_OPEN
+    assert breaker.before_call() is True
+
+
+# --- retry / backoff ---
+
+def test_delay_is_full_jitter_capped():
+    policy = RetryPolicy(base_delay=1.0, max_delay=4.0, seed=0)
+    for attempt in range(6):
+        for _ in range(50):
+            assert 0.0 <= policy.delay(attempt) <= min(4.0, 2 ** attempt)
+
+
+def test_transient_errors_are_retried():
+    client = make_client(httpx.ConnectError("refused"), ollama.ResponseError("busy", 503), reply())
+    assert client.chat(model="llava", messages=MESSAGES) == reply()
+    assert len(client.client.calls) == 3
+
+
+def test_retries_stop_after_max_attempts():
+    client = make_client(*[httpx.ConnectError("refused")] * 3, max_attempts=2,
+                         breaker=CircuitBreaker(failure_threshold=10))
+    with pytest.raises(httpx.ConnectError):
+        client.chat(model="llava", messages=MESSAGES)
+    assert len(client.client.calls) == 2
+
+
+def test_no_retry_past_deadline():
+    client = make_client(httpx.ConnectError("refused"), reply(), deadline=0.0)
+    with pytest.raises(httpx.ConnectError):
+        client.chat(model="llava", messages=MESSAGES)
+    assert len(client.client.calls) == 1
+
+
+@pytest.mark.parametrize("error", [httpx.ReadTimeout("slow"), ollama.ResponseError("not found", 404)])
+def test_definitive_errors_are_not_retried(error):
+    client = make_client(error, reply())
+    with pytest.raises(type(error)):
+        client.chat(model="llava", messages=MESSAGES)
+    assert len(client.client.calls) == 1
+
+
+def test_num_predict_is_capped():
+    client = make_client(reply())
+    client.policy.num_predict = 64
+    client.chat(model="llava", messages=MESSAGES, options={"num_predict": -1, "temperature": 0})
+    assert client.client.calls[0]["options"] == {"num_predict": 64, "temperature": 0}
+
+
+# --- requête d'essai à travers le client ---
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("error, state", [
+    (ollama.ResponseError("not found", 404), CircuitBreaker.CLOSED),
+    (httpx.ReadTimeout("slow"), CircuitBreaker.OPEN),
+    (GenerationTimeout("too long"), CircuitBreaker.OPEN),
+])
+def test_probe_error_never_leaves_circuit_stuck(stream, error, state):
+    breaker = open_breaker(failure_threshold=2, reset_timeout=0.0, max_wait=0.5)
+    client = make_client(error, breaker=breaker)
+    with pytest.raises(type(error)):
+        response = client.chat(model="llava", messages=MESSAGES, stream=stream)
+        if stream:
+            list(response)
+    assert breaker.state == state
+    assert not breaker.probing
+    # un timeout ne referme pas le circuit, mais la requête d'essai suivante peut passer
+    assert breaker.before_call() is (state != CircuitBreaker.CLOSED)
+
+
+def test_stream_closed_by_caller_releases_probe():
+    breaker = open_breaker(failure_threshold=2, reset_timeout=0.0, max_wait=0.5)
+    client = make_client([reply("a"), reply("b")], breaker=breaker)
+    stream = client.chat(model="llava", messages=MESSAGES, stream=True)
+    next(stream)
+    stream.close()
+    assert breaker.state == breaker.CLOSED
+    assert not breaker.probing
+
+
+def test_stream_is_retried_before_first_token():
+    client = make_client(httpx.ConnectError("refused"), [reply("a"), reply("b")])
+    chunks = list(client.chat(model="llava", messages=MESSAGES, stream=True))
+    assert [c["message"]["content"] for c in chunks] == ["a", "b"]
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_model_cache_key_uses_sent_options():
+    client = make_client(reply())
+    model = Model("llava", ["describe"], [], {}, cache=False, client=client)
+    assert model.options == {"num_predict": client.policy.num_predict}
+    # sans borne côté client, les options de l'appelant sont gardées telles quelles
+    assert Model("llava", ["describe"], [], {}, cache=False, client=client.client, options=None).options is None
@@ -0,0 +1,77 @@
+import types
+
+import pytest
+
+import core.ResponseCache as response_cache
+from core.ResponseCache import ResponseCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Horloge du cache avancée à la main (les accès d'un test tomberaient sinon dans la même milliseconde)."""
+    now = types.SimpleNamespace(t=1000.0)
+    monkeypatch.setattr(response_cache, "time", types.SimpleNamespace(time=lambda: now.t))
+    return now
+
+
+def make_cache(tmp_path, **kwargs):
+    return ResponseCache(path=tmp_path / "responses.sqlite", **kwargs)
+
+
+def test_key_depends_on_every_field():
+    base = ResponseCache.make_key("img", "describe", "llava@sha", {"temperature": 0})
+    assert base == ResponseCache.make_key("img", "describe", "llava@sha", {"temperature": 0})
+    assert base != ResponseCache.make_key("img2", "describe", "llava@sha", {"temperature": 0})
+    assert base != ResponseCache.make_key("img", "caption", "llava@sha", {"temperature": 0})
+    assert base != ResponseCache.make_key("img", "describe", "llava@other", {"temperature": 0})
+    assert base != ResponseCache.make_key("img", "describe", "llava@sha", {"temperature": 0.5})
+    assert base != ResponseCache.make_key("img", "describe", "llava@sha", {"temperature": 0, "num_predict": 64})
+
+
+def test_key_ignores_option_order_and_empty_options():
+    assert (ResponseCache.make_key("img", "p", "m", {"a": 1, "b": 2})
+            == ResponseCache.make_key("img", "p", "m", {"b": 2, "a": 1}))
+    assert ResponseCache.make_key("img", "p", "m", None) == ResponseCache.make_key("img", "p", "m", {})
+
+
+def test_get_set_and_persistence(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get("k") is None
+    cache.set("k", "a dog on a couch")
+    assert cache.get("k") == "a dog on a couch"
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5, "entries": 1}
+    cache.close()
+    assert make_cache(tmp_path).get("k") == "a dog on a couch"
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = make_cache(tmp_path, max_entries=2)
+    cache.set("a", "A")
+    clock.t += 1
+    cache.set("b", "B")
+    clock.t += 1
+    # a est relu : c'est b le moins récemment utilisé
+    assert cache.get("a") == "A"
+    clock.t += 1
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+    assert cache.stats()["entries"] == 2
+
+
+def test_expired_entries_are_misses(tmp_path, clock):
+    cache = make_cache(tmp_path, max_age=60)
+    cache.set("old", "O")
+    clock.t += 61
+    assert cache.get("old") is None
+    cache.set("new", "N")
+    clock.t += 30
+    assert cache.get("new") == "N"
+    assert cache.stats()["entries"] == 1
+
+
+def test_disabled_cache_is_bypassed(tmp_path):
+    cache = make_cache(tmp_path, enabled=False)
+    cache.set("k", "v")
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
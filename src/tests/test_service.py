@@ -0,0 +1,113 @@
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import ollama
+import pytest
+
+from bench.fake_ollama import FakeOllamaServer
+from service.client import ServiceClient
+from service.server import InferenceService
+
+
+class StubBackend:
+    """
+    Remplace core.rag : un encodeur de textes déterministe (sans CLIP) qui note la taille de chaque lot,
+    et les appels au modèle envoyés au faux Ollama.
+    """
+
+    CLIP_MIN_SCORE = 0.0
+
+    def __init__(self, ollama_url, encode_ms=50):
+        self.client = ollama.Client(host=ollama_url)
+        self.encode_ms = encode_ms
+        self.batches = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def embedding(text):
+        v = np.random.default_rng(zlib.crc32(text.encode())).standard_normal(8).astype(np.float32)
+        return v / np.linalg.norm(v)
+
+    def encode_texts(self, texts):
+        with self.lock:
+            self.batches.append(len(texts))
+        time.sleep(self.encode_ms / 1000)
+        return np.stack([self.embedding(t) for t in texts])
+
+    def preprocess_prompt(self, prompt):
+        return prompt.strip()
+
+    def _messages(self, question, image):
+        return [{"role": "user", "content": f"{question} ({image})"}]
+
+    def pipeline_model(self, question, image, model, cache=None):
+        return self.client.chat(model=model, messages=self._messages(question, image))["message"]["content"]
+
+    def stream_model(self, question, image, model, cache=None):
+        for chunk in self.client.chat(model=model, messages=self._messages(question, image), stream=True):
+            yield chunk["message"]["content"]
+
+
+@pytest.fixture
+def fake_ollama():
+    with FakeOllamaServer(latency_ms=300, token_ms=20) as server:
+        yield server
+
+
+@pytest.fixture
+def service(fake_ollama):
+    backend = StubBackend(fake_ollama.url)
+    with InferenceService(port=0, backend=backend, max_wait_ms=20, workers=8, cache=False) as service:
+        yield service, backend
+
+
+def concurrently(url, n, fn):
+    """n clients envoient fn(client, i) en même temps, renvoie leurs résultats dans l'ordre."""
+    barrier = threading.Barrier(n)
+
+    def one(i):
+        client = ServiceClient(url)
+        try:
+            barrier.wait()
+            return fn(client, i)
+        finally:
+            client.close()
+
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        return list(pool.map(one, range(n)))
+
+
+def test_identical_model_requests_are_coalesced(service, fake_ollama):
+    url = service[0].url
+    responses = concurrently(url, 8, lambda client, _: client.pipeline_model("describe", "img.jpg", "llava"))
+    assert len(set(responses)) == 1 and responses[0]
+    assert fake_ollama.stats()["requests"] == 1
+
+    # une autre question n'est pas regroupée avec la précédente
+    client = ServiceClient(url)
+    client.pipeline_model("other question", "img.jpg", "llava")
+    client.close()
+    assert fake_ollama.stats()["requests"] == 2
+
+
+def test_identical_stream_requests_share_tokens(service, fake_ollama):
+    streams = concurrently(service[0].url, 4,
+                           lambda client, _: list(client.pipeline_model("describe", "img.jpg", "llava", stream=True)))
+    assert streams[0] and all(tokens == streams[0] for tokens in streams)
+    assert fake_ollama.stats()["requests"] == 1
+
+
+def test_clip_text_requests_are_batched(service):
+    url, backend = service[0].url, service[1]
+    texts = [f"a photo of object {i}" for i in range(16)]
+    embeddings = concurrently(url, 16, lambda client, i: client.encode_text(texts[i]))
+
+    for text, embedding in zip(texts, embeddings):
+        np.testing.assert_allclose(embedding, StubBackend.embedding(text), rtol=1e-6)
+    assert sum(backend.batches) == 16
+    # 16 requêtes simultanées, moins de forwards que de requêtes
+    assert len(backend.batches) < 16
+    assert max(backend.batches) > 1
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from core.VectorSearch import CLIP_MIN_SCORE, ExactSearch, VectorSearch, balanced_accuracy, calibrate_threshold
+
+
+def normalized(rng, n, d=32):
+    x = rng.standard_normal((n, d)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_calibrate_threshold_separates_scores():
+    rng = np.random.default_rng(0)
+    positive = rng.uniform(0.25, 0.35, 50)
+    negative = rng.uniform(0.10, 0.20, 200)
+    threshold = calibrate_threshold(positive, negative)
+    assert threshold == pytest.approx(positive.min())
+    assert balanced_accuracy(positive, negative, threshold) == 1.0
+
+
+def test_calibrate_threshold_overlapping_scores():
+    positive = [0.30, 0.28, 0.21, 0.26]
+    negative = [0.12, 0.22, 0.18, 0.15]
+    threshold = calibrate_threshold(positive, negative)
+    # un bon couple sous le seuil ou un mauvais au dessus, pas mieux possible
+    assert balanced_accuracy(positive, negative, threshold) == pytest.approx(0.875)
+
+
+def test_min_score_filters_results():
+    rng = np.random.default_rng(1)
+    data = normalized(rng, 20)
+    engine = VectorSearch(data)
+    results = engine.search(data[3], k=5, min_score=0.99)
+    assert results == [(3, pytest.approx(1.0, abs=1e-5))]
+    idx, _ = ExactSearch(data).search(data[3], k=5)
+    assert [i for i, _ in engine.search(data[3], k=5)] == idx.tolist()
+
+
+def test_calibrate_min_score_on_test_images():
+    """CLIP_MIN_SCORE doit séparer les couples annotés de data/test des questions hors sujet (charge CLIP)."""
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from core.rag import calibrate_min_score
+
+    threshold, accuracy, current = calibrate_min_score()
+    assert accuracy >= 0.9
+    assert current >= 0.8, f"CLIP_MIN_SCORE={CLIP_MIN_SCORE} à recalibrer, seuil conseillé {threshold:.3f}"
+
+
+def test_calibrate_min_score_pairs(monkeypatch):
+    """Sans CLIP : chaque question est encodée près de son image, les questions hors sujet loin de toutes."""
+    from core import rag
+
+    rng = np.random.default_rng(2)
+    names = list(rag.CALIBRATION_PAIRS)
+    images = normalized(rng, len(names))
+    near = {q: images[i] for i, name in enumerate(names) for q in rag.CALIBRATION_PAIRS[name]}
+
+    def encode_texts(texts):
+        return np.stack([near[t] if t in near else -images.mean(axis=0) for t in texts])
+
+    monkeypatch.setattr(rag, "encode_images", lambda paths: images)
+    monkeypatch.setattr(rag, "encode_texts", encode_texts)
+    threshold, accuracy, _ = rag.calibrate_min_score()
+    assert accuracy == 1.0
+    assert threshold == pytest.approx(1.0, abs=1e-5)
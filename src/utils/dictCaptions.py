@@ -4,6 +4,8 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 
+from core.CaptionStore import CaptionStore
+
 load_dotenv()
 
 JSON_PATH = os.getenv("DATASET_PATH", "") + "annotations/captions_val2017.json"
@@ -12,6 +14,16 @@ BASE_DIR = Path(__file__).resolve().parent
 OUTPUT_PATH = BASE_DIR / "our_data" / "captions_map.pkl"
 
 
+def captions_store_save():
+    """
+    Base SQLite indexée des légendes (cf core/CaptionStore.py), construite en lisant le json en streaming.
+    Remplace captions_map.pkl : les légendes ne sont chargées qu'à la demande.
+    """
+    store = CaptionStore.from_json(JSON_PATH)
+    print(f"{len(store)} images dans {store.path}")
+    return store
+
+
 def captions_map_save():
     if os.path.exists(OUTPUT_PATH):
         print(f"{OUTPUT_PATH} already created.")
@@ -37,4 +49,4 @@ def captions_map_save():
 
 
 if __name__ == "__main__":
-    captions_map_save()
+    captions_store_save()
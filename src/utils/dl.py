@@ -1,45 +1,488 @@
-import requests
-import zipfile
-import os
-from tqdm import tqdm
-
 """
-    Télécharge les données COCO VAL 2017 automatiquement
+    Télécharge les données COCO VAL 2017 : python -m utils.dl (depuis src/)
     Tu voudras changer la variable DATASET_PATH dans .env pour ./data/coco
+
+    - reprise d'un téléchargement interrompu (requêtes HTTP Range, état dans <archive>.part.json)
+    - téléchargement en plusieurs segments parallèles, par morceaux de 1 Mo
+    - les fichiers du zip sont extraits pendant le téléchargement dès que leurs octets sont arrivés
+      (le répertoire central du zip est téléchargé en premier), chaque fichier est vérifié par son CRC
+    - vérification du checksum de l'archive (MD5 publiés par COCO), et une archive déjà téléchargée, vérifiée et
+      extraite n'est pas refaite
+    - limite : le .part ne peut être supprimé qu'après la vérification du checksum (il faut l'archive entière),
+      le pic d'espace disque est donc la taille de l'archive + celle des fichiers extraits (~1,6 Go pour val2017)
 """
 
-os.makedirs("./data/coco", exist_ok=True)
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from http.server import SimpleHTTPRequestHandler
+from pathlib import Path
 
-urls = {
+import requests
+from tqdm import tqdm
+
+DEFAULT_DEST = "./data/coco"
+
+URLS = {
     "images": "http://images.cocodataset.org/zips/val2017.zip",
     "captions": "http://images.cocodataset.org/annotations/annotations_trainval2017.zip"
 }
 
-def download_and_extract(url, dest_folder):
-    filename = url.split("/")[-1]
-    file_path = os.path.join(dest_folder, filename)
-    
-    print(f"Téléchargement de {filename}")
-    
-    response = requests.get(url, stream=True)
-    total_size = int(response.headers.get('content-length', 0))
-    
-    with open(file_path, "wb") as file, tqdm(
-        desc=filename,
-        total=total_size,
-        unit='iB',
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for data in response.iter_content(chunk_size=1024):
-            size = file.write(data)
-            bar.update(size)
-            
-    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-        zip_ref.extractall(dest_folder)
-    
-    os.remove(file_path)
+# (algorithme, empreinte) des archives officielles
+CHECKSUMS = {
+    "images": ("md5", "442b8da7639aecaf257c1dceb8ba8c80"),
+    "captions": ("md5", "f4bbac642086de4f52a3fdda2de5fa2c"),
+}
+
+CHUNK_SIZE = 1 << 20
+MIN_SEGMENT = 8 << 20
+
+
+class _Ranges:
+    """Intervalles d'octets [début, fin) déjà écrits dans le fichier .part (fusionnés et triés)."""
+
+    def __init__(self, ranges=()):
+        self.lock = threading.Lock()
+        self.ranges = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        with self.lock:
+            merged = []
+            for s, e in self.ranges:
+                if e < start or s > end:
+                    merged.append([s, e])
+                else:
+                    start, end = min(s, start), max(e, end)
+            merged.append([start, end])
+            self.ranges = sorted(merged)
+
+    def covers(self, start, end):
+        with self.lock:
+            i = bisect.bisect_right(self.ranges, [start, float("inf")]) - 1
+            return i >= 0 and self.ranges[i][0] <= start and self.ranges[i][1] >= end
+
+    def missing(self, start, end):
+        """Trous entre start et end."""
+        gaps = []
+        with self.lock:
+            pos = start
+            for s, e in self.ranges:
+                if e <= pos or s >= end:
+                    continue
+                if s > pos:
+                    gaps.append((pos, s))
+                pos = max(pos, e)
+            if pos < end:
+                gaps.append((pos, end))
+        return gaps
+
+    def total(self):
+        with self.lock:
+            return sum(e - s for s, e in self.ranges)
+
+    def to_list(self):
+        with self.lock:
+            return [list(r) for r in self.ranges]
+
+
+def _probe(session, url):
+    """Taille du fichier distant et support des requêtes Range."""
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        if r.status_code == 206 and "/" in r.headers.get("Content-Range", ""):
+            return int(r.headers["Content-Range"].rsplit("/", 1)[1]), True
+        return int(r.headers.get("Content-Length", 0)), False
+
+
+def _fetch_range(session, url, part, start, end, ranges, bar, stop, chunk_size=CHUNK_SIZE, retries=3):
+    """
+    Télécharge les octets [start, end) dans le fichier part. En cas de coupure on reprend là où on en était.
+    """
+    pos = start
+    attempt = 0
+    while pos < end:
+        try:
+            headers = {"Range": f"bytes={pos}-{end - 1}"}
+            with session.get(url, headers=headers, stream=True, timeout=60) as r:
+                if r.status_code != 206:
+                    raise requests.HTTPError(f"Le serveur a répondu {r.status_code} à une requête Range")
+                with open(part, "r+b") as f:
+                    f.seek(pos)
+                    for data in r.iter_content(chunk_size=chunk_size):
+                        if stop.is_set():
+                            return
+                        data = data[:end - pos]
+                        f.write(data)
+                        f.flush()
+                        ranges.add(pos, pos + len(data))
+                        pos += len(data)
+                        bar.update(len(data))
+                        if pos >= end:
+                            break
+            if pos < end:
+                raise requests.ConnectionError("Connexion fermée avant la fin du segment")
+        except requests.RequestException:
+            attempt += 1
+            if attempt > retries or stop.is_set():
+                raise
+            time.sleep(min(2 ** attempt, 30))
+
+
+def _fetch_stream(session, url, part, bar, chunk_size=CHUNK_SIZE):
+    """Téléchargement d'un seul tenant, pour les serveurs qui ne gèrent pas Range (pas de reprise possible)."""
+    with session.get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        with open(part, "wb") as f:
+            for data in r.iter_content(chunk_size=chunk_size):
+                bar.update(f.write(data))
+
+
+def _split(gaps, segments):
+    """Découpe les trous à télécharger en segments de taille proche (au moins MIN_SEGMENT)."""
+    total = sum(e - s for s, e in gaps)
+    size = max(MIN_SEGMENT, -(-total // max(1, segments)))
+    pieces = []
+    for start, end in gaps:
+        for s in range(start, end, size):
+            pieces.append((s, min(s + size, end)))
+    return pieces
+
+
+def file_digest(path, algorithm="sha256"):
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class _ZipStreamer:
+    """
+    Extraction d'un zip pendant qu'il se télécharge : une fois le répertoire central (en fin de fichier) présent,
+    chaque entrée est extraite dès que tous ses octets [header, header suivant) sont arrivés.
+    """
+
+    def __init__(self, part, ranges, cd_offset, dest_dir, extracted):
+        self.zf = zipfile.ZipFile(part)
+        self.ranges = ranges
+        self.dest_dir = dest_dir
+        self.extracted = extracted
+        infos = sorted(self.zf.infolist(), key=lambda i: i.header_offset)
+        ends = [i.header_offset for i in infos[1:]] + [cd_offset]
+        self.pending = [(info, end) for info, end in zip(infos, ends) if info.filename not in extracted]
+
+    @staticmethod
+    def central_directory(part, size, tail_start):
+        """
+        Début du répertoire central d'après l'enregistrement de fin du zip (zip64 compris),
+        None si ce n'est pas un zip. Les octets [tail_start, size) doivent être présents.
+        """
+        with open(part, "rb") as f:
+            f.seek(tail_start)
+            tail = f.read()
+            i = tail.rfind(b"PK\x05\x06")
+            if i < 0 or len(tail) - i < 22:
+                return None
+            cd_size, cd_offset = struct.unpack("<II", tail[i + 12:i + 20])
+            if cd_offset == 0xFFFFFFFF and i >= 20 and tail[i - 20:i - 16] == b"PK\x06\x07":
+                zip64_offset = struct.unpack("<Q", tail[i - 12:i - 4])[0]
+                if zip64_offset < tail_start:
+                    return None
+                f.seek(zip64_offset)
+                record = f.read(56)
+                cd_offset = struct.unpack("<Q", record[48:56])[0]
+        return cd_offset if cd_offset <= size else None
+
+    def extract_ready(self):
+        still = []
+        for info, end in self.pending:
+            if self.ranges.covers(info.header_offset, end):
+                # zipfile vérifie le CRC de l'entrée en la lisant
+                self.zf.extract(info, self.dest_dir)
+                self.extracted.add(info.filename)
+            else:
+                still.append((info, end))
+        self.pending = still
+        return not self.pending
+
+    def close(self):
+        self.zf.close()
+
+
+def _marker_path(dest_dir, name):
+    return Path(dest_dir) / ".fetched" / f"{name}.json"
+
+
+def _already_done(marker, archive, checksum, extract, dest_dir):
+    if not marker.exists():
+        return False
+    try:
+        with open(marker, "r", encoding="utf-8") as f:
+            done = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if checksum is not None and done.get("digest") != checksum.lower():
+        return False
+    if not extract and not archive.exists():
+        return False
+    # dossiers extraits (ex val2017/) supprimés depuis : on refait
+    if extract and not all((Path(dest_dir) / root).exists() for root in done.get("extracted", [])):
+        return False
+    return True
+
+
+def fetch(url, dest_dir=DEFAULT_DEST, checksum=None, algorithm="sha256", segments=4, chunk_size=CHUNK_SIZE,
+          extract=True, keep_archive=False, retries=3, session=None):
+    """
+    Télécharge url dans dest_dir (reprise, segments parallèles, vérification) et extrait le zip.
+    :param checksum: empreinte attendue de l'archive (None = pas de comparaison, l'empreinte est juste enregistrée)
+    :param algorithm: algorithme de checksum (hashlib)
+    :param segments: nombre de connexions parallèles si le serveur gère les requêtes Range
+    :param extract: extrait le zip (pendant le téléchargement si possible)
+    :param keep_archive: garde le zip après extraction
+    :param retries: nombre de reprises d'un segment après une erreur réseau
+    :return: chemin de l'archive (qui n'existe plus si elle a été extraite puis supprimée)
+    """
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    name = url.split("/")[-1]
+    archive = dest_dir / name
+    part = dest_dir / f"{name}.part"
+    state_path = dest_dir / f"{name}.part.json"
+    marker = _marker_path(dest_dir, name)
+    is_zip = extract and name.endswith(".zip")
+
+    if _already_done(marker, archive, checksum, extract, dest_dir):
+        print(f"{name} déjà téléchargé et vérifié.")
+        return archive
+
+    session = session or requests.Session()
+    size, ranged = _probe(session, url)
+
+    # état d'un téléchargement précédent interrompu
+    state = {"url": url, "size": size, "done": [], "extracted": []}
+    if ranged and part.exists() and state_path.exists():
+        with open(state_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("url") == url and previous.get("size") == size:
+            state = previous
+    ranges = _Ranges(state["done"])
+    extracted = set(state["extracted"])
+    if ranges.total() == 0 or not part.exists():
+        with open(part, "wb") as f:
+            f.truncate(size)
+
+    def save_state():
+        tmp = state_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "size": size, "done": ranges.to_list(), "extracted": sorted(extracted)}, f)
+        os.replace(tmp, state_path)
+
+    print(f"Téléchargement de {name}" + (f" (reprise à {ranges.total() / size:.0%})" if ranges.total() else ""))
+    stop = threading.Event()
+    streamer = None
+    with tqdm(desc=name, total=size, initial=ranges.total(), unit='iB', unit_scale=True, unit_divisor=1024) as bar:
+        if not ranged:
+            _fetch_stream(session, url, part, bar, chunk_size)
+        else:
+            if is_zip and size > 0:
+                # fin du fichier d'abord : enregistrement de fin + répertoire central
+                tail_start = max(0, size - (1 << 16) - 22)
+                for s, e in ranges.missing(tail_start, size):
+                    _fetch_range(session, url, part, s, e, ranges, bar, stop, chunk_size, retries)
+                cd_offset = _ZipStreamer.central_directory(part, size, tail_start)
+                if cd_offset is not None:
+                    for s, e in ranges.missing(cd_offset, size):
+                        _fetch_range(session, url, part, s, e, ranges, bar, stop, chunk_size, retries)
+                    try:
+                        streamer = _ZipStreamer(part, ranges, cd_offset, dest_dir, extracted)
+                    except zipfile.BadZipFile:
+                        streamer = None
+
+            pieces = _split(ranges.missing(0, size), segments)
+            with ThreadPoolExecutor(max_workers=max(1, segments)) as pool:
+                futures = [pool.submit(_fetch_range, session, url, part, s, e, ranges, bar, stop, chunk_size, retries)
+                           for s, e in pieces]
+                try:
+                    while True:
+                        done, not_done = wait(futures, timeout=1.0, return_when=FIRST_EXCEPTION)
+                        if streamer is not None:
+                            streamer.extract_ready()
+                        save_state()
+                        for future in done:
+                            future.result()
+                        if not not_done:
+                            break
+                except BaseException:
+                    stop.set()
+                    save_state()
+                    if streamer is not None:
+                        streamer.close()
+                    raise
+
+    digest = file_digest(part, algorithm)
+    if checksum is not None and digest != checksum.lower():
+        if streamer is not None:
+            streamer.close()
+        part.unlink()
+        state_path.unlink(missing_ok=True)
+        raise ValueError(f"Checksum invalide pour {name} : {digest} au lieu de {checksum}")
+
+    roots = []
+    if is_zip:
+        if streamer is not None:
+            streamer.extract_ready()
+            streamer.close()
+        with zipfile.ZipFile(part) as zf:
+            if streamer is None:
+                zf.extractall(dest_dir)
+            roots = sorted({name.split("/", 1)[0] for name in zf.namelist()})
+
+    state_path.unlink(missing_ok=True)
+    if is_zip and not keep_archive:
+        part.unlink()
+    else:
+        os.replace(part, archive)
+
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump({"url": url, "size": size, "algorithm": algorithm, "digest": digest, "extracted": roots}, f)
     print("Done.")
+    return archive
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Stand-in local de serveur de téléchargement : http.server avec les requêtes Range,
+    et une coupure simulée après `fail_after` octets envoyés (pour tester la reprise).
+    """
+    fail_after = None
+    sent = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().do_GET()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) + 1 if match.group(2) else size, size)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                cls = type(self)
+                if cls.fail_after is not None and cls.sent + len(data) > cls.fail_after:
+                    # coupure brutale de la connexion
+                    cls.fail_after = None
+                    self.close_connection = True
+                    return
+                self.wfile.write(data)
+                cls.sent += len(data)
+                remaining -= len(data)
+
+
+def selftest(root=None):
+    """
+    Vérifie le fetcher contre un serveur http.server local : coupure puis reprise, extraction pendant le
+    téléchargement, checksum, téléchargement ignoré la 2e fois mais refait si le dossier extrait a disparu,
+    et serveur sans Range (http.server de base).
+    :param root: dossier de travail (défaut : un dossier temporaire)
+    """
+    import random
+    import shutil
+    import tempfile
+    from functools import partial
+    from http.server import ThreadingHTTPServer
+
+    root = Path(root) if root is not None else Path(tempfile.mkdtemp(prefix="dl_selftest_"))
+    served = root / "served"
+    served.mkdir()
+    rng = random.Random(0)
+    files = {f"val/{k:04d}.bin": rng.randbytes(rng.randint(1, 200_000)) for k in range(300)}
+    with zipfile.ZipFile(served / "data.zip", "w", zipfile.ZIP_STORED) as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    expected = file_digest(served / "data.zip")
+    size = (served / "data.zip").stat().st_size
+
+    def check(dest):
+        for name, data in files.items():
+            assert (dest / name).read_bytes() == data, name
+
+    for handler in (RangeRequestHandler, SimpleHTTPRequestHandler):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=str(served)))
+        # les connexions coupées par le client (sonde, interruption) ne sont pas des erreurs ici
+        server.handle_error = lambda request, address: None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/data.zip"
+        dest = root / handler.__name__
+        try:
+            if handler is RangeRequestHandler:
+                # 1er essai coupé à la moitié, sans reprise automatique
+                RangeRequestHandler.fail_after, RangeRequestHandler.sent = size // 2, 0
+                try:
+                    fetch(url, dest, checksum=expected, segments=4, retries=0)
+                    raise AssertionError("le téléchargement aurait dû être interrompu")
+                except requests.RequestException:
+                    pass
+                RangeRequestHandler.sent = 0
+                fetch(url, dest, checksum=expected, segments=4)
+                assert RangeRequestHandler.sent < size, "la reprise a tout re-téléchargé"
+            else:
+                fetch(url, dest, checksum=expected, segments=4)
+            check(dest)
+            assert not (dest / "data.zip").exists() and not (dest / "data.zip.part").exists()
+            sent_before = RangeRequestHandler.sent
+            fetch(url, dest, checksum=expected)
+            assert RangeRequestHandler.sent == sent_before, "archive déjà extraite re-téléchargée"
+            shutil.rmtree(dest / "val")
+            fetch(url, dest, checksum=expected)
+            check(dest)
+        finally:
+            server.shutdown()
+            server.server_close()
+    print(f"Selftest OK ({root})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Téléchargement des données COCO val2017")
+    parser.add_argument("datasets", nargs="*", help=f"parmi {', '.join(URLS)} (par défaut : tout)")
+    parser.add_argument("--dest", default=DEFAULT_DEST)
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--keep-archive", action="store_true")
+    parser.add_argument("--selftest", action="store_true", help="test contre un serveur http.server local")
+    args = parser.parse_args()
+    if args.selftest:
+        selftest()
+        return
+    unknown = [key for key in args.datasets if key not in URLS]
+    if unknown:
+        parser.error(f"jeu de données inconnu : {', '.join(unknown)}")
+    for key in args.datasets or list(URLS):
+        algorithm, checksum = CHECKSUMS[key]
+        fetch(URLS[key], args.dest, checksum=checksum, algorithm=algorithm, segments=args.segments,
+              keep_archive=args.keep_archive)
+
 
-download_and_extract(urls["images"], "./data/coco")
-download_and_extract(urls["captions"], "./data/coco")
+if __name__ == "__main__":
+    main()
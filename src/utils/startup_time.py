@@ -0,0 +1,48 @@
+"""
+    Mesure le temps de démarrage (import à froid dans un process neuf) des modules du projet,
+    et le temps de chargement de CLIP. A lancer depuis src/ : python -m utils.startup_time
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+
+CHECKS = {
+    "import core.Model": "import core.Model",
+    "import core.rag": "import core.rag",
+    "import evaluation.Scorer": "import evaluation.Scorer",
+    "core.rag.get_clip()": "import core.rag as r; r.get_clip()",
+}
+
+
+def measure(statement, repeat=3):
+    """
+    Meilleur temps (en s) sur repeat process python neufs pour exécuter statement.
+    """
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"{statement}; "
+        "print(time.perf_counter() - t)"
+    )
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr.strip().splitlines()[-1])
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def main():
+    print(f"{'étape':<28} {'temps (s)':>10}")
+    for name, statement in CHECKS.items():
+        try:
+            print(f"{name:<28} {measure(statement):>10.3f}")
+        except Exception as e:
+            print(f"{name:<28} {'erreur':>10}  ({e})")
+
+
+if __name__ == "__main__":
+    main()